@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import CountryRule, ContactMessage, SiteSettings, PageMeta
+from .models import CountryRule, ContactMessage, SiteSettings, PageMeta, ApiClient, WebhookDelivery
 
 @admin.register(CountryRule)
 class CountryRuleAdmin(admin.ModelAdmin):
@@ -53,3 +53,30 @@ class PageMetaAdmin(admin.ModelAdmin):
     list_display = ('path', 'title')
     search_fields = ('path', 'title', 'description')
     list_per_page = 200
+
+@admin.register(ApiClient)
+class ApiClientAdmin(admin.ModelAdmin):
+    list_display = ('name', 'is_active', 'created_at')
+    list_filter = ('is_active',)
+    search_fields = ('name', 'callback_hosts')
+    readonly_fields = ('created_at',)
+
+@admin.register(WebhookDelivery)
+class WebhookDeliveryAdmin(admin.ModelAdmin):
+    list_display = ('job_id', 'client', 'url', 'attempts', 'last_error', 'created_at')
+    list_filter = ('client',)
+    readonly_fields = ('client', 'job_id', 'url', 'base_url', 'event', 'attempts', 'last_error', 'created_at')
+    actions = ['redeliver']
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description='Redeliver selected webhooks')
+    def redeliver(self, request, queryset):
+        from .tasks import deliver_webhook
+        count = 0
+        for delivery in queryset:
+            deliver_webhook.delay(delivery.client_id, delivery.url, delivery.base_url, delivery.event)
+            delivery.delete()
+            count += 1
+        self.message_user(request, f"Queued {count} webhook(s) for redelivery.")
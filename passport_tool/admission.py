@@ -0,0 +1,217 @@
+"""
+Admission control and queue ETAs.
+
+Every queued job is priced in milliseconds (cost.py's estimate times a
+per-mode correction learned from real service times) and added to its
+queue's outstanding work when admitted. A new job's ETA is the work ahead
+of it spread over the queue's workers plus its own service time. Jobs
+whose ETA exceeds ADMISSION_SLO_SECONDS are refused with 503 and
+Retry-After instead of being accepted and abandoned by the client later.
+
+Counters live in Redis (redis_client.py) next to the scheduler state.
+Workers report completions through Celery's task signals.
+"""
+import json
+import logging
+import math
+import time
+
+from celery.signals import task_prerun, task_postrun, task_revoked
+
+from . import metrics
+from .liveness import CANCELLED
+from .limits import DEGRADED
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest sample in the service-time moving average
+EWMA_ALPHA = 0.2
+# Bookkeeping for admitted jobs outlives any sane job
+JOB_TTL = 24 * 3600
+
+# Start times of tasks running in this worker process
+_started = {}
+
+
+def _redis():
+    from .redis_client import get_redis
+    return get_redis()
+
+
+def service_ms(mode, estimated_ms):
+    """Cost-model estimate corrected by the observed actual/estimated ratio for `mode`."""
+    try:
+        correction = float(_redis().hget('admission:correction', mode) or 1.0)
+    except Exception:
+        correction = 1.0
+    return estimated_ms * correction
+
+
+def record_service(mode, estimated_ms, actual_ms):
+    redis = _redis()
+    ratio = actual_ms / max(estimated_ms, 1)
+    previous = redis.hget('admission:correction', mode)
+    correction = ratio if previous is None else (1 - EWMA_ALPHA) * float(previous) + EWMA_ALPHA * ratio
+    redis.hset('admission:correction', mode, round(correction, 4))
+
+
+class Admission:
+    def __init__(self, queue, position, eta_seconds, service_ms, slo_seconds):
+        self.queue = queue
+        self.position = position
+        self.eta_seconds = eta_seconds
+        self.service_ms = service_ms
+        self.accepted = eta_seconds <= slo_seconds
+        # Time for the backlog to drain back under the SLO
+        self.retry_after = max(5, math.ceil(eta_seconds - slo_seconds))
+
+
+def _admission(job, own_ms, pending_jobs, pending_ms):
+    from django.conf import settings
+    workers = max(1, settings.QUEUE_CONCURRENCY.get(job.queue, 1))
+    eta_seconds = (pending_ms / workers + own_ms) / 1000
+    return Admission(job.queue, pending_jobs + 1, round(eta_seconds, 1), own_ms, settings.ADMISSION_SLO_SECONDS)
+
+
+def assess(job):
+    """Predicts queue position and ETA for a JobCost on its queue."""
+    own_ms = service_ms(job.mode, job.estimated_ms)
+    try:
+        redis = _redis()
+        pending_jobs = int(redis.get(f"admission:{job.queue}:jobs") or 0)
+        pending_ms = float(redis.get(f"admission:{job.queue}:ms") or 0)
+    except Exception as e:
+        logger.warning("Queue stats unavailable (%s); admitting without ETA", e)
+        pending_jobs, pending_ms = 0, 0.0
+    return _admission(job, own_ms, pending_jobs, pending_ms)
+
+
+async def aassess(job):
+    """assess for async views."""
+    from .redis_client import get_async_redis
+    redis = get_async_redis()
+    try:
+        correction = float(await redis.hget('admission:correction', job.mode) or 1.0)
+    except Exception:
+        correction = 1.0
+    try:
+        pending_jobs = int(await redis.get(f"admission:{job.queue}:jobs") or 0)
+        pending_ms = float(await redis.get(f"admission:{job.queue}:ms") or 0)
+    except Exception as e:
+        logger.warning("Queue stats unavailable (%s); admitting without ETA", e)
+        pending_jobs, pending_ms = 0, 0.0
+    return _admission(job, job.estimated_ms * correction, pending_jobs, pending_ms)
+
+
+def _record(job, admission):
+    return json.dumps({
+        'queue': job.queue,
+        'mode': job.mode,
+        'estimated_ms': job.estimated_ms,
+        'service_ms': int(admission.service_ms),
+    })
+
+
+def admitted(task_id, job, admission):
+    """Adds an accepted job's work to its queue's outstanding total."""
+    try:
+        redis = _redis()
+        redis.incr(f"admission:{job.queue}:jobs")
+        redis.incrby(f"admission:{job.queue}:ms", int(admission.service_ms))
+        redis.set(f"admission:task:{task_id}", _record(job, admission), ex=JOB_TTL)
+    except Exception as e:
+        logger.warning("Could not record admitted job %s: %s", task_id, e)
+
+
+async def aadmitted(task_id, job, admission):
+    """admitted for async views."""
+    from .redis_client import get_async_redis
+    try:
+        redis = get_async_redis()
+        await redis.incr(f"admission:{job.queue}:jobs")
+        await redis.incrby(f"admission:{job.queue}:ms", int(admission.service_ms))
+        await redis.set(f"admission:task:{task_id}", _record(job, admission), ex=JOB_TTL)
+    except Exception as e:
+        logger.warning("Could not record admitted job %s: %s", task_id, e)
+
+
+def retried(task_id, retry_id, queue):
+    """
+    Admits the retry of a running job to `queue` with the original's cost
+    (the original's own work is released when it finishes). Returns the
+    estimated ms, for the scheduler.
+    """
+    try:
+        redis = _redis()
+        record = redis.get(f"admission:task:{task_id}")
+        if record is None:
+            return 0
+        record = json.loads(record)
+        record['queue'] = queue
+        redis.incr(f"admission:{queue}:jobs")
+        redis.incrby(f"admission:{queue}:ms", record['service_ms'])
+        redis.set(f"admission:task:{retry_id}", json.dumps(record), ex=JOB_TTL)
+        return record['estimated_ms']
+    except Exception as e:
+        logger.warning("Could not record retry %s of job %s: %s", retry_id, task_id, e)
+        return 0
+
+
+def withdrawn(task_id):
+    """Takes an admitted job's work back off its queue when it was never queued."""
+    try:
+        finished(task_id)
+    except Exception as e:
+        logger.warning("Could not withdraw admitted job %s: %s", task_id, e)
+
+
+def finished(task_id, actual_ms=None, abandoned=False):
+    """
+    Removes a job's work from its queue and learns from its real service
+    time. For abandoned jobs it instead records the worker time wasted
+    before the cancel and the estimated time saved by it.
+    """
+    redis = _redis()
+    record = redis.get(f"admission:task:{task_id}")
+    if record is None:
+        return
+    redis.delete(f"admission:task:{task_id}")
+    record = json.loads(record)
+    queue = record['queue']
+    if redis.decr(f"admission:{queue}:jobs") < 0:
+        redis.set(f"admission:{queue}:jobs", 0)
+    if redis.incrby(f"admission:{queue}:ms", -record['service_ms']) < 0:
+        redis.set(f"admission:{queue}:ms", 0)
+    if abandoned:
+        wasted_ms = actual_ms or 0
+        metrics.incr('abandoned_jobs')
+        metrics.incr('abandoned_work_ms', wasted_ms)
+        metrics.incr('abandoned_saved_ms', max(0, record['service_ms'] - wasted_ms))
+    elif actual_ms is not None:
+        record_service(record['mode'], record['estimated_ms'], actual_ms)
+
+
+@task_prerun.connect
+def note_task_start(task_id=None, **kwargs):
+    _started[task_id] = time.monotonic()
+
+
+@task_postrun.connect
+def note_task_finish(task_id=None, retval=None, **kwargs):
+    started = _started.pop(task_id, None)
+    actual_ms = (time.monotonic() - started) * 1000 if started is not None else None
+    if retval == DEGRADED:
+        # Over budget: an outlier, not a sample of the mode's service time
+        actual_ms = None
+    try:
+        finished(task_id, actual_ms, abandoned=retval == CANCELLED)
+    except Exception as e:
+        logger.warning("Could not record finished job %s: %s", task_id, e)
+
+
+@task_revoked.connect
+def note_task_revoked(request=None, **kwargs):
+    try:
+        finished(request.id, abandoned=True)
+    except Exception as e:
+        logger.warning("Could not record revoked job: %s", e)
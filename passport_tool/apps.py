@@ -6,4 +6,9 @@ class PassportToolConfig(AppConfig):
     name = 'passport_tool'
 
     def ready(self):
+        from django.core import checks
         import passport_tool.signals
+        from .imaging import check_backend
+        from .limits import check_budgets
+        checks.register(check_backend)
+        checks.register(check_budgets)
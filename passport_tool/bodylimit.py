@@ -0,0 +1,86 @@
+"""
+Upload size limit enforced at the ASGI edge.
+
+Django's ASGIHandler receives the whole request body (into a spooled file
+held in memory up to FILE_UPLOAD_MAX_MEMORY_SIZE) before any view or
+upload handler runs, so PhotoUploadHandler's size check (uploads.py) only
+sees a photo after all of it has arrived. UploadSizeLimit wraps the ASGI
+application and stops photo uploads while they arrive instead:
+
+- a Content-Length past the limit is answered with 413 before any of the
+  body is read;
+- bodies without one (chunked) are counted as they arrive, and the
+  request is answered with 413 and abandoned once they pass the limit.
+
+The limit is PHOTO_UPLOAD_MAX_BYTES plus FORM_ALLOWANCE for the multipart
+framing and the other form fields. Only /api/upload/ is limited: the admin
+and CKEditor keep Django's own limits.
+"""
+import json
+
+UPLOAD_PATH = '/api/upload/'
+
+# Multipart boundaries, part headers and the small form fields
+FORM_ALLOWANCE = 64 * 1024
+
+REJECTION = json.dumps({'error': 'File too large.', 'status': 'file_too_large'}).encode()
+
+
+def _content_length(scope):
+    for name, value in scope.get('headers', ()):
+        if name == b'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+class UploadSizeLimit:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(UPLOAD_PATH):
+            return await self.app(scope, receive, send)
+        from django.conf import settings
+        limit = settings.PHOTO_UPLOAD_MAX_BYTES + FORM_ALLOWANCE
+        length = _content_length(scope)
+        if length is not None and length > limit:
+            return await self._reject(send)
+
+        received = 0
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {'type': 'http.disconnect'}
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    rejected = True
+                    await self._reject(send)
+                    # Django stops reading (RequestAborted) and sends nothing
+                    return {'type': 'http.disconnect'}
+            return message
+
+        async def guarded_send(message):
+            if not rejected:
+                await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
+
+    @staticmethod
+    async def _reject(send):
+        await send({
+            'type': 'http.response.start',
+            'status': 413,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(REJECTION)).encode()),
+                (b'connection', b'close'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': REJECTION})
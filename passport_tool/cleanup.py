@@ -0,0 +1,120 @@
+"""
+Expiry of database-store jobs (cleanup_old_photos).
+
+Expired ProcessedPhoto rows are deleted oldest first in batches of
+CLEANUP_BATCH_SIZE, walking the created_at index, and at most
+CLEANUP_MAX_BATCHES per run: a backlog is worked off over several runs
+instead of making one run as slow as the backlog is long. Each batch is
+a regular QuerySet.delete(), so the post_delete receiver (models.py)
+removes each row's files; its per-row signal and stat calls are the price
+of not bypassing the ORM.
+
+Files are stored under uploads/%Y/%m/%d/ and processed/%Y/%m/%d/, so a day
+directory that ended before the cutoff only holds files of expired jobs,
+including ones no row points to any more (failed saves, crashed workers).
+Such directories are removed whole, then any month and year left empty.
+"""
+import os
+import shutil
+import time
+from datetime import datetime, timedelta
+
+FILE_FIELDS = ('original_image', 'processed_image', 'preview_image')
+# upload_to roots of ProcessedPhoto's file fields
+DATE_DIRECTORIES = ('uploads', 'processed')
+
+
+class CleanupStats:
+    def __init__(self):
+        self.rows = 0
+        self.batches = 0
+        self.files = 0
+        self.directories = 0
+        self.orphans = 0
+        self.backlog = False
+        self.started = time.monotonic()
+
+    @property
+    def elapsed_ms(self):
+        return (time.monotonic() - self.started) * 1000
+
+    def __str__(self):
+        return (
+            f"Deleted {self.rows} expired photo records in {self.batches} batches"
+            f"{' (more left for the next run)' if self.backlog else ''}, "
+            f"{self.files} files, "
+            f"{self.directories} date directories ({self.orphans} orphaned files) "
+            f"in {self.elapsed_ms:.0f} ms."
+        )
+
+
+def delete_expired_rows(cutoff, batch_size, max_batches, stats):
+    from .models import ProcessedPhoto
+    expired = ProcessedPhoto.objects.filter(created_at__lt=cutoff).order_by('created_at')
+    while stats.batches < max_batches:
+        batch = list(expired.values_list('id', *FILE_FIELDS)[:batch_size])
+        if not batch:
+            return
+        # post_delete removes the files
+        ProcessedPhoto.objects.filter(id__in=[row[0] for row in batch]).delete()
+        stats.files += sum(1 for row in batch for name in row[1:] if name)
+        stats.rows += len(batch)
+        stats.batches += 1
+        if len(batch) < batch_size:
+            return
+    stats.backlog = expired.exists()
+
+
+def _day_directories(root):
+    """(date, path) of every root/YYYY/MM/DD directory."""
+    for year in os.scandir(root):
+        if not (year.is_dir() and year.name.isdigit()):
+            continue
+        for month in os.scandir(year.path):
+            if not (month.is_dir() and month.name.isdigit()):
+                continue
+            for day in os.scandir(month.path):
+                try:
+                    date = datetime(int(year.name), int(month.name), int(day.name)).date()
+                except ValueError:
+                    continue
+                if day.is_dir():
+                    yield date, day.path
+
+
+def _remove_if_empty(path):
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+def sweep_date_directories(cutoff, stats):
+    from django.core.files.storage import default_storage
+    if not hasattr(default_storage, 'path'):
+        # Only local storage has directories to sweep
+        return
+    # upload_to dates are local server time (TIME_ZONE)
+    from django.utils import timezone
+    last_day = (timezone.localtime(cutoff) - timedelta(days=1)).date()
+    for prefix in DATE_DIRECTORIES:
+        root = default_storage.path(prefix)
+        if not os.path.isdir(root):
+            continue
+        for date, path in sorted(_day_directories(root)):
+            if date > last_day:
+                continue
+            stats.orphans += sum(1 for entry in os.scandir(path) if entry.is_file())
+            shutil.rmtree(path, ignore_errors=True)
+            stats.directories += 1
+            month = os.path.dirname(path)
+            _remove_if_empty(month)
+            _remove_if_empty(os.path.dirname(month))
+
+
+def cleanup_expired(cutoff, batch_size, max_batches):
+    """Deletes jobs created before `cutoff` and their files; returns CleanupStats."""
+    stats = CleanupStats()
+    delete_expired_rows(cutoff, batch_size, max_batches, stats)
+    sweep_date_directories(cutoff, stats)
+    return stats
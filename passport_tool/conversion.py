@@ -0,0 +1,164 @@
+"""
+Fast conversion engine for the converter and compressor tools (is_tool rules).
+
+Unlike process_image() there is no segmentation, face detection or
+enhancement: decode, optional resize, encode to the target format.
+Colour profiles are carried over, JPEGs are written progressive and
+optimised, and a byte budget is met by searching the encoder quality first
+and only shrinking the image when even the lowest quality is too big.
+"""
+import io
+import re
+
+from PIL import Image, ImageOps
+
+from .engine import OPTIMIZE_MAX_PIXELS
+
+FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP'}
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+LOSSY_FORMATS = {'JPEG', 'WEBP'}
+
+DEFAULT_QUALITY = 90
+MIN_QUALITY = 40
+# Downscale attempts when the lowest quality still misses the byte budget
+MAX_SHRINK_STEPS = 3
+
+# EXIF orientations that swap width and height
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def target_format(rule, requested=None):
+    """
+    Output format for a conversion: an explicit request wins, then the
+    rule's slug ("heic-to-jpg" -> JPEG). None keeps the source format.
+    """
+    if requested and requested.lower() in FORMATS:
+        return FORMATS[requested.lower()]
+    match = re.search(r'(?:^|-)to-(jpe?g|png|webp)(?:-|$)', rule.slug)
+    return FORMATS[match.group(1)] if match else None
+
+
+def _has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or (
+        image.mode == 'P' and 'transparency' in image.info
+    )
+
+
+def _prepare(image, fmt, icc_profile):
+    """Converts `image` to a mode `fmt` can store; returns (image, icc_profile)."""
+    if image.mode == 'CMYK' and fmt != 'JPEG':
+        if icc_profile:
+            # Keep colours right when leaving CMYK: convert through the profile to sRGB
+            from PIL import ImageCms
+            image = ImageCms.profileToProfile(
+                image, ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)),
+                ImageCms.createProfile('sRGB'), outputMode='RGB'
+            )
+            icc_profile = None
+        else:
+            image = image.convert('RGB')
+
+    if fmt == 'JPEG':
+        if _has_alpha(image):
+            # JPEG has no alpha: flatten onto white like the editor does
+            rgba = image.convert('RGBA')
+            flat = Image.new('RGB', rgba.size, (255, 255, 255))
+            flat.paste(rgba, mask=rgba.getchannel('A'))
+            image = flat
+        elif image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+    elif fmt == 'WEBP':
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if _has_alpha(image) else 'RGB')
+    elif image.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I', 'I;16'):
+        image = image.convert('RGBA' if _has_alpha(image) else 'RGB')
+    return image, icc_profile
+
+
+def _encode(image, fmt, quality, icc_profile):
+    buffer = io.BytesIO()
+    params = {'icc_profile': icc_profile} if icc_profile else {}
+    if fmt == 'JPEG':
+        image.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True, **params)
+    elif fmt == 'WEBP':
+        image.save(buffer, format='WEBP', quality=quality, method=4, **params)
+    else:
+        optimize = image.width * image.height <= OPTIMIZE_MAX_PIXELS
+        image.save(buffer, format='PNG', optimize=optimize, **params)
+    return buffer.getvalue()
+
+
+def _encode_within(image, fmt, quality, icc_profile, budget):
+    """
+    Highest quality in MIN_QUALITY..quality whose encoding fits `budget`
+    bytes (binary search); the smallest attempt if none fits.
+    """
+    best = _encode(image, fmt, quality, icc_profile)
+    if len(best) <= budget or fmt not in LOSSY_FORMATS:
+        return best
+    low, high = MIN_QUALITY, quality - 1
+    fitting = None
+    smallest = best
+    while low <= high:
+        mid = (low + high) // 2
+        data = _encode(image, fmt, mid, icc_profile)
+        if len(data) <= budget:
+            fitting = data
+            low = mid + 1
+        else:
+            smallest = min(smallest, data, key=len)
+            high = mid - 1
+    return fitting or smallest
+
+
+def convert_image(source, fmt=None, size=None, quality=DEFAULT_QUALITY, target_kb=None, output=None):
+    """
+    Transcodes `source` (bytes or a binary file) to `fmt` ("JPEG", "PNG" or
+    "WEBP"; None keeps the source format when it is one of those, otherwise
+    PNG for images with transparency and JPEG for the rest).
+
+    `size` resizes to exactly (width, height). `target_kb` caps the output:
+    quality is lowered first, then the image is shrunk step by step.
+
+    Returns (data, fmt), where data is `output` if a writable binary file
+    object was given, otherwise the encoded bytes.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    image = Image.open(source)
+    icc_profile = image.info.get('icc_profile')
+    if fmt is None:
+        fmt = image.format if image.format in EXTENSIONS else ('PNG' if _has_alpha(image) else 'JPEG')
+
+    if size and image.format == 'JPEG':
+        # Let the JPEG decoder downscale by 1/2..1/8 while decoding
+        draft_size = size
+        if image.getexif().get(0x0112) in TRANSPOSED_ORIENTATIONS:
+            draft_size = (size[1], size[0])
+        image.draft(image.mode, draft_size)
+
+    image = ImageOps.exif_transpose(image)
+    if size and image.size != tuple(size):
+        image = image.resize(size, Image.Resampling.LANCZOS)
+    image, icc_profile = _prepare(image, fmt, icc_profile)
+
+    if target_kb:
+        budget = target_kb * 1024
+        data = _encode_within(image, fmt, quality, icc_profile, budget)
+        for _ in range(MAX_SHRINK_STEPS):
+            if len(data) <= budget:
+                break
+            # Bytes scale roughly with area; aim a little under the budget
+            scale = min(0.9, (budget / len(data)) ** 0.5 * 0.95)
+            image = image.resize(
+                (max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                Image.Resampling.LANCZOS,
+            )
+            data = _encode_within(image, fmt, quality, icc_profile, budget)
+    else:
+        data = _encode(image, fmt, quality, icc_profile)
+
+    if output is not None:
+        output.write(data)
+        return output, fmt
+    return data, fmt
@@ -0,0 +1,117 @@
+"""
+Per-request cost estimates for processing jobs.
+
+upload_photo classifies every upload into a mode, takes the pixel count
+from the image header (probe.py) and estimates the service time. Cheap jobs within
+the INLINE_MAX_MS / INLINE_MAX_BYTES budget are processed in the web
+process and returned in the upload response; everything else is queued
+on the Celery queue matching its cost, so short jobs never wait behind
+segmentation:
+
+- "fast":          cheap non-segmentation jobs (threaded worker pool)
+- "bulk":          non-segmentation jobs over FAST_QUEUE_MAX_MS, e.g. huge scans
+- "segmentation":  u2net + matting (solo/prefork pool, one job per process)
+"""
+import threading
+
+from PIL import Image
+from pillow_heif import register_heif_opener
+register_heif_opener()
+
+# (fixed ms, ms per input megapixel), single-threaded Pillow backend
+COST_MODEL = {
+    'conversion': (10, 30),
+    'signature': (20, 110),
+    'original': (40, 270),
+    'skip_bg': (40, 270),
+    'human': (2500, 400),
+}
+
+# Segmentation needs the ONNX models, which only workers load
+INLINE_MODES = {'conversion', 'signature', 'original', 'skip_bg'}
+
+QUEUE_FAST = 'fast'
+QUEUE_BULK = 'bulk'
+QUEUE_SEGMENTATION = 'segmentation'
+
+# INLINE_CONCURRENCY inline jobs per web process at a time; the rest go to
+# the queue. Created on first use, once settings are loaded.
+_inline_slot = None
+_inline_slot_lock = threading.Lock()
+
+
+def job_mode(rule, skip_bg=False, use_original_dimensions=False, is_signature=False, convert=False):
+    """Which pipeline an upload needs: conversion, signature, original, skip_bg or human."""
+    if is_signature:
+        return 'signature'
+    if skip_bg and (rule.is_tool or convert):
+        return 'conversion'
+    if skip_bg:
+        return 'original' if use_original_dimensions else 'skip_bg'
+    return 'human'
+
+
+def read_megapixels(upload):
+    """Pixel count from the image header, without decoding; None if unreadable."""
+    try:
+        with Image.open(upload) as image:
+            width, height = image.size
+        return width * height / 1_000_000
+    except Exception:
+        return None
+    finally:
+        upload.seek(0)
+
+
+class JobCost:
+    def __init__(self, mode, megapixels, size_bytes, info=None):
+        self.mode = mode
+        self.megapixels = megapixels
+        self.size_bytes = size_bytes
+        # probe.ImageInfo of the upload, when admission read it
+        self.info = info
+        fixed_ms, per_mp_ms = COST_MODEL[mode]
+        # Unreadable headers are priced like a 12 MP phone photo
+        self.estimated_ms = fixed_ms + per_mp_ms * (megapixels if megapixels is not None else 12)
+
+    @property
+    def inline(self):
+        from django.conf import settings
+        return (
+            self.mode in INLINE_MODES
+            and self.megapixels is not None
+            and self.size_bytes <= settings.INLINE_MAX_BYTES
+            and self.estimated_ms <= settings.INLINE_MAX_MS
+        )
+
+    @property
+    def queue(self):
+        from django.conf import settings
+        if self.mode == 'human':
+            return QUEUE_SEGMENTATION
+        if self.estimated_ms <= settings.FAST_QUEUE_MAX_MS:
+            return QUEUE_FAST
+        return QUEUE_BULK
+
+    def __repr__(self):
+        mp = f"{self.megapixels:.1f}MP" if self.megapixels is not None else "?MP"
+        return f"JobCost({self.mode}, {mp}, {self.size_bytes // 1024}KB, ~{self.estimated_ms:.0f}ms)"
+
+
+def estimate_job(upload, mode, info=None):
+    megapixels = info.megapixels if info is not None else read_megapixels(upload)
+    return JobCost(mode, megapixels, upload.size, info=info)
+
+
+def acquire_inline_slot():
+    global _inline_slot
+    if _inline_slot is None:
+        from django.conf import settings
+        with _inline_slot_lock:
+            if _inline_slot is None:
+                _inline_slot = threading.BoundedSemaphore(settings.INLINE_CONCURRENCY)
+    return _inline_slot.acquire(blocking=False)
+
+
+def release_inline_slot():
+    _inline_slot.release()
@@ -0,0 +1,131 @@
+"""
+Single-flight deduplication of identical uploads.
+
+A job is identified by the SHA-256 of the upload plus every parameter that
+affects the result (rule, mode, flags, conversion options), scoped to the
+uploader's session. A repeat upload (double click, retry after a network
+error) while the first job is queued, running or waiting to be fetched
+attaches to that job instead of creating a second job and task. The
+session is part of the key, so identical photos from different visitors
+never share a job; an IP address would not be enough (shared NATs).
+
+Each extra subscriber is counted so a failure stays reportable until every
+one of them has polled it, and one page closing does not cancel the job
+for the others. (Results are retained for a fixed window anyway, see
+delivery.py.)
+"""
+import hashlib
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Matches the job lifetime (cleanup_old_photos / JOB_TTL_SECONDS)
+FLIGHT_TTL = 3600
+
+JOINABLE_STATUSES = ('pending', 'processing', 'preview', 'completed')
+
+
+def _redis():
+    from .redis_client import get_redis
+    return get_redis()
+
+
+def content_digest(upload):
+    """SHA-256 of an uploaded file, reusing one computed while receiving it."""
+    digest = getattr(upload, 'sha256', None)
+    if digest:
+        return digest
+    sha = hashlib.sha256()
+    for chunk in upload.chunks():
+        sha.update(chunk)
+    upload.seek(0)
+    return sha.hexdigest()
+
+
+def flight_key(session_key, digest, params):
+    identity = json.dumps([session_key, digest, params], sort_keys=True)
+    return f"flight:{hashlib.sha256(identity.encode()).hexdigest()}"
+
+
+def find(key):
+    """The joinable job registered under `key`, if any."""
+    from .jobs import get_job_store
+    try:
+        photo_id = _redis().get(key)
+    except Exception as e:
+        logger.warning("Dedup lookup failed (%s); processing separately", e)
+        return None
+    if photo_id is None:
+        return None
+    job = get_job_store().get(photo_id)
+    return job if job is not None and job.status in JOINABLE_STATUSES else None
+
+
+async def afind(key):
+    """find for async views."""
+    from .jobs import get_job_store
+    from .redis_client import get_async_redis
+    try:
+        photo_id = await get_async_redis().get(key)
+    except Exception as e:
+        logger.warning("Dedup lookup failed (%s); processing separately", e)
+        return None
+    if photo_id is None:
+        return None
+    job = await get_job_store().aget(photo_id)
+    return job if job is not None and job.status in JOINABLE_STATUSES else None
+
+
+def register(key, photo_id):
+    try:
+        _redis().set(key, photo_id, ex=FLIGHT_TTL)
+    except Exception as e:
+        logger.warning("Could not register job %s for dedup: %s", photo_id, e)
+
+
+async def aregister(key, photo_id):
+    """register for async views."""
+    from .redis_client import get_async_redis
+    try:
+        await get_async_redis().set(key, photo_id, ex=FLIGHT_TTL)
+    except Exception as e:
+        logger.warning("Could not register job %s for dedup: %s", photo_id, e)
+
+
+def attach(photo_id):
+    """Adds a subscriber beyond the original uploader."""
+    try:
+        redis = _redis()
+        redis.incr(f"flight:subscribers:{photo_id}")
+        redis.expire(f"flight:subscribers:{photo_id}", FLIGHT_TTL)
+    except Exception as e:
+        logger.warning("Could not attach to job %s: %s", photo_id, e)
+
+
+async def aattach(photo_id):
+    """attach for async views."""
+    from .redis_client import get_async_redis
+    try:
+        redis = get_async_redis()
+        await redis.incr(f"flight:subscribers:{photo_id}")
+        await redis.expire(f"flight:subscribers:{photo_id}", FLIGHT_TTL)
+    except Exception as e:
+        logger.warning("Could not attach to job %s: %s", photo_id, e)
+
+
+def release(photo_id):
+    """
+    Called when a subscriber is done with the job (fetched the result or
+    left). Returns True while other subscribers still need it.
+    """
+    try:
+        redis = _redis()
+        key = f"flight:subscribers:{photo_id}"
+        if int(redis.get(key) or 0) > 0:
+            redis.decr(key)
+            return True
+        redis.delete(key)
+    except Exception as e:
+        logger.warning("Dedup release failed for %s: %s", photo_id, e)
+    return False
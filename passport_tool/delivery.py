@@ -0,0 +1,121 @@
+"""
+Result delivery through short-lived signed URLs.
+
+check_status answers a completed job with a URL instead of the image:
+/api/result/<id>/?token=..., signed for that job and valid for
+RESULT_URL_MAX_AGE seconds. Jobs record their owner (the uploading
+session, or "api:<pk>" for an API client) and check_status and
+stream_status only answer the owner, so only the uploader (or their
+webhook) is ever handed a token: enumerating job ids gets 404s, and
+download_result needs no session, just the token.
+
+The low-res preview of a job still rendering is handed out the same way
+(`kind=preview`), so status polls and progress events carry a URL rather
+than the image.
+
+download_result serves the bytes with their real Content-Type and
+Content-Length and honours single byte ranges (resumed downloads, media
+players). The bytes are read from the job store as they are sent (see
+JobStore.open_blob); RangeFile limits a file to the requested range. Results are no longer deleted on first read:
+they stay fetchable for RESULT_RETENTION_SECONDS after completion, so a
+lost response no longer means processing the photo again.
+"""
+import io
+import re
+
+from django.core import signing
+
+from .jobs import RESULT
+
+SALT = 'passport_tool.result'
+
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def _signed_value(job_id, kind):
+    # Result tokens sign the bare id; other kinds are named in the value, so
+    # a preview token cannot fetch the result
+    return str(job_id) if kind == RESULT else f"{job_id}:{kind}"
+
+
+def sign(job_id, kind=RESULT):
+    return signing.TimestampSigner(salt=SALT).sign(_signed_value(job_id, kind))
+
+
+def verify(job_id, token, max_age, kind=RESULT):
+    try:
+        return signing.TimestampSigner(salt=SALT).unsign(token or '', max_age=max_age) == _signed_value(job_id, kind)
+    except signing.BadSignature:
+        return False
+
+
+def result_url(job_id, kind=RESULT):
+    """Signed URL of a job's result, or with kind=PREVIEW of its preview."""
+    from urllib.parse import urlencode
+    from django.urls import reverse
+    params = {'token': sign(job_id, kind)}
+    if kind != RESULT:
+        params['kind'] = kind
+    return f"{reverse('api_result', args=[job_id])}?{urlencode(params)}"
+
+
+def byte_range(header, size):
+    """
+    (start, end) inclusive for a single-range Range header, or None to send
+    everything (no header, or a form we do not handle such as multiple ranges).
+    """
+    match = RANGE_RE.fullmatch((header or '').strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        # Suffix range: the last N bytes
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+class RangeFile(io.RawIOBase):
+    """Bytes start..end (inclusive) of a seekable file, as a file of their own."""
+    def __init__(self, file, start, end):
+        self.file = file
+        self.start = start
+        self.length = end - start + 1
+        self.position = 0
+        file.seek(start)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.length}[whence]
+        self.position = max(0, base + offset)
+        self.file.seek(self.start + self.position)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        wanted = min(len(buffer), self.length - self.position)
+        if wanted <= 0:
+            return 0
+        data = self.file.read(wanted)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        self.file.close()
+        super().close()
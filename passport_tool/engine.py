@@ -3,52 +3,198 @@ import io
 from pillow_heif import register_heif_opener
 register_heif_opener()
 import os
+import logging
 import numpy as np
 import time
 from django.core.files.base import ContentFile
+from .imaging import get_backend
+
+logger = logging.getLogger(__name__)
 
 # Global session cache to prevent reloading model on every request
 SESSIONS = {}
 
+# Small, fast model used for the low-res preview pass
+PREVIEW_MODEL_NAME = "u2netp"
+
 def get_session(model_name):
-    from rembg import new_session
+    # Local rembg session or a micro-batched one, per INFERENCE_MODE
+    from .inference import get_inference_session
     if model_name not in SESSIONS:
-        SESSIONS[model_name] = new_session(model_name)
+        SESSIONS[model_name] = get_inference_session(model_name)
     return SESSIONS[model_name]
 
-def process_image(image_bytes, width_mm, height_mm, bg_color, skip_bg=False, use_original_dimensions=False, is_signature=False):
+class OutputSpec:
+    """
+    Final output geometry and byte budget for a rule.
+    Exact pixel targets (e.g. exam specs) win over millimetres; when only one
+    pixel side is pinned the other follows the mm aspect ratio.
+    """
+    def __init__(self, width_mm, height_mm, width_px=None, height_px=None, dpi=300, target_kb=None):
+        self.width_mm = width_mm
+        self.height_mm = height_mm
+        self.dpi = dpi
+        self.target_kb = target_kb
+
+        # Pixel-only rules may leave the millimetres at 0: then a single
+        # pinned side gives a square
+        has_mm = bool(width_mm and height_mm)
+        if width_px and height_px:
+            self.width_px, self.height_px = int(width_px), int(height_px)
+        elif width_px:
+            self.width_px = int(width_px)
+            self.height_px = max(1, round(self.width_px * height_mm / width_mm)) if has_mm else self.width_px
+        elif height_px:
+            self.height_px = int(height_px)
+            self.width_px = max(1, round(self.height_px * width_mm / height_mm)) if has_mm else self.height_px
+        elif has_mm:
+            self.width_px = int((width_mm / 25.4) * dpi)
+            self.height_px = int((height_mm / 25.4) * dpi)
+        else:
+            raise ValueError("Photo size needs pixel or millimetre dimensions")
+
+    @classmethod
+    def from_rule(cls, rule, dpi=300):
+        return cls(
+            rule.width_mm,
+            rule.height_mm,
+            width_px=rule.width_px,
+            height_px=rule.height_px,
+            dpi=dpi,
+            target_kb=rule.default_target_kb,
+        )
+
+    @property
+    def size(self):
+        return (self.width_px, self.height_px)
+
+    def __repr__(self):
+        return f"OutputSpec({self.width_px}x{self.height_px}px, {self.dpi}dpi, {self.target_kb}KB)"
+
+class JobCancelled(Exception):
+    """Raised between engine stages when `should_cancel()` turns true."""
+
+def _checkpoint(should_cancel):
+    if should_cancel is not None and should_cancel():
+        raise JobCancelled()
+
+# Budgeted outputs up to this size get the slower optimising PNG encoder;
+# past it the encode cost outweighs the bytes saved.
+OPTIMIZE_MAX_PIXELS = 1_000_000
+
+
+# Quality tiers. Economy is the retry for jobs that ran out of time or
+# memory (see limits.py): the photo is worked on at ECONOMY_MAX_SIDE at most,
+# masked at proxy resolution without alpha matting and without a preview.
+QUALITY_FULL = 'full'
+QUALITY_ECONOMY = 'economy'
+ECONOMY_MAX_SIDE = 2048
+
+def detect_faces(proxy_image):
+    """
+    Haar-cascade face boxes (x, y, w, h) in the proxy's coordinate space.
+    """
+    import cv2
+    gray = cv2.cvtColor(np.asarray(proxy_image), cv2.COLOR_RGBA2GRAY)
+    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    return face_cascade.detectMultiScale(gray, 1.1, 4)
+
+def render_preview(proxy_image, spec, faces, use_original_dimensions=False, backend=None):
+    """
+    Fast low-res preview: fast model on the proxy, no alpha matting.
+    `proxy_image` is consumed (its alpha is replaced), so pass a copy if it
+    is still needed afterwards. Returns PNG bytes.
+    """
+    from rembg import remove
+    mask = remove(proxy_image, session=get_session(PREVIEW_MODEL_NAME), only_mask=True)
+    if mask.mode != "L":
+        mask = mask.convert("L")
+    proxy_image.putalpha(mask)
+    preview_canvas = compose_photo(
+        proxy_image, spec, faces, proxy_image.width,
+        use_original_dimensions=use_original_dimensions,
+        backend=backend,
+    )
+    return encode_png(preview_canvas, spec, backend=backend)
+
+def process_image(image_bytes, spec, bg_color, skip_bg=False, use_original_dimensions=False, is_signature=False, output=None, on_preview=None, backend=None, should_cancel=None, on_stage=None, quality=QUALITY_FULL, on_budget_miss=None):
     """
     Processes an image: handles orientation, removes background (optional), detects face, 
     and crops/resizes with appropriate headroom and zoom levels.
+
+    `spec` is an OutputSpec; the photo is rendered directly at its final
+    pixel size so the browser never has to shrink an oversized result.
+
+    The upload is decoded once into a single RGBA buffer; the proxies used for
+    detection and matting are views of it (or downscales, never full copies).
+    If `output` is a writable binary file object the PNG is encoded straight
+    into it and `output` is returned, otherwise the PNG bytes are returned.
+
+    `on_preview(png_bytes)`, if given, is called as soon as a low-res preview
+    is ready (human background removal only), before the slow matting pass.
+
+    Decode, resampling, enhancement, compositing and encoding go through
+    `backend` (see imaging.py); the configured one is used by default.
+
+    `should_cancel()`, if given, is polled between stages; when it returns
+    true the job stops with JobCancelled.
+
+    `on_stage(name)`, if given, is called as each stage starts: 'decoding',
+    'segmenting', 'matting' (human background removal only), 'composing'
+    and 'encoding'.
+
+    `quality` is QUALITY_FULL or the cheaper QUALITY_ECONOMY.
+
+    `on_budget_miss(size_bytes, budget_bytes)`, if given, is called when the
+    result cannot be made to fit spec.target_kb (see encode_png).
     """
-    # 1. Load image and handle EXIF orientation
+    backend = backend or get_backend()
+    report = on_stage or (lambda stage: None)
+
+    # 1. Load image and handle EXIF orientation (single canonical RGBA buffer)
+    report('decoding')
     try:
-        input_image = Image.open(io.BytesIO(image_bytes))
-        input_image = ImageOps.exif_transpose(input_image)
+        input_image = backend.decode(image_bytes)
     except Exception as e:
         # Fallback for complex formats like some HEIC or corrupted files
         raise Exception(f"Failed to open image: {str(e)}")
+    _checkpoint(should_cancel)
+    economy = quality == QUALITY_ECONOMY
+    if economy and not use_original_dimensions:
+        input_image = backend.thumbnail(input_image, ECONOMY_MAX_SIDE)
     
     # Optimization: Dual Path (Fast AI + High Res Output)
     original_w, original_h = input_image.size
     proxy_size = 1024
     
     # Create Proxy (Always 1024px or smaller) - SKIP FOR SIGNATURES TO PRESERVE DETAIL
-    if not is_signature and max(original_w, original_h) > proxy_size:
-        proxy_image = input_image.copy()
-        proxy_image.thumbnail((proxy_size, proxy_size), Image.Resampling.LANCZOS)
+    if not is_signature:
+        proxy_image = backend.thumbnail(input_image, proxy_size)
     else:
-        proxy_image = input_image.copy()
+        proxy_image = input_image
 
-    # ... (rest of function)
+    # 2. Face Detection on the proxy (only needed when cropping to a frame)
+    faces = []
+    if not skip_bg:
+        report('segmenting')
+    if not (skip_bg or use_original_dimensions or is_signature):
+        faces = detect_faces(proxy_image)
+
+    # Two-phase results: publish a quick preview before the slow path
+    if on_preview is not None and not skip_bg and not is_signature and not economy:
+        _checkpoint(should_cancel)
+        preview_source = proxy_image.copy() if proxy_image is input_image else proxy_image
+        on_preview(render_preview(preview_source, spec, faces, use_original_dimensions, backend=backend))
+        del preview_source
+    _checkpoint(should_cancel)
 
     if not skip_bg:
         if is_signature:
             import cv2
             # OPENCV ADAPTIVE THRESHOLDING: Industry standard for signature processing
             # Use original high-res image logic (proxy is now original size)
-            img_array = np.array(input_image.convert("RGB"))
-            gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+            img_array = np.asarray(input_image)
+            gray = cv2.cvtColor(img_array, cv2.COLOR_RGBA2GRAY)
             
             # SOFT INK EXTRACTION: Best of both worlds (Sharpness + Natural Fade)
             
@@ -83,7 +229,7 @@ def process_image(image_bytes, width_mm, height_mm, bg_color, skip_bg=False, use
             # 3. Detect Ink Color & Auto-Enhance Vibrancy
             mask_bool = alpha_mask > 20 # Only check solid-ish parts
             if mask_bool.any():
-                ink_pixels = img_array[mask_bool]
+                ink_pixels = img_array[mask_bool][:, :3]
                 median_color = np.median(ink_pixels, axis=0).astype(np.uint8)
                 
                 # Convert to HSV to boost Saturation/Value
@@ -116,57 +262,75 @@ def process_image(image_bytes, width_mm, height_mm, bg_color, skip_bg=False, use
             
         else:
             # HUMAN PATH: High-Res Masking Pipeline
+            report('matting')
             model_name = "u2net_human"
             session = get_session(model_name)
             
             # 1. Prepare High-Res Input (Limit to 3200px to prevent OOM, but better than 1024)
             # If image is huge, downscale to a "Ultra High Quality Proxy" 
-            hq_proxy_size = 3200
-            if max(original_w, original_h) > hq_proxy_size:
-                 hq_input = input_image.copy()
-                 hq_input.thumbnail((hq_proxy_size, hq_proxy_size), Image.Resampling.LANCZOS)
-                 hq_scale_correction = True
-            else:
-                 hq_input = input_image.copy()
-                 hq_scale_correction = False
-
-            # Convert to RGBA for rembg
-            hq_input_rgba = hq_input.convert("RGBA")
-            buffer = io.BytesIO()
-            hq_input_rgba.save(buffer, format="PNG")
-            hq_input_bytes = buffer.getvalue()
+            hq_proxy_size = proxy_size if economy else 3200
+            hq_input = backend.thumbnail(input_image, hq_proxy_size)
             
             # 2. Get Mask with Alpha Matting (Slower but much better edges)
+            # rembg takes the PIL view directly, no PNG encode/decode round trip
             from rembg import remove
-            mask_bytes = remove(
-                hq_input_bytes,
+            hq_mask = remove(
+                hq_input,
                 session=session,
                 only_mask=True,
-                alpha_matting=True,
+                alpha_matting=not economy,
                 alpha_matting_foreground_threshold=240,
                 alpha_matting_background_threshold=10,
                 alpha_matting_erode_size=15 # Increased for higher resolution
             )
-            
-            hq_mask = Image.open(io.BytesIO(mask_bytes)).convert("L")
+            del hq_input
+            _checkpoint(should_cancel)
+            if hq_mask.mode != "L":
+                hq_mask = hq_mask.convert("L")
             
             # 3. Resize Mask to Original Size if we used a HQ proxy
-            if hq_scale_correction or hq_mask.size != (original_w, original_h):
-                hq_mask = hq_mask.resize((original_w, original_h), Image.Resampling.LANCZOS)
+            if hq_mask.size != (original_w, original_h):
+                hq_mask = backend.to_pil(backend.resize(hq_mask, (original_w, original_h)))
             
-            # 4. Apply to Original Image
-            pil_no_bg = input_image.convert("RGBA")
+            # 4. Apply to Original Image (in place on the canonical buffer)
+            pil_no_bg = input_image
             pil_no_bg.putalpha(hq_mask)
 
     # 4. Refine alpha mask smoothing (Humans only)
         if not is_signature:
-            r, g, b, a = pil_no_bg.split()
-            a = a.filter(ImageFilter.GaussianBlur(radius=1.0))
-            pil_no_bg = Image.merge("RGBA", (r, g, b, a))
+            backend.blur_alpha(pil_no_bg, 1.0)
     else:
-        # If skipping BG removal, use Original Image
-        pil_no_bg = input_image.convert("RGBA")
+        # If skipping BG removal, use Original Image (already RGBA)
+        pil_no_bg = input_image
 
+    # 3-8. Crop, scale, position and enhance onto the final canvas
+    _checkpoint(should_cancel)
+    report('composing')
+    result_canvas = compose_photo(
+        pil_no_bg, spec, faces, proxy_image.width,
+        skip_bg=skip_bg,
+        use_original_dimensions=use_original_dimensions,
+        is_signature=is_signature,
+        backend=backend,
+    )
+
+    # 9. Encode transparent PNG straight into the destination. The KB budget
+    # is for the rule's size; a photo kept at its own dimensions (skip_bg,
+    # use_original_dimensions) is not held to it
+    _checkpoint(should_cancel)
+    report('encoding')
+    target_kb = spec.target_kb if (result_canvas.width, result_canvas.height) == spec.size else None
+    return encode_png(result_canvas, spec, output, backend=backend, target_kb=target_kb, on_budget_miss=on_budget_miss)
+
+def compose_photo(pil_no_bg, spec, faces, proxy_width, skip_bg=False, use_original_dimensions=False, is_signature=False, backend=None):
+    """
+    Crops, scales and positions a background-free subject onto the final
+    transparent canvas. `faces` are boxes detected on a proxy `proxy_width`
+    pixels wide; they are rescaled to `pil_no_bg`, so the same geometry serves
+    both the low-res preview and the full-resolution result.
+    Returns a backend image; pass it to encode_png.
+    """
+    backend = backend or get_backend()
     # 3. Determine Target Dimensions
     # Calculate bbox based on ACTUAL INK for signatures with extra padding
     bbox = pil_no_bg.getbbox()
@@ -199,26 +363,13 @@ def process_image(image_bytes, width_mm, height_mm, bg_color, skip_bg=False, use
         scaled_no_bg = pil_no_bg
         
     else:
-        # Create target dimensions at 300 DPI
-        dpi = 300
-        width_px = int((width_mm / 25.4) * dpi)
-        height_px = int((height_mm / 25.4) * dpi)
+        # Target dimensions come straight from the output spec
+        width_px, height_px = spec.size
         
-        # 5. Face Detection (using RGB version)
-        # Only perform face detection if NOT a signature
-        faces = []
-        if not is_signature:
-            import cv2
-            # Detect on Proxy for Speed
-            cv_img = cv2.cvtColor(np.array(proxy_image.convert("RGB")), cv2.COLOR_RGB2BGR)
-            gray = cv2.cvtColor(cv_img, cv2.COLOR_BGR2GRAY)
-            face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-            faces = face_cascade.detectMultiScale(gray, 1.1, 4)
-            
-            # Map faces back to High-Res Coordinate Space if needed
-            det_scale = pil_no_bg.width / proxy_image.width
-            if det_scale != 1.0:
-                 faces = [ (int(x*det_scale), int(y*det_scale), int(w*det_scale), int(h*det_scale)) for (x,y,w,h) in faces ]
+        # 5. Faces were detected on the proxy; map them to this image's space
+        det_scale = pil_no_bg.width / proxy_width
+        if det_scale != 1.0:
+             faces = [ (int(x*det_scale), int(y*det_scale), int(w*det_scale), int(h*det_scale)) for (x,y,w,h) in faces ]
         
         # 6. Smart Cover Scaling Strategy
         if len(faces) > 0:
@@ -250,8 +401,7 @@ def process_image(image_bytes, width_mm, height_mm, bg_color, skip_bg=False, use
         new_h = int(pil_no_bg.height * scale_factor)
 
         # Use LANCZOS for everything now (Signature needs sharpness)
-        resampling_method = Image.Resampling.LANCZOS
-        scaled_no_bg = pil_no_bg.resize((new_w, new_h), resampling_method)
+        scaled_no_bg = backend.resize(pil_no_bg, (new_w, new_h))
         
         # 7. Calculate Positioning
         target_top_margin = height_px * 0.15
@@ -273,27 +423,62 @@ def process_image(image_bytes, width_mm, height_mm, bg_color, skip_bg=False, use
     
     # 8. Create Transparent Result (PNG)
     # The background color is now handled by the client-side canvas
-    result_canvas = Image.new("RGBA", (width_px, height_px), (0, 0, 0, 0))
-    
-    # AI Enhancement (Common)
-    enhancer_br = ImageEnhance.Brightness(scaled_no_bg)
-    scaled_no_bg = enhancer_br.enhance(1.05)
     
+    # AI Enhancement (Common: brightness 1.05)
     if is_signature:
-        # Final auto-enhancement for professional signature quality
-        enhancer_ct = ImageEnhance.Contrast(scaled_no_bg)
-        scaled_no_bg = enhancer_ct.enhance(1.4)  # Balanced contrast
-        enhancer_sh = ImageEnhance.Sharpness(scaled_no_bg)
-        scaled_no_bg = enhancer_sh.enhance(1.3)  # Clear edges
-    elif not is_signature:
+        # Final auto-enhancement for professional signature quality:
+        # balanced contrast and clear edges
+        scaled_no_bg = backend.enhance(scaled_no_bg, brightness=1.05, contrast=1.4, sharpness=1.3)
+    else:
         # Standard Human Enhancement
-        enhancer_ct = ImageEnhance.Contrast(scaled_no_bg)
-        scaled_no_bg = enhancer_ct.enhance(1.10)
+        scaled_no_bg = backend.enhance(scaled_no_bg, brightness=1.05, contrast=1.10)
     
-    result_canvas.paste(scaled_no_bg, (paste_x, paste_y), scaled_no_bg)
+    return backend.composite(scaled_no_bg, (width_px, height_px), (paste_x, paste_y))
 
-    # 9. Return transparent PNG bytes
+def encode_png(result_canvas, spec, output=None, backend=None, target_kb=None, on_budget_miss=None):
+    """
+    Encodes the transparent result with spec.dpi as its resolution. Writes
+    straight into `output` when given (and returns it), otherwise returns
+    the PNG bytes.
+
+    With `target_kb` the PNG should fit in that many KB. The pixel size is
+    part of the rule, so only lossless savings are tried (see fit_png); if
+    the smallest encoding is still too big it is kept anyway and
+    `on_budget_miss(size_bytes, budget_bytes)` is called. Those attempts are
+    encoded in memory, which is cheap at a rule's pixel size, and only the
+    one kept is written to `output`.
+    """
+    backend = backend or get_backend()
+    if not target_kb:
+        return backend.encode(result_canvas, output=output, dpi=spec.dpi)
+    optimize = (result_canvas.width * result_canvas.height) <= OPTIMIZE_MAX_PIXELS
+    data = backend.encode(result_canvas, optimize=optimize, dpi=spec.dpi)
+    budget = target_kb * 1024
+    if len(data) > budget:
+        data = min(data, fit_png(backend.to_pil(result_canvas), spec.dpi), key=len)
+        if len(data) > budget:
+            logger.warning("Result is %d KB, over its %d KB budget", len(data) // 1024, target_kb)
+            if on_budget_miss is not None:
+                on_budget_miss(len(data), budget)
+    if output is not None:
+        output.write(data)
+        return output
+    return data
+
+def _encode_png(image, dpi):
     buffer = io.BytesIO()
-    result_canvas.save(buffer, format="PNG")
+    image.save(buffer, format="PNG", optimize=True, compress_level=9, dpi=(dpi, dpi))
     return buffer.getvalue()
 
+def fit_png(image, dpi):
+    """
+    Smallest lossless PNG of PIL RGBA `image` at its own size: maximum
+    compression, without the alpha channel when it is fully opaque, and as
+    an exact palette when the image has at most 256 colours.
+    """
+    if image.getextrema()[3][0] == 255:
+        image = image.convert('RGB')
+    if image.getcolors(256) is not None:
+        # Fewer than 257 colours: the palette holds every one of them
+        image = image.quantize(256, method=Image.Quantize.FASTOCTREE if image.mode == 'RGBA' else Image.Quantize.MEDIANCUT)
+    return _encode_png(image, dpi)
@@ -0,0 +1,151 @@
+"""
+Per-job progress events.
+
+Workers publish each stage a job passes through (queued, processing,
+decoding, segmenting, matting, composing, encoding, preview, retrying,
+done, failed, cancelled) on the Redis channel job:<id>:events. The same event is also
+stored as job:<id>:event, so a subscriber that connects late, or reconnects,
+starts from the current stage instead of waiting for the next one.
+stream_status relays them to the browser as server-sent events, replacing
+the status polling loop; listeners share one subscription per process
+(EventHub).
+
+Publishing never fails a job: without Redis the page falls back to polling.
+"""
+import asyncio
+import json
+import logging
+import time
+import weakref
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STAGES = ('done', 'failed', 'cancelled')
+
+
+def channel(job_id):
+    return f"job:{job_id}:events"
+
+
+def _last_key(job_id):
+    return f"job:{job_id}:event"
+
+
+def publish(job_id, stage, **data):
+    from django.conf import settings
+    from .redis_client import get_redis
+    event = json.dumps({'stage': stage, 'at': time.time(), **data})
+    try:
+        redis = get_redis()
+        redis.set(_last_key(job_id), event, ex=settings.JOB_TTL_SECONDS)
+        redis.publish(channel(job_id), event)
+    except Exception as e:
+        logger.warning("Could not publish %s for job %s: %s", stage, job_id, e)
+
+
+async def apublish(job_id, stage, **data):
+    """publish for async views."""
+    from django.conf import settings
+    from .redis_client import get_async_redis
+    event = json.dumps({'stage': stage, 'at': time.time(), **data})
+    try:
+        redis = get_async_redis()
+        await redis.set(_last_key(job_id), event, ex=settings.JOB_TTL_SECONDS)
+        await redis.publish(channel(job_id), event)
+    except Exception as e:
+        logger.warning("Could not publish %s for job %s: %s", stage, job_id, e)
+
+
+async def last_event(job_id):
+    from .redis_client import get_async_redis
+    raw = await get_async_redis().get(_last_key(job_id))
+    return json.loads(raw) if raw else None
+
+
+class EventHub:
+    """
+    One pub/sub connection per event loop, shared by every stream of the
+    process: channels are subscribed while someone listens and messages
+    are fanned out to the listeners' queues. Thousands of waiting clients
+    cost a queue each, not a Redis connection each.
+    """
+
+    def __init__(self, redis):
+        self.pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        # channel -> set of listener queues
+        self.inboxes = {}
+        self.lock = asyncio.Lock()
+        self.reader = None
+
+    async def subscribe(self, name):
+        inbox = asyncio.Queue()
+        async with self.lock:
+            if name not in self.inboxes:
+                self.inboxes[name] = set()
+                await self.pubsub.subscribe(name)
+            self.inboxes[name].add(inbox)
+            if self.reader is None or self.reader.done():
+                self.reader = asyncio.create_task(self._read())
+        return inbox
+
+    async def unsubscribe(self, name, inbox):
+        async with self.lock:
+            inboxes = self.inboxes.get(name)
+            if inboxes is None:
+                return
+            inboxes.discard(inbox)
+            if not inboxes:
+                del self.inboxes[name]
+                await self.pubsub.unsubscribe(name)
+
+    async def _read(self):
+        while self.inboxes:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except Exception as e:
+                logger.warning("Event hub read failed: %s", e)
+                await asyncio.sleep(1)
+                continue
+            if message and message.get('type') == 'message':
+                for inbox in self.inboxes.get(message['channel'], ()):
+                    inbox.put_nowait(message['data'])
+
+
+_hubs = weakref.WeakKeyDictionary()
+
+def _hub():
+    from .redis_client import get_async_redis
+    loop = asyncio.get_running_loop()
+    if loop not in _hubs:
+        _hubs[loop] = EventHub(get_async_redis())
+    return _hubs[loop]
+
+
+async def listen(job_id, timeout, keepalive=15):
+    """
+    Yields the job's events for up to `timeout` seconds, starting with the
+    current one, and None every `keepalive` seconds without one. Stops after
+    a terminal stage.
+    """
+    hub = _hub()
+    # Subscribe before reading the current stage so nothing falls in between
+    inbox = await hub.subscribe(channel(job_id))
+    try:
+        event = await last_event(job_id)
+        if event:
+            yield event
+            if event['stage'] in TERMINAL_STAGES:
+                return
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                raw = await asyncio.wait_for(inbox.get(), timeout=min(keepalive, remaining))
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            event = json.loads(raw)
+            yield event
+            if event['stage'] in TERMINAL_STAGES:
+                return
+    finally:
+        await hub.unsubscribe(channel(job_id), inbox)
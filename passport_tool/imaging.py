@@ -0,0 +1,331 @@
+"""
+Imaging backends for the photo engine.
+
+The engine routes decode, thumbnail, resize, enhance, composite and encode
+through one of these. Decoded frames and proxies are always PIL RGBA images
+(rembg, OpenCV and the alpha steps need them); everything after the final
+resize stays in the backend's own image type until `encode`, so the vips
+backend can run that tail as a single demand-driven pipeline.
+
+Select the backend with the IMAGING_BACKEND setting ("pillow" or "vips").
+The vips backend needs pyvips (requirements.txt installs pyvips[binary],
+which bundles libvips); without it get_backend raises ImproperlyConfigured,
+and `manage.py check` reports it.
+"""
+import io
+import logging
+
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+
+from . import tiling
+
+logger = logging.getLogger(__name__)
+
+
+class ImagingBackend:
+    name = None
+
+    def decode(self, source):
+        """Bytes or binary file -> upright PIL RGBA image."""
+        raise NotImplementedError
+
+    def thumbnail(self, image, max_side):
+        """PIL image -> PIL image fitting in max_side (same object if it already fits)."""
+        raise NotImplementedError
+
+    def resize(self, image, size):
+        """LANCZOS resize to exactly `size`."""
+        raise NotImplementedError
+
+    def enhance(self, image, brightness=1.0, contrast=1.0, sharpness=1.0):
+        """ImageEnhance-equivalent brightness, contrast and sharpness, in that order."""
+        raise NotImplementedError
+
+    def composite(self, image, canvas_size, position):
+        """Pastes RGBA `image` (masked by its own alpha) onto a transparent canvas."""
+        raise NotImplementedError
+
+    def encode(self, image, output=None, optimize=False, dpi=None):
+        """
+        PNG-encodes into `output` (returned) or returns the bytes; `dpi`
+        is written as the pHYs resolution.
+        """
+        raise NotImplementedError
+
+    def to_pil(self, image):
+        raise NotImplementedError
+
+    def blur_alpha(self, image, radius):
+        """Gaussian-blurs the alpha channel of PIL RGBA `image` in place."""
+        image.putalpha(image.getchannel("A").filter(ImageFilter.GaussianBlur(radius=radius)))
+        return image
+
+
+class PillowBackend(ImagingBackend):
+    """
+    Pillow backend. With workers > 1, large resizes, the alpha blur and the
+    enhancement chain are split into tiles on a thread pool (see tiling.py);
+    results are bit-identical to the serial path.
+    """
+    name = "pillow"
+
+    def __init__(self, workers=1):
+        self.workers = max(1, workers)
+
+    def decode(self, source):
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        image = Image.open(source)
+        # In place: no extra frame when the photo is already upright
+        ImageOps.exif_transpose(image, in_place=True)
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        else:
+            image.load()
+        return image
+
+    def thumbnail(self, image, max_side):
+        width, height = image.size
+        if max(width, height) <= max_side:
+            return image
+        scale = max_side / max(width, height)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        return image.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+    def resize(self, image, size):
+        if tiling.should_tile(self.workers, image.size, size):
+            return tiling.resize(image, size, self.workers)
+        return image.resize(size, Image.Resampling.LANCZOS)
+
+    def blur_alpha(self, image, radius):
+        if not tiling.should_tile(self.workers, image.size):
+            return super().blur_alpha(image, radius)
+        image.putalpha(tiling.gaussian_blur(image.getchannel("A"), radius, self.workers))
+        return image
+
+    def enhance(self, image, brightness=1.0, contrast=1.0, sharpness=1.0):
+        if image.mode not in tiling.TABLE_MODES:
+            if brightness != 1.0:
+                image = ImageEnhance.Brightness(image).enhance(brightness)
+            if contrast != 1.0:
+                image = ImageEnhance.Contrast(image).enhance(contrast)
+        elif tiling.should_tile(self.workers, image.size):
+            return tiling.enhance(image, brightness, contrast, sharpness, self.workers)
+        else:
+            # ImageEnhance's results from one point() table per step, without
+            # its full-size degenerate images and blends
+            if brightness != 1.0:
+                image = tiling.point_colour(image, tiling.blend_table(0, brightness))
+            if contrast != 1.0:
+                image = tiling.point_colour(image, tiling.blend_table(tiling.contrast_mean(image), contrast))
+        if sharpness != 1.0:
+            image = ImageEnhance.Sharpness(image).enhance(sharpness)
+        return image
+
+    def composite(self, image, canvas_size, position):
+        canvas = Image.new("RGBA", canvas_size, (0, 0, 0, 0))
+        canvas.paste(image, position, image)
+        return canvas
+
+    def encode(self, image, output=None, optimize=False, dpi=None):
+        params = {"dpi": (dpi, dpi)} if dpi else {}
+        if output is not None:
+            image.save(output, format="PNG", optimize=optimize, **params)
+            return output
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG", optimize=optimize, **params)
+        return buffer.getvalue()
+
+    def to_pil(self, image):
+        return image
+
+
+class VipsBackend(ImagingBackend):
+    """
+    libvips backend. Operations after the final resize are lazy; nothing is
+    computed until `encode` streams the PNG out, region by region.
+    Arithmetic mirrors Pillow (truncating blends, rounding paste, 8-bit
+    premultiplied LANCZOS in the same pass order) so results match the
+    Pillow backend to within PARITY_LEVELS per premultiplied band (see
+    tests/test_imaging.py). Enlarging is left to Pillow.
+    """
+    name = "vips"
+
+    # Largest difference from PillowBackend, in levels of a premultiplied band
+    PARITY_LEVELS = 3
+
+    # ImageFilter.SMOOTH, the degenerate image used by ImageEnhance.Sharpness
+    SMOOTH_KERNEL = [[1, 1, 1], [1, 5, 1], [1, 1, 1]]
+
+    def __init__(self):
+        import pyvips
+        self.pyvips = pyvips
+        self.smooth = pyvips.Image.new_from_array(self.SMOOTH_KERNEL, scale=13)
+
+    def _to_vips(self, image):
+        if isinstance(image, self.pyvips.Image):
+            return image
+        bands = len(image.getbands())
+        vimage = self.pyvips.Image.new_from_memory(image.tobytes(), image.width, image.height, bands, "uchar")
+        return vimage.copy(interpretation="srgb" if bands >= 3 else "b-w")
+
+    @staticmethod
+    def _truncate(vimage):
+        # Pillow's blend truncates float results; the epsilon absorbs float error
+        return (vimage + 1e-3).cast("uchar")
+
+    def to_pil(self, image):
+        if isinstance(image, Image.Image):
+            return image
+        if image.format != "uchar":
+            image = image.cast("uchar")
+        mode = {1: "L", 3: "RGB", 4: "RGBA"}[image.bands]
+        return Image.frombytes(mode, (image.width, image.height), image.write_to_memory())
+
+    def decode(self, source):
+        data = source if isinstance(source, (bytes, bytearray)) else (
+            bytes(source) if isinstance(source, memoryview) else source.read()
+        )
+        try:
+            vimage = self.pyvips.Image.new_from_buffer(data, "").autorot()
+        except self.pyvips.Error:
+            # Formats this libvips build lacks (e.g. HEIC without libheif)
+            return PillowBackend().decode(data)
+        if vimage.interpretation != "srgb" or vimage.format != "uchar":
+            vimage = vimage.colourspace("srgb")
+        if vimage.bands == 3:
+            vimage = vimage.bandjoin(255)
+        elif vimage.bands > 4:
+            vimage = vimage.extract_band(0, n=4)
+        return self.to_pil(vimage)
+
+    def thumbnail(self, image, max_side):
+        if max(image.size) <= max_side:
+            return image
+        return self.to_pil(self._to_vips(image).thumbnail_image(max_side, height=max_side))
+
+    def resize(self, image, size):
+        vimage = self._to_vips(image)
+        if (vimage.width, vimage.height) == tuple(size):
+            return vimage
+        hshrink, vshrink = vimage.width / size[0], vimage.height / size[1]
+        if hshrink < 1 or vshrink < 1:
+            # libvips enlarges by interpolation rather than a Lanczos
+            # convolution, which would not match Pillow; enlarged results
+            # are small, so Pillow does them
+            return PillowBackend().resize(self.to_pil(vimage), size)
+        has_alpha = vimage.bands == 4
+        if has_alpha:
+            # Pillow resizes RGBA as 8-bit premultiplied RGBa
+            vimage = (vimage.premultiply() + 0.5).cast("uchar")
+        # Horizontal pass first, rounded to 8 bits in between, like Pillow
+        vimage = vimage.reduceh(hshrink, kernel="lanczos3").reducev(vshrink, kernel="lanczos3")
+        if has_alpha:
+            vimage = self._unpremultiply(vimage)
+        if (vimage.width, vimage.height) != tuple(size):
+            # Guard against off-by-one output sizes from vips' rounding
+            vimage = vimage.crop(0, 0, min(vimage.width, size[0]), min(vimage.height, size[1]))
+            vimage = vimage.embed(0, 0, size[0], size[1], extend="copy")
+        return vimage
+
+    @staticmethod
+    def _unpremultiply(vimage):
+        # Pillow's RGBa -> RGBA: truncating division, pixels with alpha 0
+        # or 255 copied as they are
+        alpha = vimage[3]
+        rgb = vimage.extract_band(0, n=3)
+        divided = (rgb * 255 / (alpha == 0).ifthenelse(1, alpha)).cast("uchar")
+        return ((alpha == 0) | (alpha == 255)).ifthenelse(rgb, divided).bandjoin(alpha)
+
+    def enhance(self, image, brightness=1.0, contrast=1.0, sharpness=1.0):
+        vimage = self._to_vips(image)
+        alpha = vimage[3] if vimage.bands == 4 else None
+        rgb = vimage.extract_band(0, n=3) if alpha is not None else vimage
+
+        if brightness != 1.0:
+            rgb = self._truncate(rgb * brightness)
+        if contrast != 1.0:
+            # Same grey mean as ImageEnhance.Contrast (ITU-R 601-2 luma over all pixels)
+            luma = rgb.recomb([[0.299, 0.587, 0.114]])
+            mean = int(luma.avg() + 0.5)
+            rgb = self._truncate((rgb - mean) * contrast + mean)
+        if sharpness != 1.0:
+            smooth = rgb.conv(self.smooth, precision="integer")
+            rgb = self._truncate(smooth + (rgb - smooth) * sharpness)
+
+        return rgb.bandjoin(alpha) if alpha is not None else rgb
+
+    def composite(self, image, canvas_size, position):
+        vimage = self._to_vips(image)
+        # Image.paste(im, box, mask=im) onto transparent black: every band,
+        # alpha included, is scaled by alpha/255 with rounding
+        pasted = (vimage * vimage[3] / 255 + 0.5).cast("uchar")
+        return pasted.embed(
+            position[0], position[1], canvas_size[0], canvas_size[1],
+            extend="background", background=[0, 0, 0, 0],
+        )
+
+    def encode(self, image, output=None, optimize=False, dpi=None):
+        vimage = self._to_vips(image)
+        if vimage.interpretation != "srgb":
+            vimage = vimage.copy(interpretation="srgb")
+        if dpi:
+            # libvips resolution is in pixels per millimetre
+            vimage = vimage.copy(xres=dpi / 25.4, yres=dpi / 25.4)
+        compression = 9 if optimize else 6
+        if output is not None:
+            # Stream the PNG straight into the destination as it is computed
+            target = self.pyvips.TargetCustom()
+            target.on_write(output.write)
+            vimage.write_to_target(target, ".png", compression=compression)
+            return output
+        return vimage.pngsave_buffer(compression=compression)
+
+
+BACKENDS = {
+    "pillow": PillowBackend,
+    "vips": VipsBackend,
+}
+
+# One instance per backend name for the life of the process
+_instances = {}
+
+def engine_threads():
+    """ENGINE_THREADS setting, or the container's CPU quota when it is 0/unset."""
+    from django.conf import settings
+    return getattr(settings, 'ENGINE_THREADS', 0) or tiling.cpu_quota()
+
+def get_backend(name=None):
+    """
+    Returns the named imaging backend, by default settings.IMAGING_BACKEND.
+    Raises ImproperlyConfigured when it is unknown or cannot be loaded (e.g.
+    vips without libvips): a worker silently running another backend would
+    produce different output than the one configured.
+    """
+    from django.core.exceptions import ImproperlyConfigured
+    if name is None:
+        from django.conf import settings
+        name = getattr(settings, 'IMAGING_BACKEND', 'pillow')
+    if name not in _instances:
+        if name not in BACKENDS:
+            raise ImproperlyConfigured(f"Unknown imaging backend {name!r}; choose from {', '.join(BACKENDS)}")
+        try:
+            if name == "pillow":
+                _instances[name] = PillowBackend(workers=engine_threads())
+            else:
+                _instances[name] = BACKENDS[name]()
+        except (ImportError, OSError) as e:
+            logger.error("Imaging backend %r unavailable: %s", name, e)
+            raise ImproperlyConfigured(f"Imaging backend {name!r} is unavailable: {e}") from e
+    return _instances[name]
+
+
+def check_backend(app_configs=None, **kwargs):
+    """System check: the configured IMAGING_BACKEND loads."""
+    from django.core import checks
+    from django.core.exceptions import ImproperlyConfigured
+    try:
+        get_backend()
+    except ImproperlyConfigured as e:
+        return [checks.Error(str(e), hint="Install pyvips and libvips or set IMAGING_BACKEND=pillow.", id='passport_tool.E001')]
+    return []
@@ -0,0 +1,266 @@
+"""
+Cross-job micro-batching for segmentation inference.
+
+INFERENCE_MODE decides how engine.get_session() runs the u2net-family models:
+
+- "local"  (default) every worker process owns its rembg session and runs
+           one image per ONNX call.
+- "thread" a batcher thread inside the worker collects requests from
+           concurrent jobs (threaded pools) for INFERENCE_BATCH_WINDOW_MS,
+           stacks them and runs ONNX once for the whole batch.
+- "socket" the same batcher runs in `manage.py run_inference_server`, one per
+           node, on the Unix socket INFERENCE_SOCKET. Only a small JSON header
+           crosses the socket; input tensors and masks go through shared
+           memory. One model copy per node instead of one per process.
+           docker-compose.yml runs it next to the segmentation worker;
+           koyeb.yaml stays "local" (one child per instance, nothing to batch).
+
+Batched sessions are drop-in replacements for rembg sessions: `remove()` calls
+their `predict()`, which normalises and post-processes exactly like rembg's
+U2net sessions and only hands the 320x320 tensor to the batcher.
+"""
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# rembg's U2net-style sessions share this pre/post-processing
+INPUT_SIZE = (320, 320)
+MEAN = (0.485, 0.456, 0.406)
+STD = (0.229, 0.224, 0.225)
+TENSOR_SHAPE = (3,) + INPUT_SIZE
+TENSOR_BYTES = int(np.prod(TENSOR_SHAPE)) * 4
+BATCHABLE_SESSIONS = {"U2netSession", "U2netpSession", "U2netHumanSegSession", "SiluetaSession"}
+
+
+def is_batchable(model_name):
+    """True if rembg maps `model_name` to a U2net-style session."""
+    from rembg.sessions import sessions_class
+    for session_class in sessions_class:
+        if session_class.name() == model_name:
+            return session_class.__name__ in BATCHABLE_SESSIONS
+    # rembg falls back to U2netSession for unknown names
+    return True
+
+
+def normalize(img):
+    """rembg BaseSession.normalize for a single image, without the batch axis."""
+    im = img.convert("RGB").resize(INPUT_SIZE, Image.Resampling.LANCZOS)
+    im_ary = np.array(im)
+    im_ary = im_ary / np.max(im_ary)
+    tensor = np.zeros((im_ary.shape[0], im_ary.shape[1], 3))
+    for channel in range(3):
+        tensor[:, :, channel] = (im_ary[:, :, channel] - MEAN[channel]) / STD[channel]
+    return tensor.transpose((2, 0, 1)).astype(np.float32)
+
+
+def to_mask(pred, size):
+    """rembg U2netSession.predict post-processing for one (320, 320) prediction."""
+    ma = np.max(pred)
+    mi = np.min(pred)
+    pred = (pred - mi) / (ma - mi)
+    mask = Image.fromarray((pred * 255).astype("uint8"), mode="L")
+    return mask.resize(size, Image.Resampling.LANCZOS)
+
+
+class Batcher:
+    """
+    Collects single-image requests for up to `window_ms`, runs them as one
+    ONNX batch and hands each caller its own prediction. Models exported with
+    a fixed batch size of 1 are run back to back instead, still sharing the
+    one session.
+    """
+    def __init__(self, session, window_ms=5, max_batch=8):
+        self.session = session
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        model_input = session.inner_session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.batchable = not isinstance(model_input.shape[0], int) or model_input.shape[0] != 1
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.batched_requests = 0
+        threading.Thread(target=self._loop, name=f"inference-batcher-{session.model_name}", daemon=True).start()
+
+    def submit(self, tensor):
+        """Blocks until the (320, 320) float32 prediction for `tensor` is ready."""
+        request = {"tensor": tensor, "done": threading.Event()}
+        self.requests.put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["pred"]
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, tensors):
+        outputs = self.session.inner_session.run(None, {self.input_name: tensors})
+        return outputs[0][:, 0, :, :]
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            try:
+                if self.batchable:
+                    preds = self._run(np.stack([request["tensor"] for request in batch]))
+                else:
+                    preds = [self._run(request["tensor"][np.newaxis])[0] for request in batch]
+                for request, pred in zip(batch, preds):
+                    request["pred"] = pred
+                self.batches += 1
+                self.batched_requests += len(batch)
+            except Exception as e:
+                for request in batch:
+                    request["error"] = e
+            finally:
+                for request in batch:
+                    request["done"].set()
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+def get_batcher(model_name):
+    """One rembg session and batcher per model for the life of the process."""
+    with _batchers_lock:
+        if model_name not in _batchers:
+            from django.conf import settings
+            from rembg import new_session
+            _batchers[model_name] = Batcher(
+                new_session(model_name),
+                window_ms=settings.INFERENCE_BATCH_WINDOW_MS,
+                max_batch=settings.INFERENCE_MAX_BATCH,
+            )
+        return _batchers[model_name]
+
+
+class BatchedSession:
+    """rembg-compatible session whose ONNX run goes through a batcher."""
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    def infer(self, tensor):
+        return get_batcher(self.model_name).submit(tensor)
+
+    def predict(self, img, *args, **kwargs):
+        return [to_mask(self.infer(normalize(img)), img.size)]
+
+
+def _attach(name):
+    # The server only borrows the client's segment; keep Python's resource
+    # tracker from unlinking it when the server exits
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class SocketSession(BatchedSession):
+    """
+    Sends tensors to the node's inference server through shared memory.
+    Falls back to a process-local rembg session if the server is unreachable.
+    """
+    def __init__(self, model_name, path, timeout=60):
+        super().__init__(model_name)
+        self.path = path
+        self.timeout = timeout
+        self.local_session = None
+
+    def infer(self, tensor):
+        shm = shared_memory.SharedMemory(create=True, size=TENSOR_BYTES)
+        try:
+            np.ndarray(TENSOR_SHAPE, dtype=np.float32, buffer=shm.buf)[:] = tensor
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(self.path)
+                sock.sendall(json.dumps({"model": self.model_name, "shm": shm.name}).encode() + b"\n")
+                reply = json.loads(sock.makefile("rb").readline() or b"{}")
+            if not reply.get("ok"):
+                raise RuntimeError(f"Inference server error: {reply.get('error', 'no reply')}")
+            return np.ndarray(INPUT_SIZE, dtype=np.float32, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def predict(self, img, *args, **kwargs):
+        try:
+            return super().predict(img, *args, **kwargs)
+        except (OSError, socket.timeout) as e:
+            logger.warning("Inference server at %s unavailable (%s); running %s locally", self.path, e, self.model_name)
+            if self.local_session is None:
+                from rembg import new_session
+                self.local_session = new_session(self.model_name)
+            return self.local_session.predict(img, *args, **kwargs)
+
+
+def get_inference_session(model_name):
+    """Session for engine.get_session() according to INFERENCE_MODE."""
+    from django.conf import settings
+    from rembg import new_session
+
+    mode = getattr(settings, 'INFERENCE_MODE', 'local')
+    if mode == 'local' or not is_batchable(model_name):
+        return new_session(model_name)
+    if mode == 'thread':
+        return BatchedSession(model_name)
+    if mode == 'socket':
+        return SocketSession(model_name, settings.INFERENCE_SOCKET)
+    raise ValueError(f"Unknown INFERENCE_MODE {mode!r}")
+
+
+class InferenceRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                shm = _attach(request["shm"])
+                try:
+                    tensor = np.ndarray(TENSOR_SHAPE, dtype=np.float32, buffer=shm.buf).copy()
+                    pred = get_batcher(request["model"]).submit(tensor)
+                    np.ndarray(INPUT_SIZE, dtype=np.float32, buffer=shm.buf)[:] = pred
+                finally:
+                    shm.close()
+                reply = {"ok": True}
+            except Exception as e:
+                logger.exception("Inference request failed")
+                reply = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path, preload=()):
+    """Runs the node-local inference server on `path` until interrupted."""
+    for model_name in preload:
+        get_batcher(model_name)
+    if os.path.exists(path):
+        os.unlink(path)
+    with InferenceServer(path, InferenceRequestHandler) as server:
+        os.chmod(path, 0o660)
+        server.serve_forever()
@@ -0,0 +1,519 @@
+"""
+Job store: status, small metadata and image blobs (original, preview,
+result) of processing jobs.
+
+- DatabaseJobStore keeps them in ProcessedPhoto rows and MEDIA_ROOT files,
+  which cleanup_old_photos removes after an hour.
+- RedisJobStore keeps them in Redis (redis_client.py) under keys that
+  expire on their own after JOB_TTL_SECONDS. A status poll is a single
+  HGETALL, and nothing touches Postgres or the media disk.
+
+settings.JOB_STORE picks the backend. Views and tasks only go through the
+store, so ProcessedPhoto is only needed by the database backend.
+
+In both, originals travel through the payload transport (payloads.py)
+rather than either backend's own storage: they never touch MEDIA_ROOT, and
+web and worker nodes need not share a disk.
+
+aget, aread_blob, acreate and aupdate serve the async views (upload,
+status, stream): the Redis store uses redis.asyncio, the database store the
+async ORM.
+
+blob_writer hands the engine a file to encode a preview or result into, so
+the finished image is written out as it is produced instead of being built
+up in memory first.
+"""
+import io
+import mimetypes
+import time
+from contextlib import contextmanager
+
+from .redis_client import local_script
+
+ORIGINAL = 'original'
+PREVIEW = 'preview'
+RESULT = 'result'
+
+# Statuses of jobs that have not finished yet
+ACTIVE_STATUSES = ('pending', 'processing', 'preview')
+
+# KEYS job hash; ARGV field, value, ... Updates the job only if it still
+# exists: HSET on an expired job would recreate it without a TTL.
+UPDATE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV))
+return 1
+"""
+
+
+@local_script(UPDATE_LUA)
+def _local_update(redis, keys, args):
+    if not redis.exists(keys[0]):
+        return 0
+    redis.hset(keys[0], mapping=dict(zip(args[::2], args[1::2])))
+    return 1
+
+
+class Job:
+    def __init__(self, id, rule_id, name, status='pending', error_message=None,
+                 task_id=None, created_at=None, result_format=None, owner='', record=None):
+        self.id = id
+        self.rule_id = rule_id
+        # Upload file name
+        self.name = name
+        self.status = status
+        self.error_message = error_message
+        self.task_id = task_id
+        # Epoch seconds
+        self.created_at = created_at if created_at is not None else time.time()
+        self.result_format = result_format
+        # Session key of the uploading browser, or "api:<ApiClient pk>"
+        self.owner = owner
+        # Backing ProcessedPhoto for the database store
+        self.record = record
+        self._rule = None
+
+    @property
+    def rule(self):
+        if self._rule is None:
+            from .models import CountryRule
+            self._rule = CountryRule.objects.get(id=self.rule_id)
+        return self._rule
+
+    @property
+    def result_mime(self):
+        return result_mime(self.result_format)
+
+
+def result_mime(result_format):
+    return mimetypes.guess_type(f"result.{result_format or 'png'}")[0] or 'image/png'
+
+
+class JobStore:
+    """
+    Blob access shared by the backends: originals go through the payload
+    transport, previews and results to the backend's _put/_read/_delete.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    @staticmethod
+    def _payload_key(job):
+        return f"job:{job.id}:{ORIGINAL}"
+
+    def _store_original(self, job, upload):
+        from .payloads import get_transport
+        upload.seek(0)
+        # Streamed chunk by chunk from the upload's memory or temporary file
+        get_transport().put(self._payload_key(job), upload.chunks(), self.ttl)
+
+    async def _astore_original(self, job, upload):
+        from asgiref.sync import sync_to_async
+        # Transports write (to Redis or the payload disk) blocking, chunk by
+        # chunk from the upload's file: the one step left in a thread
+        await sync_to_async(self._store_original, thread_sensitive=False)(job, upload)
+
+    def put_blob(self, job, kind, data, fmt='png'):
+        if kind == ORIGINAL:
+            from .payloads import get_transport
+            get_transport().put(self._payload_key(job), data, self.ttl)
+        else:
+            self._put(job, kind, data, fmt)
+
+    @contextmanager
+    def blob_writer(self, job, kind, fmt='png'):
+        """
+        Writable file for a preview or result; the blob is stored when the
+        block exits cleanly and discarded if it raises.
+        """
+        raise NotImplementedError
+
+    def read_blob(self, job, kind):
+        if kind == ORIGINAL:
+            from .payloads import get_transport
+            return get_transport().get(self._payload_key(job))
+        return self._read(job, kind)
+
+    def open_blob(self, job, kind):
+        """
+        Readable, seekable file for a blob; raises FileNotFoundError if there
+        is none. The backends read previews and results as the file is read.
+        """
+        data = self.read_blob(job, kind)
+        if data is None:
+            raise FileNotFoundError(f"Job {job.id} has no {kind} image")
+        return io.BytesIO(data)
+
+    async def aread_blob(self, job, kind):
+        """read_blob for a preview or result, from async code."""
+        return await self._aread(job, kind)
+
+    def delete_blob(self, job, kind):
+        if kind == ORIGINAL:
+            from .payloads import get_transport
+            get_transport().delete(self._payload_key(job))
+        else:
+            self._delete(job, kind)
+
+
+class DatabaseJobStore(JobStore):
+    """Jobs as ProcessedPhoto rows with their previews and results in MEDIA_ROOT."""
+
+    FIELDS = {PREVIEW: 'preview_image', RESULT: 'processed_image'}
+
+    @staticmethod
+    def _job(photo):
+        # original_image stays empty: the original is a payload
+        name = photo.processed_image.name or ''
+        result_format = None
+        if photo.processed_image:
+            result_format = photo.processed_image.name.rsplit('.', 1)[-1].lower()
+        return Job(
+            photo.id, photo.rule_id, name,
+            status=photo.status,
+            error_message=photo.error_message,
+            task_id=photo.task_id,
+            created_at=photo.created_at.timestamp(),
+            result_format=result_format,
+            owner=photo.owner,
+            record=photo,
+        )
+
+    def create(self, rule, upload, original=True, owner=''):
+        from .models import ProcessedPhoto
+        photo = ProcessedPhoto.objects.create(rule=rule, owner=owner)
+        job = self._job(photo)
+        if original:
+            self._store_original(job, upload)
+        return job
+
+    async def acreate(self, rule, upload, original=True, owner=''):
+        from .models import ProcessedPhoto
+        photo = await ProcessedPhoto.objects.acreate(rule=rule, owner=owner)
+        job = self._job(photo)
+        if original:
+            await self._astore_original(job, upload)
+        return job
+
+    def get(self, job_id):
+        from .models import ProcessedPhoto
+        photo = ProcessedPhoto.objects.filter(id=job_id).first()
+        return self._job(photo) if photo else None
+
+    async def aget(self, job_id):
+        from .models import ProcessedPhoto
+        photo = await ProcessedPhoto.objects.filter(id=job_id).afirst()
+        return self._job(photo) if photo else None
+
+    def update(self, job, **fields):
+        # One save also persists any blobs deleted since the last update
+        for name, value in fields.items():
+            setattr(job, name, value)
+            setattr(job.record, name, value)
+        job.record.save()
+
+    async def aupdate(self, job, **fields):
+        for name, value in fields.items():
+            setattr(job, name, value)
+            setattr(job.record, name, value)
+        await job.record.asave()
+
+    def _put(self, job, kind, data, fmt):
+        from django.core.files.base import ContentFile, File
+        prefix = 'preview_' if kind == PREVIEW else 'processed_' if fmt == 'png' else 'converted_'
+        content = data if isinstance(data, File) else ContentFile(data)
+        getattr(job.record, self.FIELDS[kind]).save(f"{prefix}{job.id}.{fmt}", content, save=False)
+        if kind == RESULT:
+            job.result_format = fmt
+
+    @contextmanager
+    def blob_writer(self, job, kind, fmt='png'):
+        import tempfile
+        from django.core.files.base import File
+        # Spooled to a temporary file, then copied into storage chunk by chunk
+        with tempfile.TemporaryFile() as f:
+            yield f
+            f.seek(0)
+            self._put(job, kind, File(f), fmt)
+
+    def _read(self, job, kind):
+        field = getattr(job.record, self.FIELDS[kind])
+        if not field:
+            return None
+        try:
+            with field.open('rb') as f:
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+    def open_blob(self, job, kind):
+        if kind == ORIGINAL:
+            return super().open_blob(job, kind)
+        field = getattr(job.record, self.FIELDS[kind])
+        if not field:
+            raise FileNotFoundError(f"Job {job.id} has no {kind} image")
+        return field.storage.open(field.name, 'rb')
+
+    async def _aread(self, job, kind):
+        from asgiref.sync import sync_to_async
+        # Storage backends only offer blocking reads
+        return await sync_to_async(self._read, thread_sensitive=False)(job, kind)
+
+    def _delete(self, job, kind):
+        field = getattr(job.record, self.FIELDS[kind])
+        if field:
+            field.delete(save=False)
+
+    def delete(self, job):
+        self.delete_blob(job, ORIGINAL)
+        # post_delete removes the files
+        job.record.delete()
+
+    def retain(self, job, seconds):
+        # Rows and files go with cleanup_old_photos, an hour after upload
+        pass
+
+    def stale_pending(self, created_before):
+        from datetime import datetime, timezone
+        from .models import ProcessedPhoto
+        cutoff = datetime.fromtimestamp(created_before, tz=timezone.utc)
+        photos = ProcessedPhoto.objects.filter(status='pending', created_at__lt=cutoff).exclude(task_id=None)
+        return [self._job(photo) for photo in photos]
+
+
+class RedisJobStore(JobStore):
+    """
+    Jobs as Redis keys that expire with the job:
+
+    - job:{id}           hash of the Job fields
+    - job:{id}:{kind}    preview and result bytes
+    - jobs:pending       hash of pending job id -> created_at, for the
+                         abandoned-job sweep
+    """
+
+    FIELDS = ('rule_id', 'name', 'status', 'error_message', 'task_id', 'created_at', 'result_format', 'owner')
+
+    def __init__(self, ttl):
+        from .redis_client import get_redis
+        super().__init__(ttl)
+        self.redis = get_redis()
+        self.blobs = get_redis(binary=True)
+        self._update = self.redis.register_script(UPDATE_LUA)
+
+    def create(self, rule, upload, original=True, owner=''):
+        job_id = self.redis.incr('job:next_id')
+        job = Job(job_id, rule.id, upload.name, owner=owner)
+        job._rule = rule
+        if original:
+            self._store_original(job, upload)
+        self.redis.hset(f"job:{job_id}", mapping={
+            name: '' if getattr(job, name) is None else getattr(job, name) for name in self.FIELDS
+        })
+        self.redis.expire(f"job:{job_id}", self.ttl)
+        self.redis.hset('jobs:pending', job_id, job.created_at)
+        return job
+
+    async def acreate(self, rule, upload, original=True, owner=''):
+        from .redis_client import get_async_redis
+        redis = get_async_redis()
+        job_id = await redis.incr('job:next_id')
+        job = Job(job_id, rule.id, upload.name, owner=owner)
+        job._rule = rule
+        if original:
+            await self._astore_original(job, upload)
+        await redis.hset(f"job:{job_id}", mapping={
+            name: '' if getattr(job, name) is None else getattr(job, name) for name in self.FIELDS
+        })
+        await redis.expire(f"job:{job_id}", self.ttl)
+        await redis.hset('jobs:pending', job_id, job.created_at)
+        return job
+
+    def get(self, job_id):
+        return self._job(job_id, self.redis.hgetall(f"job:{job_id}"))
+
+    async def aget(self, job_id):
+        from .redis_client import get_async_redis
+        return self._job(job_id, await get_async_redis().hgetall(f"job:{job_id}"))
+
+    @staticmethod
+    def _job(job_id, fields):
+        if not fields:
+            return None
+        return Job(
+            int(job_id), int(fields['rule_id']), fields['name'],
+            status=fields['status'],
+            error_message=fields.get('error_message') or None,
+            task_id=fields.get('task_id') or None,
+            created_at=float(fields['created_at']),
+            result_format=fields.get('result_format') or None,
+            owner=fields.get('owner', ''),
+        )
+
+    def update(self, job, **fields):
+        for name, value in fields.items():
+            setattr(job, name, value)
+        args = [item for name, value in fields.items() for item in (name, '' if value is None else value)]
+        if args and not self._update(keys=[f"job:{job.id}"], args=args):
+            raise LookupError(f"Job {job.id} expired")
+        if job.status != 'pending':
+            self.redis.hdel('jobs:pending', job.id)
+
+    async def aupdate(self, job, **fields):
+        from .redis_client import get_async_redis
+        redis = get_async_redis()
+        for name, value in fields.items():
+            setattr(job, name, value)
+        args = [item for name, value in fields.items() for item in (name, '' if value is None else value)]
+        if args and not await redis.register_script(UPDATE_LUA)(keys=[f"job:{job.id}"], args=args):
+            raise LookupError(f"Job {job.id} expired")
+        if job.status != 'pending':
+            await redis.hdel('jobs:pending', job.id)
+
+    def _put(self, job, kind, data, fmt):
+        self.blobs.set(f"job:{job.id}:{kind}", data, ex=self.ttl)
+        if kind == RESULT:
+            self.update(job, result_format=fmt)
+
+    @contextmanager
+    def blob_writer(self, job, kind, fmt='png'):
+        key = f"job:{job.id}:{kind}"
+        writer = RedisAppendWriter(self.blobs, f"{key}:partial", self.ttl)
+        try:
+            yield writer
+            writer.flush()
+            if not writer.written:
+                self.blobs.set(key, b'', ex=self.ttl)
+            else:
+                # Readers never see a half-written blob
+                self.blobs.rename(f"{key}:partial", key)
+                self.blobs.expire(key, self.ttl)
+        except BaseException:
+            writer.buffer.clear()
+            self.blobs.delete(f"{key}:partial")
+            raise
+        if kind == RESULT:
+            self.update(job, result_format=fmt)
+
+    def _read(self, job, kind):
+        return self.blobs.get(f"job:{job.id}:{kind}")
+
+    def open_blob(self, job, kind):
+        if kind == ORIGINAL:
+            return super().open_blob(job, kind)
+        key = f"job:{job.id}:{kind}"
+        size = self.blobs.strlen(key)
+        if not size and not self.blobs.exists(key):
+            raise FileNotFoundError(f"Job {job.id} has no {kind} image")
+        return RedisRangeReader(self.blobs, key, size)
+
+    async def _aread(self, job, kind):
+        from .redis_client import get_async_redis
+        return await get_async_redis(binary=True).get(f"job:{job.id}:{kind}")
+
+    def _delete(self, job, kind):
+        self.blobs.delete(f"job:{job.id}:{kind}")
+
+    def delete(self, job):
+        self.delete_blob(job, ORIGINAL)
+        self.redis.delete(f"job:{job.id}", f"job:{job.id}:{PREVIEW}", f"job:{job.id}:{RESULT}")
+        self.redis.hdel('jobs:pending', job.id)
+
+    def retain(self, job, seconds):
+        """Shortens a finished job's lifetime to `seconds`."""
+        self.redis.expire(f"job:{job.id}", seconds)
+        self.blobs.expire(f"job:{job.id}:{RESULT}", seconds)
+
+    def stale_pending(self, created_before):
+        jobs = []
+        for job_id, created_at in self.redis.hgetall('jobs:pending').items():
+            if float(created_at) >= created_before:
+                continue
+            job = self.get(job_id)
+            if job is None:
+                # Expired before it ever ran
+                self.redis.hdel('jobs:pending', job_id)
+            elif job.status == 'pending' and job.task_id:
+                jobs.append(job)
+        return jobs
+
+
+class RedisAppendWriter(io.RawIOBase):
+    """
+    File-like sink that APPENDs to a Redis string in BUFFER_BYTES pieces, so
+    at most one piece of the encoded image is held in memory.
+    """
+    BUFFER_BYTES = 256 * 1024
+
+    def __init__(self, redis, key, ttl):
+        self.redis = redis
+        self.key = key
+        self.ttl = ttl
+        self.buffer = bytearray()
+        self.written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.BUFFER_BYTES:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.redis.append(self.key, bytes(self.buffer))
+            self.redis.expire(self.key, self.ttl)
+            self.written += len(self.buffer)
+            self.buffer.clear()
+
+
+class RedisRangeReader(io.RawIOBase):
+    """
+    Seekable file over a Redis string of `size` bytes, fetched with GETRANGE
+    as it is read, so only the piece being read is held in memory.
+    """
+    def __init__(self, redis, key, size):
+        self.redis = redis
+        self.key = key
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        end = min(self.size, self.position + len(buffer)) - 1
+        data = self.redis.getrange(self.key, self.position, end)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+_store = None
+
+def get_job_store():
+    global _store
+    if _store is None:
+        from django.conf import settings
+        if settings.JOB_STORE == 'redis':
+            _store = RedisJobStore(settings.JOB_TTL_SECONDS)
+        else:
+            _store = DatabaseJobStore(settings.JOB_TTL_SECONDS)
+    return _store
@@ -0,0 +1,111 @@
+"""
+Time and memory budgets for processing jobs.
+
+Celery enforces TASK_SOFT_TIME_LIMIT and TASK_TIME_LIMIT on prefork workers:
+past the soft limit SoftTimeLimitExceeded is raised inside the task, past
+the hard limit the child process is killed and replaced. Thread and solo
+pools cannot interrupt a task, so the engine also checks a budget between
+stages (budget_checker): time against the soft limit and the process's RSS
+against TASK_MAX_RSS_MB.
+
+RSS is per process, so it only measures the running job where a process
+runs one job at a time: prefork children, solo pools and single-thread
+pools. In a multi-thread pool one job would be charged for its
+neighbours' memory, so the RSS ceiling is off there (logged at worker
+start); every worker that processes photos runs prefork for that reason.
+
+A job over budget is not failed straight away: it is retried once at the
+economy quality tier (engine.QUALITY_ECONOMY) through the fair scheduler,
+behind its client's queued jobs, and only fails if that runs over budget
+too. One bad image thus holds a worker for at most one soft (or hard)
+limit per tier.
+
+Prefork children are also recycled after WORKER_MAX_TASKS_PER_CHILD tasks
+or once their RSS passes WORKER_MAX_RSS_MB, so fragmentation and leaks
+from earlier jobs do not accumulate (Celery settings, see settings.py).
+TASK_MAX_RSS_MB sits below that line: a job is stopped before its child
+grows past the recycle threshold (and the instance's memory).
+"""
+import logging
+import os
+import resource
+import time
+
+from celery.signals import worker_init
+
+logger = logging.getLogger(__name__)
+
+# Task result of a job handed on to its economy retry
+DEGRADED = 'degraded'
+
+
+# Whether this process runs one job at a time, so its RSS is the job's
+_rss_per_job = True
+
+
+class OverBudget(Exception):
+    """A job ran past its soft time limit or its memory ceiling."""
+
+
+def rss_mb():
+    """Resident set size of this process, in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        # Not Linux: the peak is the best we have (KB on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if peak > 1 << 32 else peak / 1024
+
+
+def budget_checker(should_cancel=None):
+    """
+    Wraps a process_image `should_cancel` so the engine's stage checkpoints
+    also raise OverBudget once the task has used up its budget.
+    """
+    from django.conf import settings
+    started = time.monotonic()
+    seconds = settings.TASK_SOFT_TIME_LIMIT
+    max_rss = settings.TASK_MAX_RSS_MB
+
+    def check():
+        elapsed = time.monotonic() - started
+        if seconds and elapsed > seconds:
+            raise OverBudget(f"ran for {elapsed:.0f}s (soft limit {seconds}s)")
+        if max_rss and _rss_per_job:
+            rss = rss_mb()
+            if rss > max_rss:
+                raise OverBudget(f"worker RSS {rss:.0f} MB (ceiling {max_rss} MB)")
+        return should_cancel() if should_cancel is not None else False
+
+    return check
+
+
+@worker_init.connect
+def note_pool(sender=None, **kwargs):
+    """Turns the RSS ceiling off for pools running several jobs per process."""
+    global _rss_per_job
+    from celery.concurrency import get_implementation
+    from django.conf import settings
+    pool = get_implementation(sender.pool_cls).__module__.rsplit('.', 1)[-1]
+    _rss_per_job = pool in ('prefork', 'solo') or sender.concurrency == 1
+    if settings.TASK_MAX_RSS_MB and not _rss_per_job:
+        logger.warning(
+            "TASK_MAX_RSS_MB is not enforced on the %s pool (concurrency %s): its jobs share one process",
+            pool, sender.concurrency,
+        )
+
+
+def check_budgets(app_configs=None, **kwargs):
+    """System check: a job's RSS ceiling is below the worker recycle threshold."""
+    from django.conf import settings
+    from django.core import checks
+    worker_kib = settings.CELERY_WORKER_MAX_MEMORY_PER_CHILD
+    if settings.TASK_MAX_RSS_MB and worker_kib and settings.TASK_MAX_RSS_MB * 1024 >= worker_kib:
+        return [checks.Warning(
+            f"TASK_MAX_RSS_MB ({settings.TASK_MAX_RSS_MB}) is not below WORKER_MAX_RSS_MB ({worker_kib // 1024}).",
+            hint="Jobs should be stopped before their worker child passes the recycle threshold.",
+            id='passport_tool.W001',
+        )]
+    return []
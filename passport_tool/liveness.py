@@ -0,0 +1,99 @@
+"""
+Client liveness for queued and running jobs.
+
+The upload and every status poll refresh a heartbeat for the photo that
+expires after ABANDON_AFTER_SECONDS; closing or leaving the page sends an
+explicit cancel. A job whose heartbeat has lapsed (or that was cancelled)
+is abandoned:
+
+- queued jobs are revoked (tasks.cancel_abandoned_jobs) and, should one
+  still reach a worker, skipped on arrival;
+- running jobs stop at the next engine stage boundary (JobCancelled).
+
+Jobs whose client waits elsewhere (a webhook, see webhooks.py) are held
+alive without a heartbeat. When Redis cannot be reached jobs are never
+treated as abandoned.
+"""
+import time
+
+# Task return value for jobs dropped because their client went away
+CANCELLED = 'cancelled'
+
+# How often a running job re-checks liveness between engine stages
+CHECK_INTERVAL = 1.0
+
+
+def _redis():
+    from .redis_client import get_redis
+    return get_redis()
+
+
+def beat(photo_id):
+    from django.conf import settings
+    try:
+        _redis().set(f"heartbeat:{photo_id}", int(time.time()), ex=settings.ABANDON_AFTER_SECONDS)
+    except Exception:
+        pass
+
+
+async def abeat(photo_id):
+    """beat for async views."""
+    from django.conf import settings
+    from .redis_client import get_async_redis
+    try:
+        await get_async_redis().set(f"heartbeat:{photo_id}", int(time.time()), ex=settings.ABANDON_AFTER_SECONDS)
+    except Exception:
+        pass
+
+
+def hold(photo_id, seconds):
+    """Keeps `photo_id` alive for `seconds` whether or not anyone polls."""
+    try:
+        _redis().set(f"held:{photo_id}", 1, ex=seconds)
+    except Exception:
+        pass
+
+
+async def ahold(photo_id, seconds):
+    """hold for async views."""
+    from .redis_client import get_async_redis
+    try:
+        await get_async_redis().set(f"held:{photo_id}", 1, ex=seconds)
+    except Exception:
+        pass
+
+
+def cancel(photo_id):
+    try:
+        _redis().set(f"cancel:{photo_id}", 1, ex=3600)
+    except Exception:
+        pass
+
+
+def is_abandoned(photo_id):
+    try:
+        redis = _redis()
+        return bool(redis.exists(f"cancel:{photo_id}")) or not redis.exists(f"heartbeat:{photo_id}", f"held:{photo_id}")
+    except Exception:
+        return False
+
+
+def forget(photo_id):
+    try:
+        _redis().delete(f"heartbeat:{photo_id}", f"held:{photo_id}", f"cancel:{photo_id}")
+    except Exception:
+        pass
+
+
+def cancel_checker(photo_id):
+    """`should_cancel` callable for process_image, hitting Redis at most once per CHECK_INTERVAL."""
+    last = {'at': 0.0, 'abandoned': False}
+
+    def should_cancel():
+        now = time.monotonic()
+        if now - last['at'] >= CHECK_INTERVAL:
+            last['at'] = now
+            last['abandoned'] = is_abandoned(photo_id)
+        return last['abandoned']
+
+    return should_cancel
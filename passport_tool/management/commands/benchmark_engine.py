@@ -0,0 +1,86 @@
+import io
+import statistics
+import time
+
+import numpy as np
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from passport_tool.engine import process_image, OutputSpec
+from passport_tool.imaging import PillowBackend, get_backend, engine_threads
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the photo engine: serial vs tile-parallel Pillow, and vips if installed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('image', nargs='?', help='Image to process (default: synthetic 4000x3000 photo)')
+        parser.add_argument('--runs', type=int, default=3)
+        parser.add_argument('--threads', type=int, default=0, help='Tile threads (default: ENGINE_THREADS / CPU quota)')
+        parser.add_argument(
+            '--mode', action='append', choices=['skip_bg', 'original', 'signature', 'human'],
+            help='Engine path(s) to time; "human" needs the rembg models (default: skip_bg, original, signature)'
+        )
+
+    def handle(self, *args, **options):
+        image_bytes = self.load_image(options['image'])
+        threads = options['threads'] or engine_threads()
+        modes = options['mode'] or ['skip_bg', 'original', 'signature']
+        spec = OutputSpec(35, 45)
+
+        backends = [('pillow x1', PillowBackend(workers=1)), (f'pillow x{threads}', PillowBackend(workers=threads))]
+        try:
+            backends.append(('vips', get_backend('vips')))
+        except ImproperlyConfigured as e:
+            self.stdout.write(f"Skipping vips: {e}")
+
+        self.stdout.write(f"Tile threads: {threads}, runs: {options['runs']}")
+        for mode in modes:
+            kwargs = {
+                'skip_bg': {'skip_bg': True},
+                'original': {'skip_bg': True, 'use_original_dimensions': True},
+                'signature': {'is_signature': True},
+                'human': {},
+            }[mode]
+
+            self.stdout.write(f"\n{mode}:")
+            serial_time = None
+            serial_pixels = None
+            for label, backend in backends:
+                timings = []
+                for _ in range(options['runs']):
+                    start = time.perf_counter()
+                    result = process_image(image_bytes, spec, 'white', backend=backend, **kwargs)
+                    timings.append(time.perf_counter() - start)
+                median = statistics.median(timings)
+                pixels = np.asarray(Image.open(io.BytesIO(result)))
+
+                line = f"  {label:<12} {median * 1000:8.1f} ms"
+                if serial_time is None:
+                    serial_time, serial_pixels = median, pixels
+                else:
+                    line += f"  speedup {serial_time / median:4.2f}x"
+                    if backend.name == 'pillow':
+                        identical = serial_pixels.shape == pixels.shape and (serial_pixels == pixels).all()
+                        line += '  bit-identical' if identical else '  MISMATCH'
+                    elif serial_pixels.shape == pixels.shape:
+                        diff = np.abs(serial_pixels.astype(int) - pixels.astype(int))
+                        line += f"  mean diff {diff.mean():.3f}"
+                self.stdout.write(line)
+
+    def load_image(self, path):
+        if path:
+            with open(path, 'rb') as f:
+                return f.read()
+        # Smooth gradients with some detail, roughly like a phone photo
+        height, width = 3000, 4000
+        ys, xs = np.mgrid[0:height, 0:width]
+        rgb = np.stack([
+            (xs * 255 // width),
+            (ys * 255 // height),
+            ((xs + ys) % 256),
+        ], axis=-1).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(rgb).save(buffer, format='JPEG', quality=90)
+        return buffer.getvalue()
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from passport_tool import metrics
+
+
+class Command(BaseCommand):
+    help = 'Show job counters (abandoned work, ...) collected in Redis'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Clear the counters after printing them')
+
+    def handle(self, *args, **options):
+        counters = metrics.snapshot()
+        if not counters:
+            self.stdout.write('No metrics recorded yet.')
+        for name, value in sorted(counters.items()):
+            if name.endswith('_ms'):
+                # Millisecond counters read better as minutes
+                self.stdout.write(f"{name[:-3] + '_minutes':<32} {value / 60000:10.1f}")
+            else:
+                self.stdout.write(f"{name:<32} {value:10d}")
+        if options['reset']:
+            metrics.reset()
+            self.stdout.write(self.style.SUCCESS('Counters reset.'))
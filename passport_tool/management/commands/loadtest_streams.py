@@ -0,0 +1,160 @@
+import asyncio
+import io
+import resource
+import statistics
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+
+class Command(BaseCommand):
+    help = (
+        'Hold many concurrent progress streams (/api/stream/<id>/) open against a running server, '
+        'then publish one event and time its fan-out; reports connections held per web worker'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Server to test')
+        parser.add_argument('--connections', type=int, default=1000)
+        parser.add_argument('--hold', type=float, default=30, help='Seconds to keep every stream open')
+        parser.add_argument('--workers', type=int, default=1, help='Web workers the server runs (WEB_CONCURRENCY)')
+        parser.add_argument('--open-concurrency', type=int, default=200, help='Connections being opened at once')
+        parser.add_argument(
+            '--photo-id', type=int,
+            help='Job to watch; by default a pending job is created in the job store the server shares'
+        )
+        parser.add_argument(
+            '--session-key',
+            help="Session of the job's uploader (with --photo-id); streams are only open to the uploader"
+        )
+
+    def handle(self, *args, **options):
+        # Every stream is a socket
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = options['connections'] + 256
+        if soft < wanted:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+            if hard < wanted:
+                self.stderr.write(f"Open file limit is {hard}; expect failures past ~{hard - 256} connections.")
+
+        job = None
+        photo_id, session_key = options['photo_id'], options['session_key']
+        if photo_id is None:
+            job, session_key = self.create_job()
+            photo_id = job.id
+        try:
+            stats = asyncio.run(self.run(photo_id, session_key, options))
+        finally:
+            if job is not None:
+                from passport_tool.jobs import get_job_store
+                get_job_store().delete(job)
+        self.report(stats, options)
+
+    def create_job(self):
+        from importlib import import_module
+        from django.conf import settings
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from passport_tool import events
+        from passport_tool.jobs import get_job_store
+        from passport_tool.models import CountryRule
+        rule = CountryRule.objects.first()
+        if rule is None:
+            raise CommandError('No CountryRule to attach the test job to; run import_rules first.')
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 64), 'white').save(buffer, 'PNG')
+        # Every stream presents the uploading session's cookie
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session.create()
+        job = get_job_store().create(
+            rule, SimpleUploadedFile('loadtest.png', buffer.getvalue()), owner=session.session_key
+        )
+        events.publish(job.id, 'queued', position=1)
+        return job, session.session_key
+
+    async def run(self, photo_id, session_key, options):
+        from django.conf import settings
+        from asgiref.sync import sync_to_async
+        from passport_tool import events
+
+        url = urlsplit(options['url'])
+        stats = {'connected': 0, 'refused': {}, 'errors': {}, 'open': 0, 'delivered': []}
+        published = asyncio.Event()
+        publish_time = [0.0]
+        opening = asyncio.Semaphore(options['open_concurrency'])
+        cookie = f"Cookie: {settings.SESSION_COOKIE_NAME}={session_key}\r\n" if session_key else ''
+
+        async def client():
+            writer = None
+            try:
+                async with opening:
+                    reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+                    writer.write(
+                        f"GET /api/stream/{photo_id}/ HTTP/1.1\r\nHost: {url.netloc}\r\n"
+                        f"Accept: text/event-stream\r\nX-Forwarded-Proto: https\r\n{cookie}\r\n".encode()
+                    )
+                    await writer.drain()
+                    status = (await reader.readline()).split()
+                code = status[1].decode() if len(status) > 1 else 'none'
+                if code != '200':
+                    stats['refused'][code] = stats['refused'].get(code, 0) + 1
+                    return
+                stats['connected'] += 1
+                stats['open'] += 1
+                try:
+                    while True:
+                        line = await reader.readline()
+                        if not line:
+                            break
+                        if published.is_set() and line.startswith(b'data:') and b'"done"' in line:
+                            stats['delivered'].append(time.monotonic() - publish_time[0])
+                            break
+                finally:
+                    stats['open'] -= 1
+            except Exception as e:
+                name = type(e).__name__
+                stats['errors'][name] = stats['errors'].get(name, 0) + 1
+            finally:
+                if writer is not None:
+                    writer.close()
+
+        clients = [asyncio.create_task(client()) for _ in range(options['connections'])]
+        started = time.monotonic()
+        peak = 0
+        while time.monotonic() - started < options['hold']:
+            await asyncio.sleep(0.5)
+            peak = max(peak, stats['open'])
+        stats['held'] = stats['open']
+        stats['peak'] = peak
+
+        # One event to every stream at once
+        publish_time[0] = time.monotonic()
+        published.set()
+        await sync_to_async(events.publish)(photo_id, 'done')
+        await asyncio.wait(clients, timeout=30)
+        for task in clients:
+            task.cancel()
+        return stats
+
+    def report(self, stats, options):
+        workers = max(1, options['workers'])
+        self.stdout.write(f"Connections attempted      {options['connections']:>8}")
+        self.stdout.write(f"Streams accepted           {stats['connected']:>8}")
+        self.stdout.write(f"Open after {options['hold']:.0f}s hold{'':<8}{stats['held']:>8}")
+        self.stdout.write(f"Peak open streams          {stats['peak']:>8}")
+        self.stdout.write(f"Per web worker ({workers})         {stats['peak'] / workers:>8.0f}")
+        delivered = sorted(stats['delivered'])
+        self.stdout.write(f"Final event delivered to   {len(delivered):>8}")
+        if delivered:
+            p95 = delivered[min(len(delivered) - 1, int(len(delivered) * 0.95))]
+            self.stdout.write(
+                f"Fan-out latency            median {statistics.median(delivered) * 1000:.0f} ms, "
+                f"p95 {p95 * 1000:.0f} ms, max {delivered[-1] * 1000:.0f} ms"
+            )
+        for code, count in sorted(stats['refused'].items()):
+            self.stdout.write(f"HTTP {code:<22}{count:>8}")
+        if '429' in stats['refused']:
+            self.stdout.write('  (all streams come from one IP: raise STATUS_RATE_LIMIT on the server for this test)')
+        for name, count in sorted(stats['errors'].items()):
+            self.stdout.write(f"{name:<27}{count:>8}")
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from passport_tool.engine import PREVIEW_MODEL_NAME
+from passport_tool.inference import serve
+
+
+class Command(BaseCommand):
+    help = 'Run the node-local micro-batching segmentation server used with INFERENCE_MODE=socket'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=None, help='Unix socket path (default: INFERENCE_SOCKET)')
+        parser.add_argument(
+            '--model', action='append',
+            help='Model(s) to load before accepting requests (default: u2net_human and the preview model)'
+        )
+
+    def handle(self, *args, **options):
+        path = options['socket'] or settings.INFERENCE_SOCKET
+        models = options['model'] or ['u2net_human', PREVIEW_MODEL_NAME]
+        self.stdout.write(
+            f"Inference server on {path} (window {settings.INFERENCE_BATCH_WINDOW_MS} ms, "
+            f"max batch {settings.INFERENCE_MAX_BATCH}), models: {', '.join(models)}"
+        )
+        try:
+            serve(path, preload=models)
+        except KeyboardInterrupt:
+            pass
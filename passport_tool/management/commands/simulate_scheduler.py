@@ -0,0 +1,96 @@
+import heapq
+import statistics
+from collections import deque
+
+from django.core.management.base import BaseCommand
+
+from passport_tool.redis_client import LocalRedis
+from passport_tool.scheduler import FairScheduler
+
+
+class Command(BaseCommand):
+    help = 'Simulate FIFO vs fair scheduling for a bursty client and steady clients; reports per-client waits'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--job-ms', type=int, default=2000, help='Service time of every job')
+        parser.add_argument('--burst', type=int, default=20, help='Jobs the bursty client submits at t=0')
+        parser.add_argument('--steady-clients', type=int, default=3)
+        parser.add_argument('--steady-interval-ms', type=int, default=8000, help='Gap between a steady client\'s jobs')
+        parser.add_argument('--duration-ms', type=int, default=60000, help='Steady clients submit until then')
+        parser.add_argument('--quantum-ms', type=int, default=3000)
+        parser.add_argument('--max-inflight', type=int, default=2)
+
+    def handle(self, *args, **options):
+        arrivals = [(0, 'burst') for _ in range(options['burst'])]
+        for index in range(options['steady_clients']):
+            # Stagger the steady clients so they do not arrive in lockstep
+            t = 500 * (index + 1)
+            while t < options['duration_ms']:
+                arrivals.append((t, f'steady-{index + 1}'))
+                t += options['steady_interval_ms']
+        arrivals.sort()
+
+        for policy in ('fifo', 'fair'):
+            waits = self.simulate(policy, arrivals, options)
+            self.stdout.write(f"\n{policy.upper()} ({options['workers']} worker(s), {options['job_ms']} ms jobs)")
+            self.stdout.write(f"  {'client':<10} {'jobs':>5} {'mean wait':>11} {'max wait':>10}")
+            for client in sorted(waits):
+                client_waits = waits[client]
+                self.stdout.write(
+                    f"  {client:<10} {len(client_waits):>5} "
+                    f"{statistics.mean(client_waits) / 1000:>10.1f}s {max(client_waits) / 1000:>9.1f}s"
+                )
+
+    def simulate(self, policy, arrivals, options):
+        """Discrete-event run in virtual milliseconds; returns {client: [wait_ms, ...]}."""
+        job_ms = options['job_ms']
+        events = []
+        sequence = 0
+        now = 0
+        submitted = {}
+        waits = {}
+
+        def push(at, kind, payload):
+            nonlocal sequence
+            sequence += 1
+            heapq.heappush(events, (at, sequence, kind, payload))
+
+        def start(task_id, client):
+            waits.setdefault(client, []).append(now - submitted[task_id])
+            push(now + job_ms, 'finish', task_id)
+
+        for at, client in arrivals:
+            push(at, 'arrive', client)
+
+        if policy == 'fifo':
+            backlog = deque()
+            idle = options['workers']
+        else:
+            scheduler = FairScheduler(
+                LocalRedis(),
+                quantum_ms=options['quantum_ms'],
+                max_dispatched=options['workers'],
+                max_inflight=options['max_inflight'],
+                send=lambda job, queue: start(job['task_id'], job['kwargs']['client']),
+            )
+
+        while events:
+            now, _, kind, payload = heapq.heappop(events)
+            if kind == 'arrive':
+                task_id = f"job-{sequence}"
+                submitted[task_id] = now
+                if policy == 'fifo':
+                    backlog.append((task_id, payload))
+                else:
+                    scheduler.submit('sim', payload, 'sim', kwargs={'client': payload}, cost_ms=job_ms, task_id=task_id)
+            elif policy == 'fifo':
+                idle += 1
+            else:
+                scheduler.finish(payload)
+
+            if policy == 'fifo':
+                while idle and backlog:
+                    idle -= 1
+                    start(*backlog.popleft())
+        return waits
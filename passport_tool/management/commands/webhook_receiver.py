@@ -0,0 +1,68 @@
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand, CommandError
+
+from passport_tool import webhooks
+
+
+class Command(BaseCommand):
+    help = (
+        'Local stand-in for an API client\'s webhook endpoint: prints every delivery '
+        'and checks its signature against the client\'s secret'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--api-key', help='ApiClient whose secret signs the deliveries')
+        parser.add_argument('--fail-first', type=int, default=0, help='Answer the first N requests with --status')
+        parser.add_argument('--status', type=int, default=503, help='Status for failed requests')
+
+    def handle(self, *args, **options):
+        secret = None
+        if options['api_key']:
+            client = webhooks.api_client(options['api_key'])
+            if client is None:
+                raise CommandError('No active API client with that key.')
+            secret = client.secret
+        command = self
+        state = {'requests': 0, 'seen': set()}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                state['requests'] += 1
+                if state['requests'] <= options['fail_first']:
+                    command.stdout.write(command.style.WARNING(f"#{state['requests']} answered {options['status']}"))
+                    self.send_response(options['status'])
+                    self.end_headers()
+                    return
+                signature = self.headers.get('X-SnapFixer-Signature', '')
+                if secret is None:
+                    verdict = 'unchecked'
+                elif webhooks.verify(secret, signature, body):
+                    verdict = 'valid'
+                else:
+                    verdict = 'INVALID'
+                delivery = self.headers.get('X-SnapFixer-Delivery')
+                repeat = ' (repeat)' if delivery in state['seen'] else ''
+                state['seen'].add(delivery)
+                command.stdout.write(f"#{state['requests']} {self.path} signature {verdict}{repeat}")
+                try:
+                    command.stdout.write(json.dumps(json.loads(body), indent=2))
+                except ValueError:
+                    command.stdout.write(repr(body[:200]))
+                self.send_response(401 if verdict == 'INVALID' else 204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', options['port']), Handler)
+        self.stdout.write(f"Receiving webhooks on http://127.0.0.1:{options['port']}/ (Ctrl+C to stop)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
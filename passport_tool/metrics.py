@@ -0,0 +1,28 @@
+"""
+Operational counters shared by web processes and workers (Redis hash
+"metrics"); read them with `manage.py job_metrics`.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY = 'metrics'
+
+
+def incr(name, amount=1):
+    """Adds an integer `amount` to counter `name`; never raises."""
+    try:
+        from .redis_client import get_redis
+        get_redis().hincrby(METRICS_KEY, name, int(amount))
+    except Exception as e:
+        logger.warning("Could not update metric %s: %s", name, e)
+
+
+def snapshot():
+    from .redis_client import get_redis
+    return {name: int(value) for name, value in get_redis().hgetall(METRICS_KEY).items()}
+
+
+def reset():
+    from .redis_client import get_redis
+    get_redis().delete(METRICS_KEY)
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-19 16:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('passport_tool', '0011_processedphoto_error_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processedphoto',
+            name='preview_image',
+            field=models.ImageField(blank=True, null=True, upload_to='processed/%Y/%m/%d/'),
+        ),
+    ]
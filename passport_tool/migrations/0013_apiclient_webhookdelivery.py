@@ -0,0 +1,48 @@
+# Generated by Django 5.1.4 on 2026-10-19 16:57
+
+import django.db.models.deletion
+import passport_tool.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('passport_tool', '0012_processedphoto_preview_image'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApiClient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('key', models.CharField(default=passport_tool.models._generate_token, help_text='Sent as the X-API-Key header', max_length=64, unique=True)),
+                ('secret', models.CharField(default=passport_tool.models._generate_token, help_text="Signs this client's webhook deliveries", max_length=64)),
+                ('callback_hosts', models.TextField(blank=True, help_text='Hosts a callback_url may point at, one per line (e.g. hooks.example.com)')),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'API Client',
+            },
+        ),
+        migrations.CreateModel(
+            name='WebhookDelivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_id', models.BigIntegerField()),
+                ('url', models.URLField(max_length=500)),
+                ('base_url', models.URLField(max_length=200)),
+                ('event', models.JSONField()),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='passport_tool.apiclient')),
+            ],
+            options={
+                'verbose_name': 'Failed Webhook Delivery',
+                'verbose_name_plural': 'Failed Webhook Deliveries',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-19 17:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('passport_tool', '0013_apiclient_webhookdelivery'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='processedphoto',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
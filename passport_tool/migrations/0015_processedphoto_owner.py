@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-19 17:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('passport_tool', '0014_processedphoto_created_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processedphoto',
+            name='owner',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
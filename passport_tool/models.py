@@ -128,10 +128,14 @@ class ProcessedPhoto(models.Model):
     rule = models.ForeignKey(CountryRule, on_delete=models.CASCADE)
     original_image = models.ImageField(upload_to='uploads/%Y/%m/%d/')
     processed_image = models.ImageField(upload_to='processed/%Y/%m/%d/', blank=True, null=True)
-    status = models.CharField(max_length=20, default='pending') # pending, processing, completed, failed
+    preview_image = models.ImageField(upload_to='processed/%Y/%m/%d/', blank=True, null=True)
+    status = models.CharField(max_length=20, default='pending') # pending, processing, preview, completed, failed, cancelled
     error_message = models.TextField(blank=True, null=True)
     task_id = models.CharField(max_length=100, blank=True, null=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Session key of the uploader, or "api:<ApiClient pk>" (jobs.Job.owner)
+    owner = models.CharField(max_length=64, blank=True, default='')
+    # Indexed for the expiry sweep (cleanup.py)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
 class ContactMessage(models.Model):
     name = models.CharField(max_length=200)
@@ -143,6 +147,48 @@ class ContactMessage(models.Model):
     def __str__(self):
         return f"Message from {self.name} ({self.email})"
 
+def _generate_token():
+    import secrets
+    return secrets.token_urlsafe(32)
+
+class ApiClient(models.Model):
+    """Server-to-server integrator calling /api/upload/ with an X-API-Key header."""
+    name = models.CharField(max_length=200)
+    key = models.CharField(max_length=64, unique=True, default=_generate_token, help_text="Sent as the X-API-Key header")
+    secret = models.CharField(max_length=64, default=_generate_token, help_text="Signs this client's webhook deliveries")
+    callback_hosts = models.TextField(blank=True, help_text="Hosts a callback_url may point at, one per line (e.g. hooks.example.com)")
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "API Client"
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def allowed_hosts(self):
+        return {host.strip().lower() for host in self.callback_hosts.splitlines() if host.strip()}
+
+class WebhookDelivery(models.Model):
+    """Dead letter: a completion event that could not be delivered after every retry."""
+    client = models.ForeignKey(ApiClient, on_delete=models.CASCADE)
+    job_id = models.BigIntegerField()
+    url = models.URLField(max_length=500)
+    # Result links in the event are signed afresh against this on redelivery
+    base_url = models.URLField(max_length=200)
+    event = models.JSONField()
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Failed Webhook Delivery"
+        verbose_name_plural = "Failed Webhook Deliveries"
+
+    def __str__(self):
+        return f"Job {self.job_id} -> {self.url}"
+
 # Signals for automatic file cleanup
 from django.db.models.signals import post_delete
 from django.dispatch import receiver
@@ -160,3 +206,7 @@ def auto_delete_file_on_delete(sender, instance, **kwargs):
     if instance.processed_image:
         if os.path.isfile(instance.processed_image.path):
             os.remove(instance.processed_image.path)
+
+    if instance.preview_image:
+        if os.path.isfile(instance.preview_image.path):
+            os.remove(instance.preview_image.path)
@@ -0,0 +1,136 @@
+"""
+Site navigation built from the CountryRules (context_processors.country_rules).
+
+The menus only need a few fields of each rule, so the hierarchy is built
+once into plain dicts and lists (build) and cached twice: as JSON in Redis,
+shared by every process, and as objects in each process. A process checks
+the Redis version at most every CHECK_INTERVAL seconds; rendering a page
+otherwise costs no queries and no Redis round trip.
+
+Saving or deleting a CountryRule or the SiteSettings (signals.py) bumps the
+version, so every process picks up the change within CHECK_INTERVAL.
+Without Redis each process caches on its own for CHECK_INTERVAL.
+"""
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+CHECK_INTERVAL = 5
+# Superseded versions are left to expire
+CACHE_TTL = 24 * 3600
+VERSION_KEY = 'nav:version'
+
+CUSTOM_SIZE_SLUG = 'custom-size-passport-photo'
+NAV_FIELDS = ('slug', 'country', 'flag_emoji', 'exam_country')
+VISA_ORGANIZATIONS = ("Visa", "Residence Permit", "BRP", "Biometric Residence Permit")
+
+# {'version', 'checked_at', 'nav', 'site_settings'}; replaced whole, never mutated
+_cache = None
+
+
+def _key(version):
+    return f"nav:hierarchy:{version}"
+
+
+def build():
+    """The nav menus as JSON-compatible data, holding only NAV_FIELDS of each rule."""
+    from .models import CountryRule
+
+    # 1. Distinct countries for the "By Country" column
+    # We group by exam_country and take the best 'Passport' rule for each
+    rules = (
+        CountryRule.objects.filter(is_exam=False, is_tool=False).exclude(exam_country="Global")
+        .order_by('exam_country', 'country').values(*NAV_FIELDS)
+    )
+    unique_countries = {}
+    for rule in rules:
+        current = unique_countries.get(rule['exam_country'])
+        if current is None:
+            unique_countries[rule['exam_country']] = rule
+        elif "Passport" in (rule['country'] or "") and "Passport" not in (current['country'] or ""):
+            unique_countries[rule['exam_country']] = rule
+    countries = sorted(unique_countries.values(), key=lambda rule: rule['exam_country'])
+
+    # 2. Hierarchies: exams and visas
+    exams = (
+        CountryRule.objects.filter(is_exam=True)
+        .order_by('exam_country', 'exam_state', 'exam_organization', 'country')
+        .values(*NAV_FIELDS, 'exam_state', 'exam_organization')
+    )
+    exam_hierarchy = {}
+    visa_hierarchy = {}
+    for exam in exams:
+        name = exam['country'] or ""
+        state, organization = exam.pop('exam_state'), exam.pop('exam_organization')
+        is_visa = organization in VISA_ORGANIZATIONS or "Visa" in name or "BRP" in name
+        country = (visa_hierarchy if is_visa else exam_hierarchy).setdefault(
+            exam['exam_country'] or "Other", {"states": {}, "orgs": {}, "flat_exams": []}
+        )
+        if not state and not organization:
+            country["flat_exams"].append(exam)
+        elif not state:
+            country["orgs"].setdefault(organization, []).append(exam)
+        else:
+            country["states"].setdefault(state, {}).setdefault(organization or "Standard", []).append(exam)
+
+    return {
+        'countries': countries,
+        'exam_hierarchy': exam_hierarchy,
+        'visa_hierarchy': visa_hierarchy,
+        'tools': list(CountryRule.objects.filter(is_tool=True).values(*NAV_FIELDS)),
+        'custom_size_rule': CountryRule.objects.filter(slug=CUSTOM_SIZE_SLUG).values(*NAV_FIELDS).first(),
+    }
+
+
+def _load(version, redis):
+    """The nav for `version`: from Redis, else built and shared there."""
+    if redis is not None:
+        raw = redis.get(_key(version))
+        if raw:
+            return json.loads(raw)
+    nav = build()
+    if redis is not None:
+        redis.set(_key(version), json.dumps(nav), ex=CACHE_TTL)
+    return nav
+
+
+def navigation():
+    """(nav, site_settings) for rendering a page, cached as described above."""
+    global _cache
+    from .models import SiteSettings
+    cache = _cache
+    now = time.monotonic()
+    if cache is not None and now - cache['checked_at'] < CHECK_INTERVAL:
+        return cache['nav'], cache['site_settings']
+
+    try:
+        from .redis_client import get_redis
+        redis = get_redis()
+        version = int(redis.get(VERSION_KEY) or 0)
+    except Exception as e:
+        logger.warning("Navigation cache unavailable (%s); caching in this process only", e)
+        redis, version = None, None
+    if cache is not None and version is not None and version == cache['version']:
+        _cache = {**cache, 'checked_at': now}
+        return cache['nav'], cache['site_settings']
+
+    try:
+        nav = _load(version, redis)
+    except Exception as e:
+        logger.warning("Could not share navigation cache (%s); building it here", e)
+        nav = build()
+    _cache = {'version': version, 'checked_at': now, 'nav': nav, 'site_settings': SiteSettings.load()}
+    return nav, _cache['site_settings']
+
+
+def invalidate():
+    """Makes every process rebuild or reload the nav on its next check."""
+    global _cache
+    _cache = None
+    try:
+        from .redis_client import get_redis
+        get_redis().incr(VERSION_KEY)
+    except Exception as e:
+        logger.warning("Could not invalidate navigation cache: %s", e)
@@ -0,0 +1,182 @@
+"""
+Payload transport: hands upload bytes from the web process to the worker
+without writing them to MEDIA_ROOT, so web and worker nodes need no
+shared disk.
+
+- RedisPayloadTransport stores a payload as PAYLOAD_CHUNK_BYTES-sized
+  chunks (no multi-megabyte single commands holding up Redis for the
+  scheduler and the broker), zlib-compressed when that actually helps.
+  JPEG and HEIC barely compress; PNG and BMP often halve.
+- DirectoryPayloadTransport writes each payload to one file in
+  PAYLOAD_DIR. It stands in for a blob store: point it at a tmpfs or a
+  mounted bucket, never at persistent local disk.
+
+Payloads expire after their TTL in both. `put` takes bytes or an iterable
+of byte strings (e.g. an upload's chunks()), which it streams through
+without ever holding the whole payload.
+"""
+import hashlib
+import itertools
+import json
+import os
+import time
+import zlib
+
+# Only compress if the first piece shrinks by at least this fraction
+MIN_SAVING = 0.1
+
+
+def _encode(data, compress):
+    """
+    Returns (codec, iterator of encoded pieces) for bytes or an iterable of
+    byte strings. Whether to compress is decided on the first piece: a
+    payload is one file format throughout, so it predicts the rest.
+    """
+    pieces = iter((data,) if isinstance(data, (bytes, bytearray)) else data)
+    first = next(pieces, b'')
+    pieces = itertools.chain((first,), pieces)
+    if compress and first and len(zlib.compress(first, 1)) <= len(first) * (1 - MIN_SAVING):
+        return 'zlib', _deflate(pieces)
+    return 'raw', pieces
+
+
+def _deflate(pieces):
+    compressor = zlib.compressobj(1)
+    for piece in pieces:
+        yield compressor.compress(piece)
+    yield compressor.flush()
+
+
+class _Counted:
+    """Iterates `pieces`, adding up their length in `size`."""
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.size = 0
+
+    def __iter__(self):
+        for piece in self.pieces:
+            self.size += len(piece)
+            yield piece
+
+
+def _decode(data, codec):
+    return zlib.decompress(data) if codec == 'zlib' else data
+
+
+class RedisPayloadTransport:
+    """
+    - {key}         JSON header: chunk count, codec and size
+    - {key}:{n}     chunk bytes
+    """
+
+    def __init__(self, chunk_bytes, compress=True):
+        from .redis_client import get_redis
+        self.redis = get_redis()
+        self.blobs = get_redis(binary=True)
+        self.chunk_bytes = chunk_bytes
+        self.compress = compress
+
+    def put(self, key, data, ttl):
+        counted = _Counted(data if not isinstance(data, (bytes, bytearray)) else (data,))
+        codec, payload = _encode(counted, self.compress)
+        chunks = 0
+        buffer = bytearray()
+        for piece in payload:
+            buffer += piece
+            while len(buffer) >= self.chunk_bytes:
+                self.blobs.set(f"{key}:{chunks}", bytes(buffer[:self.chunk_bytes]), ex=ttl)
+                del buffer[:self.chunk_bytes]
+                chunks += 1
+        if buffer or not chunks:
+            self.blobs.set(f"{key}:{chunks}", bytes(buffer), ex=ttl)
+            chunks += 1
+        # Header last: a reader never sees a partly written payload
+        self.redis.set(key, json.dumps({'chunks': chunks, 'codec': codec, 'size': counted.size}), ex=ttl)
+
+    def get(self, key):
+        header = self.redis.get(key)
+        if header is None:
+            return None
+        header = json.loads(header)
+        parts = []
+        for index in range(header['chunks']):
+            part = self.blobs.get(f"{key}:{index}")
+            if part is None:
+                # A chunk expired before its header
+                return None
+            parts.append(part)
+        return _decode(b''.join(parts), header['codec'])
+
+    def delete(self, key):
+        header = self.redis.get(key)
+        chunks = json.loads(header)['chunks'] if header else 0
+        self.redis.delete(key, *(f"{key}:{index}" for index in range(chunks)))
+
+
+class DirectoryPayloadTransport:
+    """One file per payload; its mtime is set to the expiry time."""
+
+    def __init__(self, directory, compress=True):
+        self.directory = directory
+        self.compress = compress
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def put(self, key, data, ttl):
+        codec, payload = _encode(data, self.compress)
+        path = self._path(key)
+        # Write then rename so readers never see a partial file
+        with open(f"{path}.tmp", 'wb') as f:
+            f.write(codec.encode().ljust(4))
+            for piece in payload:
+                f.write(piece)
+        expires = time.time() + ttl
+        os.utime(f"{path}.tmp", (expires, expires))
+        os.replace(f"{path}.tmp", path)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) <= time.time():
+                self.delete(key)
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        return _decode(data[4:], data[:4].decode().strip())
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self):
+        """Removes expired payloads; returns how many."""
+        removed = 0
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.is_file() and entry.stat().st_mtime <= now:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+
+_transport = None
+
+def get_transport():
+    global _transport
+    if _transport is None:
+        from django.conf import settings
+        if settings.PAYLOAD_TRANSPORT == 'directory':
+            _transport = DirectoryPayloadTransport(settings.PAYLOAD_DIR, compress=settings.PAYLOAD_COMPRESS)
+        else:
+            _transport = RedisPayloadTransport(settings.PAYLOAD_CHUNK_BYTES, compress=settings.PAYLOAD_COMPRESS)
+    return _transport
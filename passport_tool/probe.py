@@ -0,0 +1,88 @@
+"""
+Header-only image admission.
+
+probe_image opens an upload lazily (Pillow parses the header, pillow_heif
+the HEIF container) to learn its format, pixel size, frame count and EXIF
+orientation without decoding any pixels. upload_photo rejects what a
+worker should never decode:
+
+- more than MAX_UPLOAD_MEGAPIXELS (decode time and memory scale with the
+  pixel count, so this is also the decompression-bomb guard; Pillow's own
+  DecompressionBombError is reported the same way);
+- more than MAX_UPLOAD_FRAMES frames (animations, image sequences);
+- files whose header cannot be parsed at all.
+
+Accepted uploads carry the ImageInfo into the cost estimate (cost.py).
+"""
+import warnings
+
+from PIL import Image
+from pillow_heif import register_heif_opener
+register_heif_opener()
+
+EXIF_ORIENTATION = 0x0112
+
+
+class ImageRejected(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class ImageInfo:
+    def __init__(self, format, width, height, frames=1, orientation=1):
+        self.format = format
+        # Stored (not display) pixel size
+        self.width = width
+        self.height = height
+        self.frames = frames
+        self.orientation = orientation
+
+    @property
+    def megapixels(self):
+        return self.width * self.height / 1_000_000
+
+    @property
+    def display_size(self):
+        """Size once EXIF orientation is applied (5-8 swap the axes)."""
+        if self.orientation in (5, 6, 7, 8):
+            return self.height, self.width
+        return self.width, self.height
+
+    def __repr__(self):
+        return f"ImageInfo({self.format}, {self.width}x{self.height}, frames={self.frames}, orientation={self.orientation})"
+
+
+def probe_image(upload, max_megapixels, max_frames):
+    """Reads `upload`'s header; returns ImageInfo or raises ImageRejected."""
+    try:
+        with warnings.catch_warnings():
+            # Over MAX_IMAGE_PIXELS Pillow only warns; the megapixel cap decides
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            with Image.open(upload) as image:
+                width, height = image.size
+                info = ImageInfo(
+                    image.format,
+                    width,
+                    height,
+                    frames=getattr(image, 'n_frames', 1),
+                    # Image.getexif reads what open() parsed; PngImageFile's
+                    # override decodes every pixel looking for a late eXIf
+                    orientation=Image.Image.getexif(image).get(EXIF_ORIENTATION, 1),
+                )
+    except Image.DecompressionBombError:
+        raise ImageRejected('image_too_large', 'This image has too many pixels to process.')
+    except Exception:
+        raise ImageRejected('invalid_image', 'This file could not be read as an image.')
+    finally:
+        upload.seek(0)
+
+    if info.megapixels > max_megapixels:
+        raise ImageRejected(
+            'image_too_large',
+            f'This image is {info.megapixels:.0f} megapixels; the maximum is {max_megapixels}. Please resize it first.'
+        )
+    if info.frames > max_frames:
+        raise ImageRejected('too_many_frames', 'Animated or multi-image files are not supported. Please upload a single photo.')
+    return info
@@ -0,0 +1,50 @@
+"""
+Client addresses behind reverse proxies.
+
+In production every request reaches gunicorn through Koyeb's edge proxy,
+so REMOTE_ADDR is the proxy's address for every visitor. client_ip walks
+X-Forwarded-For from the right, skipping addresses in TRUSTED_PROXIES,
+and returns the first one that is not a trusted proxy, i.e. the address
+the outermost trusted proxy saw. Entries further left were written by the
+client and are ignored, so they cannot be used to dodge a rate limit.
+
+Requests from untrusted peers are identified by REMOTE_ADDR alone, so the
+header is only believed from proxies we run behind.
+"""
+import ipaddress
+from functools import lru_cache
+
+
+@lru_cache(maxsize=8)
+def _networks(entries):
+    return tuple(ipaddress.ip_network(entry.strip(), strict=False) for entry in entries if entry.strip())
+
+
+def _address(value):
+    try:
+        return ipaddress.ip_address(value.strip())
+    except ValueError:
+        return None
+
+
+def _trusted(address, networks):
+    return address is not None and any(address in network for network in networks)
+
+
+def client_ip(request):
+    """The client's IP address as a string ('' if there is none)."""
+    from django.conf import settings
+    networks = _networks(tuple(settings.TRUSTED_PROXIES))
+    remote = request.META.get('REMOTE_ADDR', '')
+    if not _trusted(_address(remote), networks):
+        return remote
+    client = remote
+    for hop in reversed(request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')):
+        address = _address(hop)
+        if address is None:
+            # Not written by a proxy: stop at the last address we can trust
+            break
+        client = str(address)
+        if not _trusted(address, networks):
+            break
+    return client
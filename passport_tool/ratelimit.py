@@ -0,0 +1,175 @@
+"""
+Token-bucket rate limiting per client and endpoint.
+
+Each policy in settings.RATE_LIMITS is (capacity, period_seconds): a client
+may burst up to `capacity` requests and regains capacity/period tokens per
+second. The bucket lives in Redis and is checked and updated by one Lua
+script, i.e. one round trip with no session write, shared by every web
+process. Clients are identified like the fair scheduler does (IP address,
+forwarded by trusted proxies; see proxies.py), so dropping cookies or
+switching browsers does not reset the limit.
+
+Async views take their token through redis.asyncio (the decorator works
+on both kinds of view).
+
+LocalTokenBucket keeps the same buckets in process memory. It serves
+REDIS_URL=local:// (tests, development) and takes over when Redis cannot
+be reached, so limits degrade to per-process instead of disappearing.
+"""
+import hashlib
+import logging
+import math
+import threading
+import time
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+
+logger = logging.getLogger(__name__)
+
+# KEYS[1] bucket; ARGV capacity, tokens per second, cost.
+# Returns {allowed, tokens left, seconds until `cost` tokens are available}.
+TOKEN_BUCKET_LUA = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(tokens), tostring(wait)}
+"""
+# Scripts are cached by SHA1 server-side; async clients call EVALSHA with it
+TOKEN_BUCKET_SHA = hashlib.sha1(TOKEN_BUCKET_LUA.encode()).hexdigest()
+
+
+class RateLimitResult:
+    def __init__(self, allowed, remaining, wait_seconds):
+        self.allowed = allowed
+        self.remaining = int(remaining)
+        self.retry_after = max(1, math.ceil(wait_seconds)) if not allowed else 0
+
+
+class LocalTokenBucket:
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def hit(self, key, capacity, rate, cost=1):
+        with self.lock:
+            now = time.monotonic()
+            tokens, ts = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + max(0.0, now - ts) * rate)
+            if tokens >= cost:
+                self.buckets[key] = (tokens - cost, now)
+                return RateLimitResult(True, tokens - cost, 0)
+            self.buckets[key] = (tokens, now)
+            return RateLimitResult(False, tokens, (cost - tokens) / rate)
+
+    async def ahit(self, key, capacity, rate, cost=1):
+        return self.hit(key, capacity, rate, cost)
+
+
+class RedisTokenBucket:
+    def __init__(self, redis, fallback):
+        self.script = redis.register_script(TOKEN_BUCKET_LUA)
+        self.fallback = fallback
+
+    def hit(self, key, capacity, rate, cost=1):
+        try:
+            allowed, tokens, wait = self.script(keys=[key], args=[capacity, rate, cost])
+        except Exception as e:
+            logger.warning("Rate limiter falling back to process-local buckets: %s", e)
+            return self.fallback.hit(key, capacity, rate, cost)
+        return RateLimitResult(bool(int(allowed)), float(tokens), float(wait))
+
+    async def ahit(self, key, capacity, rate, cost=1):
+        from redis.exceptions import NoScriptError
+        from .redis_client import get_async_redis
+        try:
+            redis = get_async_redis()
+            try:
+                allowed, tokens, wait = await redis.evalsha(TOKEN_BUCKET_SHA, 1, key, capacity, rate, cost)
+            except NoScriptError:
+                # First use on this server (or after SCRIPT FLUSH): EVAL caches it
+                allowed, tokens, wait = await redis.eval(TOKEN_BUCKET_LUA, 1, key, capacity, rate, cost)
+        except Exception as e:
+            logger.warning("Rate limiter falling back to process-local buckets: %s", e)
+            return self.fallback.hit(key, capacity, rate, cost)
+        return RateLimitResult(bool(int(allowed)), float(tokens), float(wait))
+
+
+_limiter = None
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        from .redis_client import get_redis, LocalRedis
+        redis = get_redis()
+        local = LocalTokenBucket()
+        _limiter = local if isinstance(redis, LocalRedis) else RedisTokenBucket(redis, local)
+    return _limiter
+
+
+def check(request, policy):
+    """Takes a token from the client's `policy` bucket; returns RateLimitResult."""
+    from django.conf import settings
+    from .scheduler import client_key
+    capacity, period = settings.RATE_LIMITS[policy]
+    return get_limiter().hit(f"ratelimit:{policy}:{client_key(request)}", capacity, capacity / period)
+
+
+async def acheck(request, policy):
+    """check for async views."""
+    from django.conf import settings
+    from .scheduler import aclient_key
+    capacity, period = settings.RATE_LIMITS[policy]
+    key = await aclient_key(request)
+    return await get_limiter().ahit(f"ratelimit:{policy}:{key}", capacity, capacity / period)
+
+
+def limited_response(result, error='Too many requests. Please try again later.'):
+    from django.http import JsonResponse
+    response = JsonResponse({
+        'error': error,
+        'status': 'rate_limited',
+        'retry_after': result.retry_after
+    }, status=429)
+    response['Retry-After'] = str(result.retry_after)
+    return response
+
+
+def rate_limit(policy, methods=('GET', 'POST')):
+    """View decorator answering over-limit requests with 429 + Retry-After (JSON)."""
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if request.method in methods:
+                    result = await acheck(request, policy)
+                    if not result.allowed:
+                        return limited_response(result)
+                return await view(request, *args, **kwargs)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method in methods:
+                result = check(request, policy)
+                if not result.allowed:
+                    return limited_response(result)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
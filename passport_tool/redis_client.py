@@ -0,0 +1,389 @@
+"""
+Shared Redis connection for job state (scheduler, ...).
+
+With REDIS_URL set to "local://" the helpers get LocalRedis instead: an
+in-process stand-in implementing the handful of commands they use, for
+development without Redis and for simulations. It is per process, so it
+only makes sense when the web app and the workers share one (e.g. eager
+Celery) or for single-process tools.
+
+get_async_redis is the redis.asyncio counterpart for async views; with
+local:// it wraps the same LocalRedis.
+
+LocalRedis cannot run Lua: modules that need a script to be atomic give
+it a Python twin with @local_script, which LocalRedis.register_script runs
+under its lock.
+"""
+import asyncio
+import queue
+import threading
+import time
+import weakref
+
+_clients = {}
+_client_lock = threading.Lock()
+# Lua source -> Python twin run by LocalRedis (see local_script)
+_local_scripts = {}
+# event loop -> {binary: client}; asyncio connections belong to one loop
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_redis(binary=False):
+    """
+    Process-wide client for settings.REDIS_URL. Responses are str unless
+    `binary`, for keys holding image bytes.
+    """
+    with _client_lock:
+        if binary not in _clients:
+            from django.conf import settings
+            if settings.REDIS_URL.startswith('local://'):
+                # One store for both: it hands back values as they were set
+                local = _clients.get(not binary)
+                _clients[binary] = local if isinstance(local, LocalRedis) else LocalRedis()
+            else:
+                import redis
+                _clients[binary] = redis.Redis.from_url(
+                    settings.REDIS_URL, decode_responses=not binary,
+                    socket_timeout=2, socket_connect_timeout=2,
+                )
+        return _clients[binary]
+
+
+def get_async_redis(binary=False):
+    """get_redis for coroutines: a redis.asyncio client for the running loop."""
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    if binary not in clients:
+        from django.conf import settings
+        if settings.REDIS_URL.startswith('local://'):
+            clients[binary] = AsyncLocalRedis(get_redis(binary))
+        else:
+            import redis.asyncio
+            # Bounded: a burst of requests waits for a connection instead of
+            # opening one socket each
+            pool = redis.asyncio.BlockingConnectionPool.from_url(
+                settings.REDIS_URL, decode_responses=not binary,
+                socket_timeout=2, socket_connect_timeout=2,
+                max_connections=settings.REDIS_ASYNC_MAX_CONNECTIONS, timeout=5,
+            )
+            clients[binary] = redis.asyncio.Redis(connection_pool=pool)
+    return clients[binary]
+
+
+def local_script(source):
+    """
+    Registers the decorated function(redis, keys, args) as LocalRedis's
+    implementation of the Lua script `source`.
+    """
+    def decorator(func):
+        _local_scripts[source] = func
+        return func
+    return decorator
+
+
+class LocalRedis:
+    """
+    Thread-safe in-memory subset of the redis-py API (decode_responses=True,
+    except that bytes values are stored and returned as bytes).
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+        self.lock = threading.RLock()
+        # channel -> set of subscriber queues
+        self.channels = {}
+
+    # -- internals --------------------------------------------------------
+
+    def _alive(self, name):
+        deadline = self.expiry.get(name)
+        if deadline is not None and deadline <= time.monotonic():
+            self.data.pop(name, None)
+            self.expiry.pop(name, None)
+        return name in self.data
+
+    def _get(self, name, default_factory=None):
+        if not self._alive(name):
+            if default_factory is None:
+                return None
+            self.data[name] = default_factory()
+        return self.data[name]
+
+    # -- keys -------------------------------------------------------------
+
+    def exists(self, *names):
+        with self.lock:
+            return sum(1 for name in names if self._alive(name))
+
+    def delete(self, *names):
+        with self.lock:
+            removed = 0
+            for name in names:
+                if self._alive(name):
+                    removed += 1
+                self.data.pop(name, None)
+                self.expiry.pop(name, None)
+            return removed
+
+    def expire(self, name, seconds):
+        with self.lock:
+            if not self._alive(name):
+                return False
+            self.expiry[name] = time.monotonic() + seconds
+            return True
+
+    def rename(self, src, dst):
+        with self.lock:
+            if not self._alive(src):
+                raise KeyError(f"no such key: {src}")
+            self.data[dst] = self.data.pop(src)
+            self.expiry.pop(dst, None)
+            if src in self.expiry:
+                self.expiry[dst] = self.expiry.pop(src)
+            return True
+
+    def ttl(self, name):
+        with self.lock:
+            if not self._alive(name):
+                return -2
+            deadline = self.expiry.get(name)
+            return -1 if deadline is None else max(0, round(deadline - time.monotonic()))
+
+    def register_script(self, source):
+        """A callable like redis-py's Script, running the @local_script twin."""
+        func = _local_scripts[source]
+
+        def script(keys=(), args=(), client=None):
+            with self.lock:
+                return func(self, list(keys), list(args))
+        return script
+
+    # -- strings ----------------------------------------------------------
+
+    def get(self, name):
+        with self.lock:
+            return self._get(name)
+
+    def set(self, name, value, ex=None, px=None, nx=False):
+        with self.lock:
+            if nx and self._alive(name):
+                return None
+            self.data[name] = value if isinstance(value, bytes) else str(value)
+            self.expiry.pop(name, None)
+            if ex is not None:
+                self.expiry[name] = time.monotonic() + ex
+            elif px is not None:
+                self.expiry[name] = time.monotonic() + px / 1000.0
+            return True
+
+    def append(self, name, value):
+        with self.lock:
+            current = self._get(name)
+            self.data[name] = (current or b'') + value if isinstance(value, bytes) else (current or '') + str(value)
+            return len(self.data[name])
+
+    def strlen(self, name):
+        with self.lock:
+            return len(self._get(name) or b'')
+
+    def getrange(self, name, start, end):
+        with self.lock:
+            value = self._get(name) or b''
+            if end < 0:
+                end += len(value)
+            return value[start:end + 1]
+
+    def incrby(self, name, amount=1):
+        with self.lock:
+            value = int(self._get(name) or 0) + amount
+            self.data[name] = str(value)
+            return value
+
+    def incr(self, name, amount=1):
+        return self.incrby(name, amount)
+
+    def decr(self, name, amount=1):
+        return self.incrby(name, -amount)
+
+    # -- lists ------------------------------------------------------------
+
+    def rpush(self, name, *values):
+        with self.lock:
+            items = self._get(name, list)
+            items.extend(str(v) for v in values)
+            return len(items)
+
+    def lpush(self, name, *values):
+        with self.lock:
+            items = self._get(name, list)
+            for value in values:
+                items.insert(0, str(value))
+            return len(items)
+
+    def lpop(self, name):
+        with self.lock:
+            items = self._get(name)
+            if not items:
+                return None
+            value = items.pop(0)
+            if not items:
+                self.delete(name)
+            return value
+
+    def lindex(self, name, index):
+        with self.lock:
+            items = self._get(name) or []
+            try:
+                return items[index]
+            except IndexError:
+                return None
+
+    def llen(self, name):
+        with self.lock:
+            return len(self._get(name) or [])
+
+    def lrange(self, name, start, end):
+        with self.lock:
+            items = self._get(name) or []
+            return items[start:None if end == -1 else end + 1]
+
+    def lrem(self, name, count, value):
+        with self.lock:
+            items = self._get(name) or []
+            value = str(value)
+            order = range(len(items) - 1, -1, -1) if count < 0 else range(len(items))
+            matches = [index for index in order if items[index] == value][:abs(count) or None]
+            for index in sorted(matches, reverse=True):
+                del items[index]
+            if name in self.data and not items:
+                self.delete(name)
+            return len(matches)
+
+    # -- hashes -----------------------------------------------------------
+
+    def hget(self, name, key):
+        with self.lock:
+            return (self._get(name) or {}).get(str(key))
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        with self.lock:
+            fields = self._get(name, dict)
+            updates = dict(mapping or {})
+            if key is not None:
+                updates[key] = value
+            added = sum(1 for k in updates if str(k) not in fields)
+            fields.update({str(k): str(v) for k, v in updates.items()})
+            return added
+
+    def hincrby(self, name, key, amount=1):
+        with self.lock:
+            fields = self._get(name, dict)
+            value = int(fields.get(str(key), 0)) + amount
+            fields[str(key)] = str(value)
+            return value
+
+    def hdel(self, name, *keys):
+        with self.lock:
+            fields = self._get(name) or {}
+            removed = sum(1 for key in keys if fields.pop(str(key), None) is not None)
+            if name in self.data and not fields:
+                self.delete(name)
+            return removed
+
+    def hgetall(self, name):
+        with self.lock:
+            return dict(self._get(name) or {})
+
+    # -- pub/sub ----------------------------------------------------------
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscribers = list(self.channels.get(channel, ()))
+        for inbox in subscribers:
+            inbox.put({'type': 'message', 'channel': channel, 'data': str(message)})
+        return len(subscribers)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return LocalPubSub(self)
+
+
+class LocalPubSub:
+    """Subscriber side of LocalRedis.publish (subscribe messages are never sent)."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.inbox = queue.Queue()
+        self.subscribed = set()
+
+    def subscribe(self, *channels):
+        with self.redis.lock:
+            for channel in channels:
+                self.redis.channels.setdefault(channel, set()).add(self.inbox)
+                self.subscribed.add(channel)
+
+    def unsubscribe(self, *channels):
+        with self.redis.lock:
+            for channel in channels:
+                subscribers = self.redis.channels.get(channel, set())
+                subscribers.discard(self.inbox)
+                if not subscribers:
+                    self.redis.channels.pop(channel, None)
+                self.subscribed.discard(channel)
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            return self.inbox.get(timeout=timeout) if timeout else self.inbox.get_nowait()
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.unsubscribe(*self.subscribed)
+
+
+class AsyncLocalRedis:
+    """Awaitable view of a LocalRedis (its commands never block)."""
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def __getattr__(self, name):
+        command = getattr(self.redis, name)
+
+        async def call(*args, **kwargs):
+            return command(*args, **kwargs)
+        return call
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return AsyncLocalPubSub(self.redis.pubsub())
+
+    def register_script(self, source):
+        script = self.redis.register_script(source)
+
+        async def call(keys=(), args=(), client=None):
+            return script(keys, args)
+        return call
+
+
+class AsyncLocalPubSub:
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    async def subscribe(self, *channels):
+        self.pubsub.subscribe(*channels)
+
+    async def unsubscribe(self, *channels):
+        self.pubsub.unsubscribe(*channels)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        deadline = time.monotonic() + (timeout or 0)
+        while True:
+            message = self.pubsub.get_message()
+            if message is not None or time.monotonic() >= deadline:
+                return message
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    async def aclose(self):
+        self.pubsub.close()
@@ -0,0 +1,323 @@
+"""
+Per-client fair scheduling of processing jobs (deficit round robin).
+
+upload_photo hands jobs to `asubmit` instead of enqueuing them on Celery
+directly. Every client (IP address, falling back to the session) gets its
+own backlog per Celery queue. `dispatch` walks the clients with work round
+robin, crediting each a quantum of estimated milliseconds per turn, and only
+releases jobs to Celery while
+
+- the queue has fewer than SCHEDULER_MAX_DISPATCHED jobs outstanding, and
+- the client has fewer than SCHEDULER_MAX_INFLIGHT_PER_CLIENT.
+
+A burst from one client therefore interleaves with everyone else's jobs
+instead of holding the worker for its whole length. State lives in Redis
+(redis_client.py) so all web processes and workers share it; when a task
+finishes (task_postrun) its slot is freed and the scheduler dispatches again.
+
+A client is on the ring exactly when it has a deficit entry. Enqueueing
+(SUBMIT_LUA) and a client's end of turn (SETTLE_LUA) each check the
+backlog and update ring membership in one script, so a job submitted
+while the dispatcher retires its client is never left off the ring.
+"""
+import json
+import logging
+import uuid
+
+from celery.signals import task_postrun, task_revoked
+
+from .redis_client import local_script
+
+logger = logging.getLogger(__name__)
+
+# Seconds the dispatcher lock may be held before another process takes over
+LOCK_TIMEOUT = 10
+# Task -> (queue, client) bookkeeping outlives any sane job
+TASK_TTL = 24 * 3600
+
+# KEYS backlog, deficits, ring; ARGV client, job. Queues the job and puts
+# the client on the ring unless it is already there.
+SUBMIT_LUA = """
+redis.call('RPUSH', KEYS[1], ARGV[2])
+if redis.call('HSETNX', KEYS[2], ARGV[1], 0) == 1 then
+    redis.call('RPUSH', KEYS[3], ARGV[1])
+end
+return 1
+"""
+
+# KEYS backlog, deficits, ring; ARGV client, deficit. Ends a client's turn:
+# back on the ring with its deficit if it has work left (including work
+# submitted during the turn), otherwise off the ring, forfeiting its credit.
+# Returns 1 if the client stays on the ring.
+SETTLE_LUA = """
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('RPUSH', KEYS[3], ARGV[1])
+return 1
+"""
+
+
+@local_script(SUBMIT_LUA)
+def _local_submit(redis, keys, args):
+    backlog, deficits, ring = keys
+    client, job = args
+    redis.rpush(backlog, job)
+    if redis.hget(deficits, client) is None:
+        redis.hset(deficits, client, 0)
+        redis.rpush(ring, client)
+    return 1
+
+
+@local_script(SETTLE_LUA)
+def _local_settle(redis, keys, args):
+    backlog, deficits, ring = keys
+    client, deficit = args
+    if not redis.llen(backlog):
+        redis.hdel(deficits, client)
+        return 0
+    redis.hset(deficits, client, deficit)
+    redis.rpush(ring, client)
+    return 1
+
+
+def client_key(request):
+    """
+    Scheduling identity: the client IP (behind trusted proxies, see
+    proxies.py), or the session when there is none.
+    """
+    from .proxies import client_ip
+    ip_address = client_ip(request)
+    if ip_address:
+        return f"ip:{ip_address}"
+    if not request.session.session_key:
+        request.session.save()
+    return f"session:{request.session.session_key}"
+
+
+async def aclient_key(request):
+    """client_key for async views."""
+    from .proxies import client_ip
+    ip_address = client_ip(request)
+    if ip_address:
+        return f"ip:{ip_address}"
+    if not request.session.session_key:
+        await request.session.asave()
+    return f"session:{request.session.session_key}"
+
+
+class FairScheduler:
+    def __init__(self, redis, quantum_ms, max_dispatched, max_inflight, send=None):
+        self.redis = redis
+        self.quantum_ms = quantum_ms
+        self.max_dispatched = max_dispatched
+        self.max_inflight = max_inflight
+        self.send = send or self._send_to_celery
+        self._submit = redis.register_script(SUBMIT_LUA)
+        self._settle = redis.register_script(SETTLE_LUA)
+
+    @staticmethod
+    def _send_to_celery(job, queue):
+        from celery import current_app
+        current_app.send_task(job['task'], job['args'], job['kwargs'], queue=queue, task_id=job['task_id'])
+
+    @staticmethod
+    def _key(queue, name):
+        return f"sched:{queue}:{name}"
+
+    @staticmethod
+    def _job(task_name, args, kwargs, cost_ms, task_id):
+        return {
+            'task': task_name,
+            'args': list(args),
+            'kwargs': kwargs or {},
+            'task_id': task_id or str(uuid.uuid4()),
+            'cost_ms': int(cost_ms),
+        }
+
+    def submit(self, queue, client, task_name, args=(), kwargs=None, cost_ms=0, task_id=None):
+        """Adds a job to `client`'s backlog on `queue`; returns its Celery task id."""
+        job = self._job(task_name, args, kwargs, cost_ms, task_id)
+        self._submit(
+            keys=[self._key(queue, f"jobs:{client}"), self._key(queue, 'deficit'), self._key(queue, 'ring')],
+            args=[client, json.dumps(job)],
+        )
+        self.dispatch(queue)
+        return job['task_id']
+
+    async def asubmit(self, queue, client, task_name, args=(), kwargs=None, cost_ms=0, task_id=None):
+        """
+        submit for async views: the job is queued through get_async_redis
+        (the same server as get_redis). Dispatching publishes to Celery,
+        whose client blocks, so it runs in a thread.
+        """
+        from asgiref.sync import sync_to_async
+        from .redis_client import get_async_redis
+        job = self._job(task_name, args, kwargs, cost_ms, task_id)
+        await get_async_redis().register_script(SUBMIT_LUA)(
+            keys=[self._key(queue, f"jobs:{client}"), self._key(queue, 'deficit'), self._key(queue, 'ring')],
+            args=[client, json.dumps(job)],
+        )
+        await sync_to_async(self.dispatch, thread_sensitive=False)(queue)
+        return job['task_id']
+
+    def finish(self, task_id):
+        """Releases the slot held by a dispatched task and dispatches more work."""
+        record = self.redis.get(f"sched:task:{task_id}")
+        if record is None:
+            return
+        self.redis.delete(f"sched:task:{task_id}")
+        queue, client = json.loads(record)
+        if self.redis.hincrby(self._key(queue, 'inflight'), client, -1) <= 0:
+            self.redis.hdel(self._key(queue, 'inflight'), client)
+        if self.redis.decr(self._key(queue, 'dispatched')) < 0:
+            self.redis.set(self._key(queue, 'dispatched'), 0)
+        self.dispatch(queue)
+
+    def client(self, task_id):
+        """The client a dispatched, unfinished task was scheduled for, or None."""
+        record = self.redis.get(f"sched:task:{task_id}")
+        return json.loads(record)[1] if record else None
+
+    def dispatch(self, queue):
+        """
+        Releases jobs to Celery in DRR order while there is capacity. Only one
+        process dispatches at a time; anyone who finds the lock taken marks
+        the queue dirty so the holder runs another round before leaving.
+        """
+        lock = self._key(queue, 'lock')
+        dirty = self._key(queue, 'dirty')
+        self.redis.set(dirty, 1)
+        while self.redis.get(dirty) and self.redis.set(lock, 1, ex=LOCK_TIMEOUT, nx=True):
+            try:
+                self.redis.delete(dirty)
+                self._round(queue)
+            finally:
+                self.redis.delete(lock)
+
+    def _round(self, queue):
+        ring = self._key(queue, 'ring')
+        deficits = self._key(queue, 'deficit')
+        inflight = self._key(queue, 'inflight')
+        dispatched = self._key(queue, 'dispatched')
+
+        capacity = self.max_dispatched - int(self.redis.get(dispatched) or 0)
+        while capacity > 0:
+            clients = self.redis.llen(ring)
+            if not clients:
+                return
+            capped = 0
+            # One pass over the ring; deficits grow every pass, so large jobs
+            # are eventually affordable and the loop always makes progress
+            for _ in range(clients):
+                if capacity <= 0:
+                    return
+                client = self.redis.lpop(ring)
+                if client is None:
+                    return
+                backlog = self._key(queue, f"jobs:{client}")
+                running = int(self.redis.hget(inflight, client) or 0)
+                if running >= self.max_inflight:
+                    capped += 1
+                    self.redis.rpush(ring, client)
+                    continue
+
+                deficit = int(self.redis.hget(deficits, client) or 0) + self.quantum_ms
+                head = self.redis.lindex(backlog, 0)
+                while head is not None and capacity > 0 and running < self.max_inflight:
+                    job = json.loads(head)
+                    if job['cost_ms'] > deficit:
+                        break
+                    self.redis.lpop(backlog)
+                    deficit -= job['cost_ms']
+                    self.redis.set(f"sched:task:{job['task_id']}", json.dumps([queue, client]), ex=TASK_TTL)
+                    self.redis.hincrby(inflight, client, 1)
+                    self.redis.incr(dispatched)
+                    self.send(job, queue)
+                    running += 1
+                    capacity -= 1
+                    head = self.redis.lindex(backlog, 0)
+
+                # Idle clients leave the ring and forfeit their credit
+                self._settle(keys=[backlog, deficits, ring], args=[client, deficit])
+            if capped == clients:
+                return
+
+
+_scheduler = None
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        from django.conf import settings
+        from .redis_client import get_redis
+        _scheduler = FairScheduler(
+            get_redis(),
+            quantum_ms=settings.SCHEDULER_QUANTUM_MS,
+            max_dispatched=settings.SCHEDULER_MAX_DISPATCHED,
+            max_inflight=settings.SCHEDULER_MAX_INFLIGHT_PER_CLIENT,
+        )
+    return _scheduler
+
+
+def submit(task, queue, client, args=(), kwargs=None, cost_ms=0, task_id=None):
+    """
+    Schedules `task` fairly for `client`, or enqueues it directly when fair
+    scheduling is off or Redis is unreachable. Returns the task id.
+    """
+    from django.conf import settings
+    if settings.FAIR_SCHEDULING:
+        try:
+            return get_scheduler().submit(queue, client, task.name, args, kwargs, cost_ms, task_id=task_id)
+        except Exception as e:
+            logger.warning("Fair scheduler unavailable (%s); enqueuing directly", e)
+    return task.apply_async(args, kwargs, queue=queue, task_id=task_id).id
+
+
+async def asubmit(task, queue, client, args=(), kwargs=None, cost_ms=0, task_id=None):
+    """submit for async views."""
+    from asgiref.sync import sync_to_async
+    from django.conf import settings
+    if settings.FAIR_SCHEDULING:
+        try:
+            return await get_scheduler().asubmit(queue, client, task.name, args, kwargs, cost_ms, task_id=task_id)
+        except Exception as e:
+            logger.warning("Fair scheduler unavailable (%s); enqueuing directly", e)
+    result = await sync_to_async(task.apply_async, thread_sensitive=False)(args, kwargs, queue=queue, task_id=task_id)
+    return result.id
+
+
+def client_of(task_id):
+    """The client a running task was scheduled for, or None if unknown."""
+    from django.conf import settings
+    if not settings.FAIR_SCHEDULING:
+        return None
+    try:
+        return get_scheduler().client(task_id)
+    except Exception as e:
+        logger.warning("Could not look up the client of %s: %s", task_id, e)
+        return None
+
+
+@task_postrun.connect
+def release_finished_task(task_id=None, **kwargs):
+    from django.conf import settings
+    if not settings.FAIR_SCHEDULING:
+        return
+    try:
+        get_scheduler().finish(task_id)
+    except Exception as e:
+        logger.warning("Could not release scheduler slot for %s: %s", task_id, e)
+
+
+@task_revoked.connect
+def release_revoked_task(request=None, **kwargs):
+    from django.conf import settings
+    if not settings.FAIR_SCHEDULING:
+        return
+    try:
+        get_scheduler().finish(request.id)
+    except Exception as e:
+        logger.warning("Could not release scheduler slot for revoked task: %s", e)
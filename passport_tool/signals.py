@@ -1,6 +1,6 @@
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
-from .models import CountryRule, PageMeta
+from .models import CountryRule, PageMeta, SiteSettings
 from blog.models import BlogPost
 
 @receiver(pre_save, sender=CountryRule)
@@ -27,3 +27,11 @@ def sync_pagemeta_blog_post(sender, instance, **kwargs):
                 PageMeta.objects.filter(path=old_path).update(path=new_path)
         except BlogPost.DoesNotExist:
             pass
+
+@receiver(post_save, sender=CountryRule)
+@receiver(post_delete, sender=CountryRule)
+@receiver(post_save, sender=SiteSettings)
+def invalidate_navigation(sender, **kwargs):
+    # The nav menus are cached (navigation.py)
+    from .navigation import invalidate
+    invalidate()
@@ -1,74 +1,334 @@
+import uuid
+from datetime import timedelta
+
 from celery import shared_task
-from .models import ProcessedPhoto
-from .engine import process_image
-from django.core.files.base import ContentFile
-import os
+from celery.exceptions import SoftTimeLimitExceeded, TimeLimitExceeded
+from celery.signals import task_failure
+from django.conf import settings
+from django.utils import timezone
+from .engine import process_image, OutputSpec, JobCancelled, QUALITY_FULL, QUALITY_ECONOMY
+from .jobs import get_job_store, ORIGINAL, PREVIEW, RESULT
+from . import liveness
+from . import limits
+from . import events
+from . import webhooks
+from . import metrics
+from . import scheduler  # connects the task_postrun hook that frees scheduler slots
+from . import admission  # connects the hooks that track queue work and service times
+import logging
 
-@shared_task
-def process_photo_task(photo_id, **kwargs):
+logger = logging.getLogger(__name__)
+
+def drop_abandoned(store, job):
+    """Discards a job whose client went away; the job stays for check_status."""
+    store.delete_blob(job, ORIGINAL)
+    store.delete_blob(job, PREVIEW)
+    store.update(job, status='cancelled')
+    events.publish(job.id, 'cancelled')
+    webhooks.job_finished(job)
+    return liveness.CANCELLED
+
+def fail_job(store, job, error_msg):
+    """Marks a job failed, dropping its images (best effort: it may have expired)."""
+    try:
+        # Ensure cleanup on failure too
+        store.delete_blob(job, ORIGINAL)
+        store.delete_blob(job, PREVIEW)
+        store.update(job, status='failed', error_message=error_msg)
+    except Exception as e:
+        logger.warning("Could not record failure of job %s: %s", job.id, e)
+    events.publish(job.id, 'failed', error=error_msg)
+    # Set here too in case the update above failed
+    job.status, job.error_message = 'failed', error_msg
+    webhooks.job_finished(job)
+
+def budget_miss_reporter(job):
+    """on_budget_miss for process_image: the result stays at the rule's size."""
+    def report(size, budget):
+        logger.warning("Job %s result is %d KB, over the rule's %d KB", job.id, size // 1024, budget // 1024)
+        metrics.incr('budget_missed')
+    return report
+
+def degrade(store, job, kwargs, reason, task_id):
+    """
+    Retries a job that ran over its time or memory budget (in task
+    `task_id`) once at the economy tier, behind its client's queued jobs;
+    fails it the second time.
+    """
+    from .cost import QUEUE_SEGMENTATION, QUEUE_BULK
+    if kwargs.get('quality', QUALITY_FULL) == QUALITY_ECONOMY:
+        logger.warning("Job %s over budget again at economy quality: %s", job.id, reason)
+        fail_job(store, job, 'This photo is too large or complex to process. Please try a smaller photo.')
+        return 'over budget'
+    logger.warning("Job %s over budget (%s); retrying at economy quality", job.id, reason)
+    store.delete_blob(job, PREVIEW)
+    human = not (kwargs.get('skip_bg') or kwargs.get('is_signature'))
+    # Heavy non-segmentation work belongs on the bulk queue. The retry goes
+    # through the fair scheduler for the same client and is admitted like an
+    # upload, so in-flight counts and queue ETAs include it.
+    queue = QUEUE_SEGMENTATION if human else QUEUE_BULK
+    retry_id = str(uuid.uuid4())
+    cost_ms = admission.retried(task_id, retry_id, queue)
+    try:
+        scheduler.submit(
+            process_photo_task, queue, scheduler.client_of(task_id) or f"job:{job.id}",
+            args=(job.id,), kwargs={**kwargs, 'quality': QUALITY_ECONOMY}, cost_ms=cost_ms, task_id=retry_id,
+        )
+    except Exception as e:
+        admission.withdrawn(retry_id)
+        logger.warning("Could not retry job %s: %s", job.id, e)
+        fail_job(store, job, 'This photo is too large or complex to process. Please try a smaller photo.')
+        return 'over budget'
+    store.update(job, status='processing', task_id=retry_id)
+    events.publish(job.id, 'retrying')
+    return limits.DEGRADED
+
+@shared_task(bind=True, soft_time_limit=settings.TASK_SOFT_TIME_LIMIT, time_limit=settings.TASK_TIME_LIMIT)
+def process_photo_task(self, photo_id, **kwargs):
+    store = get_job_store()
+    job = None
     try:
-        photo = ProcessedPhoto.objects.get(id=photo_id)
-        photo.status = 'processing'
-        photo.save()
+        job = store.get(photo_id)
+        if job is None:
+            # Expired (or cleaned up) before a worker got to it
+            return 'expired'
+        if liveness.is_abandoned(job.id):
+            # The client left while the job was queued
+            return drop_abandoned(store, job)
+        store.update(job, status='processing')
+        events.publish(job.id, 'processing')
         
-        # Read image bytes
-        with photo.original_image.open('rb') as f:
-            image_bytes = f.read()
-            
         # Process
         skip_bg = kwargs.get('skip_bg', False)
         use_original_dimensions = kwargs.get('use_original_dimensions', False)
         is_signature = kwargs.get('is_signature', False)
+        quality = kwargs.get('quality', QUALITY_FULL)
+
+        def publish_preview(preview_bytes):
+            # Phase 1: make the low-res preview pollable while the full
+            # quality pass keeps running
+            store.put_blob(job, PREVIEW, preview_bytes)
+            store.update(job, status='preview')
+            events.publish(job.id, 'preview')
+
+        # The engine decodes straight from the stored original and encodes
+        # straight into the result blob, which is only stored if it finishes
+        with store.open_blob(job, ORIGINAL) as f, store.blob_writer(job, RESULT, 'png') as output:
+            process_image(
+                f, 
+                OutputSpec.from_rule(job.rule),
+                job.rule.bg_color,
+                skip_bg=skip_bg,
+                use_original_dimensions=use_original_dimensions,
+                is_signature=is_signature,
+                output=output,
+                on_preview=publish_preview,
+                should_cancel=limits.budget_checker(liveness.cancel_checker(job.id)),
+                on_stage=lambda stage: events.publish(job.id, stage),
+                quality=quality,
+                on_budget_miss=budget_miss_reporter(job)
+            )
         
-        processed_bytes = process_image(
-            image_bytes, 
-            photo.rule.width_mm, 
-            photo.rule.height_mm, 
-            photo.rule.bg_color,
-            skip_bg=skip_bg,
-            use_original_dimensions=use_original_dimensions,
-            is_signature=is_signature
-        )
-        
-        # Save processed image
-        filename = f"processed_{os.path.basename(photo.original_image.name)}"
-        if not filename.endswith('.png'):
-             filename = filename.rsplit('.', 1)[0] + '.png'
-             
-        photo.processed_image.save(filename, ContentFile(processed_bytes), save=False)
-        photo.status = 'completed'
-        
-        # Privacy: Delete original image file after processing
-        photo.original_image.delete(save=False)
-        photo.save()
+        # Privacy: Delete original image after processing
+        store.delete_blob(job, ORIGINAL)
+        store.delete_blob(job, PREVIEW)
+        store.update(job, status='completed')
+        store.retain(job, settings.RESULT_RETENTION_SECONDS)
+        events.publish(job.id, 'done', result_format='png')
+        webhooks.job_finished(job)
         
         return True
+    except JobCancelled:
+        return drop_abandoned(store, job)
+    except (SoftTimeLimitExceeded, limits.OverBudget) as e:
+        return degrade(store, job, kwargs, str(e) or 'soft time limit', self.request.id)
     except Exception as e:
         import sys
         import traceback
-        error_msg = str(e)
         traceback.print_exc(file=sys.stderr) # Log to Docker logs
         
-        if 'photo' in locals():
-            # Ensure cleanup on failure too
-            if photo.original_image:
-                photo.original_image.delete(save=False)
-            photo.status = 'failed'
-            photo.error_message = error_msg
-            photo.save()
+        if job is not None:
+            fail_job(store, job, str(e))
         return str(e)
 
-from django.utils import timezone
-from datetime import timedelta
+@task_failure.connect(sender=process_photo_task)
+def recover_killed_job(task_id=None, exception=None, args=None, kwargs=None, **extra):
+    """
+    Past the hard time limit the pool kills the worker child, so the task
+    never gets to clean up: the worker does it here instead.
+    """
+    if not isinstance(exception, TimeLimitExceeded):
+        return
+    try:
+        store = get_job_store()
+        job = store.get(args[0])
+        if job is not None and job.task_id == task_id:
+            degrade(store, job, kwargs or {}, f"killed at the {settings.TASK_TIME_LIMIT}s hard limit", task_id)
+    except Exception as e:
+        logger.warning("Could not recover job of killed task %s: %s", task_id, e)
+    # task_postrun never ran for it
+    scheduler.release_finished_task(task_id=task_id)
+    admission.note_task_finish(task_id=task_id, retval=limits.DEGRADED)
+
+def convert_photo(store, job, fmt=None, target_kb=None, use_original_dimensions=True):
+    """Runs the fast conversion engine for `job` and stores the result."""
+    from .conversion import convert_image, EXTENSIONS
+
+    size = None if use_original_dimensions else OutputSpec.from_rule(job.rule).size
+    events.publish(job.id, 'encoding')
+    with store.open_blob(job, ORIGINAL) as f:
+        data, fmt = convert_image(f, fmt, size=size, target_kb=target_kb)
+
+    store.put_blob(job, RESULT, data, EXTENSIONS[fmt])
+    # Privacy: Delete original image after processing
+    store.delete_blob(job, ORIGINAL)
+    store.update(job, status='completed')
+    store.retain(job, settings.RESULT_RETENTION_SECONDS)
+    events.publish(job.id, 'done', result_format=EXTENSIONS[fmt])
+    webhooks.job_finished(job)
+
+def process_upload_inline(upload, rule, mode, owner, fmt=None, target_kb=None, use_original_dimensions=False):
+    """
+    Processes a cheap upload inside the request (see cost.py) without going
+    through the queue. The result is stored as a completed job, so it is
+    delivered (signed result_url) and retained like any other. Returns the
+    job; on failure nothing is left behind.
+    """
+    from .conversion import convert_image, EXTENSIONS
+
+    store = get_job_store()
+    # The upload is processed straight from the request: no stored original
+    job = store.create(rule, upload, original=False, owner=owner)
+    try:
+        if mode == 'conversion':
+            size = None if use_original_dimensions else OutputSpec.from_rule(rule).size
+            data, fmt = convert_image(upload, fmt, size=size, target_kb=target_kb)
+            store.put_blob(job, RESULT, data, EXTENSIONS[fmt])
+        else:
+            with store.blob_writer(job, RESULT, 'png') as output:
+                process_image(
+                    upload,
+                    OutputSpec.from_rule(rule),
+                    rule.bg_color,
+                    skip_bg=mode in ('skip_bg', 'original'),
+                    use_original_dimensions=use_original_dimensions,
+                    is_signature=mode == 'signature',
+                    output=output,
+                    on_budget_miss=budget_miss_reporter(job)
+                )
+        store.update(job, status='completed')
+        store.retain(job, settings.RESULT_RETENTION_SECONDS)
+    except Exception:
+        store.delete(job)
+        raise
+    return job
+
+@shared_task
+def convert_photo_task(photo_id, fmt=None, target_kb=None, use_original_dimensions=True):
+    store = get_job_store()
+    job = None
+    try:
+        job = store.get(photo_id)
+        if job is None:
+            return 'expired'
+        if liveness.is_abandoned(job.id):
+            return drop_abandoned(store, job)
+        store.update(job, status='processing')
+        events.publish(job.id, 'processing')
+
+        convert_photo(store, job, fmt=fmt, target_kb=target_kb, use_original_dimensions=use_original_dimensions)
+        return True
+    except Exception as e:
+        import sys
+        import traceback
+        traceback.print_exc(file=sys.stderr) # Log to Docker logs
+
+        if job is not None:
+            fail_job(store, job, str(e))
+        return str(e)
+
+@shared_task(bind=True, max_retries=None, ignore_result=True)
+def deliver_webhook(self, client_id, url, base_url, event):
+    """
+    POSTs a completion event to an API client's callback (webhooks.py),
+    retrying with exponential backoff; after WEBHOOK_MAX_ATTEMPTS it is
+    kept as a WebhookDelivery dead letter.
+    """
+    from .models import ApiClient, WebhookDelivery
+    client = ApiClient.objects.filter(pk=client_id, is_active=True).first()
+    if client is None:
+        return 'no client'
+    attempt = self.request.retries + 1
+    error = webhooks.post(client, url, base_url, event)
+    if error is None:
+        return True
+    if attempt < settings.WEBHOOK_MAX_ATTEMPTS:
+        logger.info("Webhook %s for job %s failed (%s), attempt %s", event['id'], event['job_id'], error, attempt)
+        raise self.retry(countdown=webhooks.backoff(attempt))
+    WebhookDelivery.objects.create(
+        client=client, job_id=event['job_id'], url=url, base_url=base_url,
+        event=event, attempts=attempt, last_error=error,
+    )
+    logger.warning("Webhook %s for job %s dead-lettered after %s attempts: %s", event['id'], event['job_id'], attempt, error)
+    return error
+
 
 @shared_task
 def cleanup_old_photos():
     """
-    Deletes ProcessedPhoto records older than 1 hour.
-    The post_delete signals will handle deleting the files.
+    Deletes ProcessedPhoto records older than 1 hour with their files, in
+    bounded batches, and sweeps expired upload date directories (see
+    cleanup.py). (The Redis job store expires jobs on its own.)
+    """
+    from .cleanup import cleanup_expired
+    stats = cleanup_expired(
+        timezone.now() - timedelta(hours=1),
+        settings.CLEANUP_BATCH_SIZE,
+        settings.CLEANUP_MAX_BATCHES,
+    )
+    metrics.incr('cleanup_rows', stats.rows)
+    metrics.incr('cleanup_files', stats.files + stats.orphans)
+    logger.info("%s", stats)
+
+    # Payloads whose job never reached a worker
+    from .payloads import get_transport
+    transport = get_transport()
+    if hasattr(transport, 'sweep'):
+        transport.sweep()
+    return str(stats)
+
+@shared_task
+def dispatch_fair_queues():
+    """
+    Safety net for the fair scheduler: dispatches any backlog a missed
+    completion signal (e.g. a killed worker) left waiting.
+    """
+    from .cost import QUEUE_FAST, QUEUE_BULK, QUEUE_SEGMENTATION
+    for queue in (QUEUE_FAST, QUEUE_BULK, QUEUE_SEGMENTATION):
+        scheduler.get_scheduler().dispatch(queue)
+
+@shared_task
+def cancel_abandoned_jobs():
+    """
+    Revokes queued jobs whose client stopped polling (see liveness.py).
+    Running jobs notice on their own between engine stages.
     """
-    one_hour_ago = timezone.now() - timedelta(hours=1)
-    old_photos = ProcessedPhoto.objects.filter(created_at__lt=one_hour_ago)
-    count = old_photos.count()
-    old_photos.delete()  # This triggers the post_delete signal
-    return f"Deleted {count} old photo records."
+    import time
+    from celery import current_app
+    store = get_job_store()
+    revoked = 0
+    for job in store.stale_pending(time.time() - settings.ABANDON_AFTER_SECONDS):
+        if not liveness.is_abandoned(job.id):
+            continue
+        # Should a worker have picked the job up since it was listed, it
+        # stops at its next stage check and drops the job itself
+        liveness.cancel(job.id)
+        job = store.get(job.id)
+        if job is None or job.status != 'pending':
+            continue
+        # Workers drop revoked ids on arrival, even if the fair
+        # scheduler only dispatches the job later
+        current_app.control.revoke(job.task_id)
+        drop_abandoned(store, job)
+        revoked += 1
+    return f"Revoked {revoked} abandoned jobs."
@@ -0,0 +1,40 @@
+"""
+Shared test setup: REDIS_URL=local:// (redis_client.LocalRedis), so the
+suite needs no Redis, and fresh module-level clients for every test.
+"""
+import shutil
+import tempfile
+
+from django.test import TestCase, override_settings
+
+from passport_tool import (
+    events, imaging, jobs, navigation, payloads, ratelimit, redis_client,
+    scheduler, webhooks,
+)
+
+
+def reset_singletons():
+    """Drops the process-wide clients so the next use picks up test settings."""
+    redis_client._clients.clear()
+    redis_client._async_clients.clear()
+    jobs._store = None
+    payloads._transport = None
+    scheduler._scheduler = None
+    ratelimit._limiter = None
+    imaging._instances.clear()
+    navigation._cache = None
+    events._hubs.clear()
+    webhooks._pool = None
+
+
+@override_settings(REDIS_URL='local://', PAYLOAD_TRANSPORT='redis', FAIR_SCHEDULING=True)
+class LocalRedisTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        reset_singletons()
+        self.addCleanup(reset_singletons)
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
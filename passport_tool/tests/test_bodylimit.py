@@ -0,0 +1,85 @@
+import json
+
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from django.core.asgi import get_asgi_application
+from django.test import SimpleTestCase, override_settings
+
+from passport_tool.bodylimit import FORM_ALLOWANCE, UploadSizeLimit
+
+CHUNK = 64 * 1024
+
+
+class BodyReader:
+    """Stands in for Django's handler: reads the whole body, then answers 200."""
+
+    def __init__(self):
+        self.received = 0
+        self.called = False
+
+    async def __call__(self, scope, receive, send):
+        self.called = True
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            self.received += len(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'ok'})
+
+
+def scope(path='/api/upload/testland-passport-photo/', length=None):
+    headers = [(b'content-type', b'multipart/form-data; boundary=x')]
+    if length is not None:
+        headers.append((b'content-length', str(length).encode()))
+    return {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+        'scheme': 'https', 'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': b'',
+        'headers': headers, 'client': ('127.0.0.1', 5000), 'server': ('testserver', 443),
+    }
+
+
+@override_settings(PHOTO_UPLOAD_MAX_BYTES=4 * CHUNK)
+class UploadSizeLimitTests(SimpleTestCase):
+    limit = 4 * CHUNK + FORM_ALLOWANCE
+
+    @async_to_sync
+    async def request(self, app, scope, chunks):
+        communicator = ApplicationCommunicator(app, scope)
+        for index in range(chunks):
+            await communicator.send_input({'type': 'http.request', 'body': b'x' * CHUNK, 'more_body': index < chunks - 1})
+        start = await communicator.receive_output(timeout=5)
+        body = await communicator.receive_output(timeout=5)
+        await communicator.wait(timeout=5)
+        # Nothing is sent after the response (e.g. a second one from Django)
+        self.assertTrue(await communicator.receive_nothing())
+        return start['status'], body.get('body', b'')
+
+    def test_oversized_content_length_is_refused_before_the_body(self):
+        inner = BodyReader()
+        status, body = self.request(UploadSizeLimit(inner), scope(length=self.limit + 1), 0)
+        self.assertEqual(status, 413)
+        self.assertEqual(json.loads(body)['status'], 'file_too_large')
+        self.assertFalse(inner.called)
+
+    def test_chunked_body_is_cut_off_once_past_the_limit(self):
+        inner = BodyReader()
+        status, _ = self.request(UploadSizeLimit(inner), scope(), 20)
+        self.assertEqual(status, 413)
+        # The handler saw at most the limit plus the chunk that crossed it
+        self.assertLessEqual(inner.received, self.limit)
+
+    def test_django_sends_nothing_after_the_rejection(self):
+        status, body = self.request(UploadSizeLimit(get_asgi_application()), scope(), 20)
+        self.assertEqual(status, 413)
+        self.assertEqual(json.loads(body)['status'], 'file_too_large')
+
+    def test_uploads_within_the_limit_and_other_paths_pass_through(self):
+        for path, chunks in (('/api/upload/testland-passport-photo/', 4), ('/secure-portal/', 20)):
+            with self.subTest(path=path):
+                inner = BodyReader()
+                status, _ = self.request(UploadSizeLimit(inner), scope(path), chunks)
+                self.assertEqual(status, 200)
+                self.assertEqual(inner.received, chunks * CHUNK)
@@ -0,0 +1,120 @@
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+from django.utils import timezone
+
+from passport_tool import events, liveness
+from passport_tool.jobs import ORIGINAL, RedisJobStore, get_job_store
+from passport_tool.models import CountryRule, ProcessedPhoto
+from passport_tool.redis_client import get_redis
+from passport_tool.tasks import cancel_abandoned_jobs, process_photo_task
+from .base import LocalRedisTestCase
+from .test_uploads import png_upload
+
+
+class CancellationTests(LocalRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.rule = CountryRule.objects.create(
+            country='Testland', width_mm=35, height_mm=45,
+            meta_title='Testland', meta_description='Testland', content_body='Testland',
+        )
+        self.store = get_job_store()
+        self.job = self.queued_job('task-1')
+        revoke = mock.patch('celery.app.control.Control.revoke')
+        self.revoke = revoke.start()
+        self.addCleanup(revoke.stop)
+
+    def queued_job(self, task_id):
+        job = self.store.create(self.rule, SimpleUploadedFile('photo.png', png_upload().getvalue()))
+        self.store.update(job, task_id=task_id)
+        liveness.beat(job.id)
+        return job
+
+    def cancel(self, job, task_id=None):
+        return self.client.post(
+            reverse('api_cancel', args=[job.id]), {'task_id': task_id or job.task_id}, secure=True,
+        )
+
+    def status(self, job):
+        return self.store.get(job.id).status
+
+    def has_original(self, job):
+        return self.store.read_blob(self.store.get(job.id), ORIGINAL) is not None
+
+    def age(self, job):
+        """Makes `job` older than ABANDON_AFTER_SECONDS."""
+        if isinstance(self.store, RedisJobStore):
+            get_redis().hset('jobs:pending', job.id, time.time() - 3600)
+        else:
+            ProcessedPhoto.objects.filter(pk=job.id).update(created_at=timezone.now() - timedelta(hours=1))
+
+    def test_cancelled_queued_job_is_dropped_when_it_reaches_a_worker(self):
+        self.assertEqual(self.cancel(self.job).json(), {'status': 'cancelling'})
+        with mock.patch('passport_tool.tasks.process_image') as process_image:
+            self.assertEqual(process_photo_task(self.job.id, skip_bg=True), liveness.CANCELLED)
+        process_image.assert_not_called()
+        self.assertEqual(self.status(self.job), 'cancelled')
+        self.assertFalse(self.has_original(self.job))
+
+    def test_running_job_stops_at_the_next_stage(self):
+        publish = events.publish
+
+        def cancel_while_decoding(photo_id, stage, **fields):
+            if stage == 'decoding':
+                self.assertEqual(self.status(self.job), 'processing')
+                self.cancel(self.job)
+            publish(photo_id, stage, **fields)
+
+        with mock.patch.object(events, 'publish', side_effect=cancel_while_decoding) as published, \
+                mock.patch('passport_tool.engine.encode_png') as encode_png:
+            self.assertEqual(process_photo_task(self.job.id, skip_bg=True), liveness.CANCELLED)
+        encode_png.assert_not_called()
+        self.assertEqual([c.args[1] for c in published.call_args_list], ['processing', 'decoding', 'cancelled'])
+        self.assertEqual(self.status(self.job), 'cancelled')
+
+    def test_cancel_needs_the_task_id(self):
+        self.assertEqual(self.cancel(self.job, task_id='someone-else').status_code, 403)
+        self.assertFalse(liveness.is_abandoned(self.job.id))
+
+    def test_cancelling_a_finished_job_changes_nothing(self):
+        self.store.update(self.job, status='completed')
+        self.assertEqual(self.cancel(self.job).status_code, 200)
+        self.assertFalse(liveness.is_abandoned(self.job.id))
+        self.assertEqual(self.status(self.job), 'completed')
+
+    def test_sweep_revokes_abandoned_queued_jobs(self):
+        polled = self.queued_job('task-2')
+        held = self.queued_job('task-3')
+        fresh = self.queued_job('task-4')
+        for job in (self.job, polled, held):
+            self.age(job)
+        # The client of self.job and of fresh stopped polling; held waits for a webhook
+        liveness.forget(self.job.id)
+        liveness.forget(fresh.id)
+        liveness.forget(held.id)
+        liveness.hold(held.id, 60)
+
+        self.assertEqual(cancel_abandoned_jobs(), 'Revoked 1 abandoned jobs.')
+        self.revoke.assert_called_once_with('task-1')
+        self.assertEqual(self.status(self.job), 'cancelled')
+        self.assertFalse(self.has_original(self.job))
+        for job in (polled, held, fresh):
+            self.assertEqual(self.status(job), 'pending')
+
+    def test_sweep_leaves_a_job_that_started_since_it_was_listed(self):
+        self.age(self.job)
+        liveness.forget(self.job.id)
+        listed = self.store.stale_pending(time.time())
+        # A worker picks the job up between the listing and the drop
+        self.store.update(self.job, status='processing')
+        with mock.patch.object(type(self.store), 'stale_pending', return_value=listed):
+            self.assertEqual(cancel_abandoned_jobs(), 'Revoked 0 abandoned jobs.')
+        self.revoke.assert_not_called()
+        self.assertEqual(self.status(self.job), 'processing')
+        self.assertTrue(self.has_original(self.job))
+        # ...and stops at its next stage check instead
+        self.assertTrue(liveness.cancel_checker(self.job.id)())
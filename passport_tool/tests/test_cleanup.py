@@ -0,0 +1,47 @@
+import os
+from datetime import timedelta
+
+from django.core.files.base import ContentFile
+from django.utils import timezone
+
+from passport_tool.cleanup import cleanup_expired
+from passport_tool.models import CountryRule, ProcessedPhoto
+from .base import LocalRedisTestCase
+
+
+class CleanupTests(LocalRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.rule = CountryRule.objects.create(
+            country='Testland', width_mm=35, height_mm=45,
+            meta_title='Testland', meta_description='Testland', content_body='Testland',
+        )
+
+    def photo(self, age):
+        photo = ProcessedPhoto.objects.create(rule=self.rule, status='completed')
+        photo.processed_image.save(f"processed_{photo.id}.png", ContentFile(b'png'), save=False)
+        photo.preview_image.save(f"preview_{photo.id}.png", ContentFile(b'png'), save=False)
+        photo.save()
+        ProcessedPhoto.objects.filter(id=photo.id).update(created_at=timezone.now() - age)
+        return photo
+
+    def test_expired_rows_go_in_batches_with_their_files(self):
+        expired = [self.photo(timedelta(hours=2)) for _ in range(5)]
+        fresh = self.photo(timedelta(minutes=5))
+        # Files of today's jobs are left to the rows: their directory is not swept
+        stats = cleanup_expired(timezone.now() - timedelta(hours=1), batch_size=2, max_batches=10)
+
+        self.assertEqual((stats.rows, stats.batches, stats.files), (5, 3, 10))
+        self.assertEqual(list(ProcessedPhoto.objects.values_list('id', flat=True)), [fresh.id])
+        for photo in expired:
+            self.assertFalse(os.path.exists(photo.processed_image.path))
+            self.assertFalse(os.path.exists(photo.preview_image.path))
+        self.assertTrue(os.path.exists(fresh.processed_image.path))
+
+    def test_backlog_is_left_for_the_next_run(self):
+        for _ in range(5):
+            self.photo(timedelta(hours=2))
+        stats = cleanup_expired(timezone.now() - timedelta(hours=1), batch_size=2, max_batches=2)
+        self.assertEqual(stats.rows, 4)
+        self.assertTrue(stats.backlog)
+        self.assertEqual(ProcessedPhoto.objects.count(), 1)
@@ -0,0 +1,83 @@
+import io
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+from PIL import Image, ImageCms
+
+from passport_tool.conversion import convert_image, target_format
+from .test_engine import photo_like
+
+
+def encoded(image, fmt, **params):
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, **params)
+    return buffer.getvalue()
+
+
+class TargetFormatTests(SimpleTestCase):
+    def test_format_comes_from_the_slug(self):
+        for slug, fmt in (('heic-to-jpg', 'JPEG'), ('bmp-to-jpeg', 'JPEG'), ('webp-to-png', 'PNG'),
+                          ('png-to-webp-converter', 'WEBP'), ('image-compressor', None)):
+            with self.subTest(slug=slug):
+                self.assertEqual(target_format(SimpleNamespace(slug=slug)), fmt)
+
+    def test_requested_format_wins(self):
+        self.assertEqual(target_format(SimpleNamespace(slug='heic-to-jpg'), 'webp'), 'WEBP')
+        self.assertEqual(target_format(SimpleNamespace(slug='heic-to-jpg'), 'tiff'), 'JPEG')
+
+
+class ConvertImageTests(SimpleTestCase):
+    def test_jpeg_output_is_progressive_and_keeps_the_colour_profile(self):
+        profile = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        source = encoded(photo_like((200, 160)).convert('RGB'), 'PNG', icc_profile=profile)
+        data, fmt = convert_image(source, 'JPEG')
+        self.assertEqual(fmt, 'JPEG')
+        with Image.open(io.BytesIO(data)) as image:
+            self.assertEqual(image.format, 'JPEG')
+            self.assertTrue(image.info.get('progressive'))
+            self.assertEqual(image.info.get('icc_profile'), profile)
+
+    def test_transparency_is_flattened_onto_white_for_jpeg(self):
+        source = Image.new('RGBA', (40, 40), (0, 0, 0, 0))
+        source.paste((200, 0, 0, 255), (0, 0, 20, 40))
+        data, _ = convert_image(encoded(source, 'PNG'), 'JPEG')
+        with Image.open(io.BytesIO(data)) as image:
+            self.assertEqual(image.mode, 'RGB')
+            self.assertGreater(min(image.getpixel((35, 20))), 250)
+            self.assertGreater(image.getpixel((5, 20))[0], 180)
+
+    def test_source_format_is_kept_by_default(self):
+        _, fmt = convert_image(encoded(photo_like((40, 40)), 'WEBP'))
+        self.assertEqual(fmt, 'WEBP')
+        # Formats this engine does not write: PNG if transparent, else JPEG
+        _, fmt = convert_image(encoded(photo_like((40, 40)), 'TIFF'))
+        self.assertEqual(fmt, 'PNG')
+        _, fmt = convert_image(encoded(photo_like((40, 40)).convert('RGB'), 'BMP'))
+        self.assertEqual(fmt, 'JPEG')
+
+    def test_resize_to_the_requested_size(self):
+        data, _ = convert_image(encoded(photo_like((400, 300)).convert('RGB'), 'JPEG'), 'PNG', size=(120, 90))
+        with Image.open(io.BytesIO(data)) as image:
+            self.assertEqual(image.size, (120, 90))
+
+    def test_budget_is_met_by_quality_before_size(self):
+        source = encoded(photo_like((600, 450)).convert('RGB'), 'PNG')
+        full, _ = convert_image(source, 'JPEG')
+        target_kb = len(full) * 2 // 3 // 1024
+        data, _ = convert_image(source, 'JPEG', target_kb=target_kb)
+        self.assertLessEqual(len(data), target_kb * 1024)
+        with Image.open(io.BytesIO(data)) as image:
+            self.assertEqual(image.size, (600, 450))
+
+    def test_budget_below_the_lowest_quality_shrinks_the_image(self):
+        source = encoded(photo_like((600, 450)).convert('RGB'), 'PNG')
+        data, _ = convert_image(source, 'JPEG', target_kb=8)
+        self.assertLessEqual(len(data), 8 * 1024)
+        with Image.open(io.BytesIO(data)) as image:
+            self.assertLess(image.width, 600)
+
+    def test_output_file_is_written(self):
+        output = io.BytesIO()
+        result, fmt = convert_image(encoded(photo_like((40, 40)), 'PNG'), 'WEBP', output=output)
+        self.assertIs(result, output)
+        self.assertEqual(Image.open(io.BytesIO(output.getvalue())).format, 'WEBP')
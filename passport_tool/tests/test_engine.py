@@ -0,0 +1,90 @@
+import io
+
+from django.test import SimpleTestCase
+from PIL import Image, ImageChops
+
+from passport_tool.engine import OutputSpec, encode_png
+from passport_tool.imaging import PillowBackend
+
+
+def photo_like(size):
+    """RGBA gradient with noise: several hundred KB as a full-colour PNG."""
+    noise = Image.effect_noise(size, 40).convert('L')
+    gradient = Image.linear_gradient('L').resize(size)
+    image = Image.merge('RGBA', (gradient, noise, Image.blend(gradient, noise, 0.5), Image.new('L', size, 255)))
+    return image
+
+
+def posterized(size):
+    """photo_like in 200 colours: large as RGBA, a fraction of that as a palette PNG."""
+    return photo_like(size).convert('RGB').quantize(200).convert('RGBA')
+
+
+class OutputSpecTests(SimpleTestCase):
+    def test_millimetres_at_dpi(self):
+        self.assertEqual(OutputSpec(35, 45).size, (413, 531))
+
+    def test_one_pinned_side_follows_the_mm_aspect(self):
+        self.assertEqual(OutputSpec(35, 45, width_px=350).size, (350, 450))
+
+    def test_pixel_only_rules_without_millimetres(self):
+        self.assertEqual(OutputSpec(0, 0, width_px=200, height_px=230).size, (200, 230))
+        self.assertEqual(OutputSpec(0, 0, width_px=300).size, (300, 300))
+        self.assertEqual(OutputSpec(35, 0, height_px=240).size, (240, 240))
+
+    def test_no_dimensions_at_all(self):
+        with self.assertRaises(ValueError):
+            OutputSpec(0, 0)
+
+
+class EncodeBudgetTests(SimpleTestCase):
+    backend = PillowBackend()
+
+    def encode(self, image, spec, **kwargs):
+        data = encode_png(image, spec, backend=self.backend, **kwargs)
+        return data, Image.open(io.BytesIO(data))
+
+    def test_writes_the_spec_dpi(self):
+        spec = OutputSpec(35, 45, dpi=300)
+        _, png = self.encode(Image.new('RGBA', spec.size, (200, 10, 10, 255)), spec)
+        self.assertEqual(tuple(round(value) for value in png.info['dpi']), (300, 300))
+
+    def test_result_within_budget_keeps_its_size(self):
+        spec = OutputSpec(35, 45, target_kb=150)
+        image = posterized(spec.size)
+        self.assertGreater(len(self.backend.encode(image.copy())), 150 * 1024)
+        data, png = self.encode(image, spec, target_kb=spec.target_kb)
+        self.assertLessEqual(len(data), 150 * 1024)
+        self.assertEqual(png.size, spec.size)
+        self.assertEqual(tuple(round(value) for value in png.info['dpi']), (300, 300))
+        self.assertIsNone(ImageChops.difference(png.convert('RGBA'), image).getbbox())
+
+    def test_tight_budget_keeps_the_pixel_size_and_reports_the_miss(self):
+        spec = OutputSpec(35, 45, width_px=413, height_px=531, target_kb=20)
+        image = photo_like(spec.size)
+        misses = []
+        with self.assertLogs('passport_tool.engine', 'WARNING'):
+            data, png = self.encode(
+                image, spec, target_kb=spec.target_kb,
+                on_budget_miss=lambda size, budget: misses.append((size, budget)),
+            )
+        self.assertEqual(png.size, spec.size)
+        self.assertEqual(misses, [(len(data), 20 * 1024)])
+        # Lossless: the pixels are the photo's own
+        self.assertIsNone(ImageChops.difference(png.convert('RGBA'), image).getbbox())
+
+    def test_few_colour_results_are_palettised_losslessly(self):
+        spec = OutputSpec(35, 45, target_kb=10)
+        image = Image.new('RGBA', spec.size, (255, 255, 255, 255))
+        image.paste((20, 40, 200, 255), (50, 50, 300, 400))
+        full = self.backend.encode(image.copy())
+        data, png = self.encode(image, spec, target_kb=spec.target_kb)
+        self.assertLessEqual(len(data), len(full))
+        self.assertEqual(png.size, spec.size)
+        self.assertIsNone(ImageChops.difference(png.convert('RGBA'), image).getbbox())
+
+    def test_budget_is_streamed_into_output(self):
+        spec = OutputSpec(35, 45, target_kb=150)
+        output = io.BytesIO()
+        self.assertIs(encode_png(posterized(spec.size), spec, output, backend=self.backend, target_kb=150), output)
+        self.assertLessEqual(len(output.getvalue()), 150 * 1024)
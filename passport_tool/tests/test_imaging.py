@@ -0,0 +1,175 @@
+import functools
+import io
+import unittest
+from unittest import mock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, override_settings
+from PIL import Image, ImageChops, ImageDraw, ImageEnhance, ImageFilter, ImageStat
+
+from passport_tool import imaging, tiling
+from passport_tool.engine import OutputSpec, process_image
+from passport_tool.imaging import PillowBackend
+
+try:
+    from passport_tool.imaging import VipsBackend
+    VipsBackend()
+except (ImportError, OSError):
+    VipsBackend = None
+
+@functools.lru_cache
+def _subject(size):
+    image = Image.merge('RGB', (
+        Image.linear_gradient('L').resize(size),
+        Image.linear_gradient('L').rotate(90).resize(size),
+        Image.effect_noise(size, 30).convert('L'),
+    )).convert('RGBA')
+    alpha = Image.new('L', size, 0)
+    ImageDraw.Draw(alpha).ellipse((size[0] // 5, size[1] // 8, size[0] * 4 // 5, size[1] * 7 // 8), fill=255)
+    image.putalpha(alpha)
+    return image
+
+
+def subject(size=(640, 800)):
+    """
+    RGBA test photo: gradients, noise and an elliptical alpha. The same
+    pixels on every call, so both backends get identical input.
+    """
+    return _subject(size).copy()
+
+
+class TilingParityTests(SimpleTestCase):
+    """
+    The tiled paths against the serial Pillow calls they replace, with
+    tiling forced on for these small images. Three and five workers give
+    uneven strips.
+    """
+    def setUp(self):
+        patcher = mock.patch.object(tiling, 'TILE_MIN_PIXELS', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertIdentical(self, tiled, serial):
+        self.assertEqual((tiled.mode, tiled.size), (serial.mode, serial.size))
+        self.assertEqual(tiled.tobytes(), serial.tobytes())
+
+    def test_tiling_is_forced_on(self):
+        self.assertTrue(tiling.should_tile(3, (8, 8)))
+        self.assertFalse(tiling.should_tile(1, (8, 8)))
+
+    def test_rgba_resize_is_premultiplied_like_pillow(self):
+        # Colour under transparent alpha must not bleed into the edges
+        for workers in (3, 5):
+            for size in ((413, 531), (211, 97), (1000, 1250), (640, 300)):
+                with self.subTest(workers=workers, size=size):
+                    self.assertIdentical(
+                        PillowBackend(workers=workers).resize(subject(), size),
+                        subject().resize(size, Image.Resampling.LANCZOS),
+                    )
+
+    def test_blur_halo_covers_the_kernel(self):
+        # Five strips of 160 rows: a radius of 20 reaches across strip edges
+        for radius in (2, 20):
+            with self.subTest(radius=radius):
+                serial = subject()
+                serial.putalpha(serial.getchannel('A').filter(ImageFilter.GaussianBlur(radius=radius)))
+                self.assertIdentical(PillowBackend(workers=5).blur_alpha(subject(), radius), serial)
+
+    def test_contrast_mean_is_the_global_mean(self):
+        image = subject((640, 1000))
+        expected = int(ImageStat.Stat(image.convert('L')).mean[0] + 0.5)
+        for workers in (1, 3, 5):
+            with self.subTest(workers=workers):
+                self.assertEqual(tiling.contrast_mean(image, workers), expected)
+
+    def test_enhance_matches_image_enhance(self):
+        for params in ({'brightness': 1.05, 'contrast': 1.10}, {'brightness': 0.9, 'contrast': 1.4, 'sharpness': 1.3}):
+            serial = subject()
+            for enhancer in (ImageEnhance.Brightness, ImageEnhance.Contrast, ImageEnhance.Sharpness):
+                factor = params.get(enhancer.__name__.lower(), 1.0)
+                if factor != 1.0:
+                    serial = enhancer(serial).enhance(factor)
+            for workers in (3, 5):
+                with self.subTest(workers=workers, **params):
+                    self.assertIdentical(PillowBackend(workers=workers).enhance(subject(), **params), serial)
+
+
+@unittest.skipIf(VipsBackend is None, "pyvips/libvips not installed")
+class VipsParityTests(SimpleTestCase):
+    def setUp(self):
+        self.pillow = PillowBackend(workers=1)
+        self.vips = VipsBackend()
+
+    def assertClose(self, pillow_image, vips_image):
+        """
+        Compares premultiplied pixels, i.e. what shows once composited: the
+        colour under (nearly) transparent alpha carries no weight.
+        """
+        vips_image = self.vips.to_pil(vips_image)
+        self.assertEqual(vips_image.size, pillow_image.size)
+        self.assertEqual(vips_image.mode, pillow_image.mode)
+        if pillow_image.mode == 'RGBA':
+            pillow_image, vips_image = pillow_image.convert('RGBa'), vips_image.convert('RGBa')
+        extrema = ImageChops.difference(pillow_image, vips_image).getextrema()
+        worst = max(high for _, high in extrema)
+        self.assertLessEqual(worst, VipsBackend.PARITY_LEVELS, f"max difference {worst} per band")
+
+    def test_decode(self):
+        buffer = io.BytesIO()
+        subject().save(buffer, format='PNG')
+        self.assertClose(self.pillow.decode(buffer.getvalue()), self.vips.decode(buffer.getvalue()))
+
+    def test_resize(self):
+        # Shrinking both ways, a large anisotropic shrink, and enlarging
+        for size in ((413, 531), (211, 97), (1000, 1250)):
+            with self.subTest(size=size):
+                self.assertClose(self.pillow.resize(subject(), size), self.vips.resize(subject(), size))
+
+    def test_enhance(self):
+        for params in ({'brightness': 1.05, 'contrast': 1.10}, {'brightness': 1.05, 'contrast': 1.4, 'sharpness': 1.3}):
+            with self.subTest(**params):
+                self.assertClose(self.pillow.enhance(subject(), **params), self.vips.enhance(subject(), **params))
+
+    def test_composite(self):
+        self.assertClose(
+            self.pillow.composite(subject((300, 360)), (413, 531), (56, 120)),
+            self.vips.composite(subject((300, 360)), (413, 531), (56, 120)),
+        )
+
+    def test_encoded_engine_output(self):
+        buffer = io.BytesIO()
+        subject().convert('RGB').save(buffer, format='JPEG', quality=95)
+        spec = OutputSpec(35, 45)
+        results = [
+            Image.open(io.BytesIO(process_image(buffer.getvalue(), spec, 'white', skip_bg=True, backend=backend)))
+            for backend in (self.pillow, self.vips)
+        ]
+        self.assertEqual(results[1].info.get('dpi'), results[0].info.get('dpi'))
+        self.assertClose(results[0], results[1])
+
+
+class GetBackendTests(SimpleTestCase):
+    def setUp(self):
+        imaging._instances.clear()
+        self.addCleanup(imaging._instances.clear)
+
+    @override_settings(IMAGING_BACKEND='pillow')
+    def test_configured_backend(self):
+        self.assertIsInstance(imaging.get_backend(), PillowBackend)
+
+    @override_settings(IMAGING_BACKEND='gimp')
+    def test_unknown_backend_is_an_error(self):
+        with self.assertRaises(ImproperlyConfigured):
+            imaging.get_backend()
+        self.assertEqual(len(imaging.check_backend()), 1)
+
+    def test_unavailable_backend_is_an_error_not_a_fallback(self):
+        class Missing(imaging.ImagingBackend):
+            def __init__(self):
+                raise ImportError("No module named 'pyvips'")
+
+        backends = {**imaging.BACKENDS, 'vips': Missing}
+        with mock.patch.dict(imaging.BACKENDS, backends), self.assertLogs('passport_tool.imaging', 'ERROR'):
+            with self.assertRaises(ImproperlyConfigured):
+                imaging.get_backend('vips')
+        self.assertNotIn('vips', imaging._instances)
@@ -0,0 +1,222 @@
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from multiprocessing import shared_memory
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+from PIL import Image
+
+from passport_tool import inference
+from passport_tool.inference import (
+    INPUT_SIZE, TENSOR_SHAPE, Batcher, BatchedSession, InferenceRequestHandler,
+    InferenceServer, SocketSession, get_inference_session, serve,
+)
+
+
+class FakeOnnxSession:
+    """Stands in for onnxruntime: the prediction is the first channel plus one."""
+    def __init__(self, batch_axis='batch', error=None):
+        self.batch_axis = batch_axis
+        self.error = error
+        self.batch_sizes = []
+
+    def get_inputs(self):
+        return [SimpleNamespace(name='input.1', shape=[self.batch_axis, 3, 320, 320])]
+
+    def run(self, output_names, feed):
+        tensors = feed['input.1']
+        self.batch_sizes.append(len(tensors))
+        if self.error:
+            raise self.error
+        return [tensors[:, :1, :, :] + 1]
+
+
+def fake_session(**kwargs):
+    return SimpleNamespace(model_name='u2net_human', inner_session=FakeOnnxSession(**kwargs))
+
+
+def tensor(value):
+    return np.full(TENSOR_SHAPE, value, dtype=np.float32)
+
+
+def photo(size):
+    return Image.linear_gradient('L').convert('RGB').resize(size)
+
+
+def submit_concurrently(batcher, values):
+    results = {}
+
+    def submit(value):
+        try:
+            results[value] = batcher.submit(tensor(value))
+        except Exception as e:
+            results[value] = e
+
+    threads = [threading.Thread(target=submit, args=(value,)) for value in values]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+class BatcherTests(SimpleTestCase):
+    def test_concurrent_submits_run_as_one_batch(self):
+        session = fake_session()
+        batcher = Batcher(session, window_ms=500)
+        results = submit_concurrently(batcher, [1, 2, 3, 4])
+        self.assertEqual(session.inner_session.batch_sizes, [4])
+        self.assertEqual((batcher.batches, batcher.batched_requests), (1, 4))
+        for value, pred in results.items():
+            self.assertEqual(pred.shape, INPUT_SIZE)
+            self.assertTrue(np.all(pred == value + 1))
+
+    def test_batches_are_capped_at_max_batch(self):
+        session = fake_session()
+        batcher = Batcher(session, window_ms=500, max_batch=2)
+        results = submit_concurrently(batcher, [1, 2, 3, 4])
+        self.assertEqual(session.inner_session.batch_sizes, [2, 2])
+        self.assertTrue(all(np.all(results[value] == value + 1) for value in results))
+
+    def test_a_lone_request_runs_when_the_window_closes(self):
+        session = fake_session()
+        batcher = Batcher(session, window_ms=50, max_batch=8)
+        started = time.monotonic()
+        pred = batcher.submit(tensor(7))
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(session.inner_session.batch_sizes, [1])
+        self.assertTrue(np.all(pred == 8))
+
+    def test_fixed_batch_models_run_back_to_back(self):
+        session = fake_session(batch_axis=1)
+        batcher = Batcher(session, window_ms=500)
+        results = submit_concurrently(batcher, [1, 2, 3])
+        self.assertEqual(session.inner_session.batch_sizes, [1, 1, 1])
+        self.assertEqual(batcher.batches, 1)
+        self.assertTrue(all(np.all(results[value] == value + 1) for value in results))
+
+    def test_a_failed_run_fails_every_request_in_the_batch(self):
+        session = fake_session(error=RuntimeError('onnx failed'))
+        batcher = Batcher(session, window_ms=500)
+        results = submit_concurrently(batcher, [1, 2])
+        self.assertEqual(session.inner_session.batch_sizes, [2])
+        for error in results.values():
+            self.assertIsInstance(error, RuntimeError)
+        self.assertEqual(batcher.batches, 0)
+
+        # The batcher thread survives the failure
+        session.inner_session.error = None
+        self.assertTrue(np.all(batcher.submit(tensor(1)) == 2))
+
+    def test_batched_session_predicts_a_mask_at_the_image_size(self):
+        batcher = Batcher(fake_session(), window_ms=0)
+        with mock.patch.object(inference, 'get_batcher', return_value=batcher):
+            masks = BatchedSession('u2net_human').predict(photo((64, 48)))
+        self.assertEqual(len(masks), 1)
+        self.assertEqual((masks[0].mode, masks[0].size), ('L', (64, 48)))
+
+
+class InferenceSessionTests(SimpleTestCase):
+    def session(self, mode, batchable=True):
+        with override_settings(INFERENCE_MODE=mode, INFERENCE_SOCKET='/tmp/test.sock'), \
+                mock.patch.object(inference, 'is_batchable', return_value=batchable), \
+                mock.patch('rembg.new_session', return_value='rembg session'):
+            return get_inference_session('u2net_human')
+
+    def test_modes(self):
+        self.assertEqual(self.session('local'), 'rembg session')
+        self.assertIsInstance(self.session('thread'), BatchedSession)
+        session = self.session('socket')
+        self.assertIsInstance(session, SocketSession)
+        self.assertEqual(session.path, '/tmp/test.sock')
+
+    def test_models_that_cannot_batch_stay_local(self):
+        self.assertEqual(self.session('socket', batchable=False), 'rembg session')
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            self.session('grpc')
+
+
+class SocketTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, 'inference.sock')
+
+    def start_server(self, batcher):
+        for patcher in (
+            mock.patch.object(inference, 'get_batcher', return_value=batcher),
+            # Client and server share this process's resource tracker, which
+            # must not forget the segment before the client unlinks it
+            mock.patch.object(inference, '_attach', lambda name: shared_memory.SharedMemory(name=name)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        server = InferenceServer(self.path, InferenceRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+    def test_round_trip_through_shared_memory(self):
+        session = fake_session()
+        self.start_server(Batcher(session, window_ms=0))
+        pred = SocketSession('u2net_human', self.path, timeout=5).infer(tensor(3))
+        self.assertEqual(pred.shape, INPUT_SIZE)
+        self.assertTrue(np.all(pred == 4))
+        self.assertEqual(session.inner_session.batch_sizes, [1])
+
+    def test_server_errors_are_raised_to_the_client(self):
+        self.start_server(Batcher(fake_session(error=RuntimeError('onnx failed')), window_ms=0))
+        with self.assertRaisesRegex(RuntimeError, 'onnx failed'), self.assertLogs('passport_tool.inference', 'ERROR'):
+            SocketSession('u2net_human', self.path, timeout=5).infer(tensor(3))
+
+    def test_unreachable_server_falls_back_to_a_local_session(self):
+        local = mock.Mock()
+        local.predict.return_value = ['local mask']
+        image = photo((32, 32))
+        with mock.patch('rembg.new_session', return_value=local), self.assertLogs('passport_tool.inference', 'WARNING'):
+            self.assertEqual(SocketSession('u2net_human', self.path).predict(image), ['local mask'])
+        local.predict.assert_called_once_with(image)
+
+    def test_serve_preloads_models_and_replaces_a_stale_socket(self):
+        open(self.path, 'w').close()
+        with mock.patch.object(inference, 'get_batcher') as get_batcher, \
+                mock.patch.object(InferenceServer, 'serve_forever'):
+            serve(self.path, preload=['u2net_human', 'u2netp'])
+        self.assertEqual([c.args for c in get_batcher.call_args_list], [('u2net_human',), ('u2netp',)])
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o660)
+
+    def test_silent_server_times_out_to_a_local_session(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(listener.close)
+        listener.bind(self.path)
+        listener.listen()
+        local = mock.Mock()
+        local.predict.return_value = ['local mask']
+        with mock.patch('rembg.new_session', return_value=local), self.assertLogs('passport_tool.inference', 'WARNING'):
+            masks = SocketSession('u2net_human', self.path, timeout=0.2).predict(photo((32, 32)))
+        self.assertEqual(masks, ['local mask'])
+
+
+class RunInferenceServerTests(SimpleTestCase):
+    @override_settings(INFERENCE_SOCKET='/tmp/default.sock')
+    def test_serves_on_the_configured_socket_with_the_default_models(self):
+        with mock.patch('passport_tool.management.commands.run_inference_server.serve') as serve:
+            call_command('run_inference_server', stdout=io.StringIO())
+        path, = serve.call_args.args
+        self.assertEqual(path, '/tmp/default.sock')
+        self.assertIn('u2net_human', serve.call_args.kwargs['preload'])
+
+    def test_socket_and_models_can_be_chosen(self):
+        with mock.patch('passport_tool.management.commands.run_inference_server.serve') as serve:
+            call_command('run_inference_server', socket='/tmp/other.sock', model=['u2netp'], stdout=io.StringIO())
+        serve.assert_called_once_with('/tmp/other.sock', preload=['u2netp'])
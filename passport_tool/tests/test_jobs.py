@@ -0,0 +1,55 @@
+import unittest
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+
+from passport_tool.jobs import RedisJobStore, get_job_store
+from passport_tool.models import CountryRule
+from .base import LocalRedisTestCase
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401  (fakeredis needs it for EVAL)
+except ImportError:
+    fakeredis = None
+
+
+@override_settings(JOB_STORE='redis')
+class RedisJobUpdateTests(LocalRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.rule = CountryRule.objects.create(
+            country='Testland', width_mm=35, height_mm=45,
+            meta_title='Testland', meta_description='Testland', content_body='Testland',
+        )
+
+    def create(self, store):
+        return store.create(self.rule, SimpleUploadedFile('photo.png', b'png', content_type='image/png'))
+
+    def assert_update_is_atomic(self, store):
+        job = self.create(store)
+        store.update(job, status='processing', error_message=None)
+        self.assertEqual(store.get(job.id).status, 'processing')
+        self.assertGreater(store.redis.ttl(f"job:{job.id}"), 0)
+        self.assertNotIn(job.id, store.redis.hgetall('jobs:pending'))
+
+        # The job expires between the task loading it and writing its status
+        store.redis.delete(f"job:{job.id}")
+        with self.assertRaises(LookupError):
+            store.update(job, status='completed')
+        self.assertFalse(store.redis.exists(f"job:{job.id}"))
+
+    def test_update_does_not_recreate_an_expired_job(self):
+        self.assert_update_is_atomic(get_job_store())
+
+    @unittest.skipIf(fakeredis is None, "fakeredis with Lua support not installed")
+    def test_update_script_on_redis(self):
+        server = fakeredis.FakeServer()
+        clients = {
+            False: fakeredis.FakeRedis(server=server, decode_responses=True),
+            True: fakeredis.FakeRedis(server=server),
+        }
+        with mock.patch('passport_tool.redis_client.get_redis', side_effect=lambda binary=False: clients[binary]):
+            store = RedisJobStore(3600)
+        self.assert_update_is_atomic(store)
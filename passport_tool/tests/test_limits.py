@@ -0,0 +1,94 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+
+from passport_tool import admission, limits, scheduler
+from passport_tool.cost import QUEUE_BULK, QUEUE_FAST
+from passport_tool.engine import QUALITY_ECONOMY
+from passport_tool.jobs import get_job_store
+from passport_tool.models import CountryRule
+from passport_tool.redis_client import get_redis
+from passport_tool.scheduler import FairScheduler
+from passport_tool.tasks import degrade, process_photo_task
+from .base import LocalRedisTestCase
+
+
+class BudgetTests(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(setattr, limits, '_rss_per_job', limits._rss_per_job)
+
+    def test_job_ceiling_is_below_the_recycle_threshold(self):
+        self.assertLess(settings.TASK_MAX_RSS_MB * 1024, settings.CELERY_WORKER_MAX_MEMORY_PER_CHILD)
+        self.assertEqual(limits.check_budgets(), [])
+        with override_settings(TASK_MAX_RSS_MB=480, CELERY_WORKER_MAX_MEMORY_PER_CHILD=440 * 1024):
+            self.assertEqual([warning.id for warning in limits.check_budgets()], ['passport_tool.W001'])
+
+    def test_rss_ceiling_only_holds_where_a_process_runs_one_job(self):
+        for pool, concurrency, enforced in (
+            ('prefork', 4, True), ('solo', 1, True), ('threads', 1, True), ('threads', 4, False),
+        ):
+            with self.subTest(pool=pool, concurrency=concurrency):
+                if enforced:
+                    limits.note_pool(SimpleNamespace(pool_cls=pool, concurrency=concurrency))
+                else:
+                    with self.assertLogs('passport_tool.limits', 'WARNING'):
+                        limits.note_pool(SimpleNamespace(pool_cls=pool, concurrency=concurrency))
+                check = limits.budget_checker()
+                with mock.patch('passport_tool.limits.rss_mb', return_value=settings.TASK_MAX_RSS_MB + 1):
+                    if enforced:
+                        self.assertRaises(limits.OverBudget, check)
+                    else:
+                        self.assertFalse(check())
+
+
+class DegradeTests(LocalRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sent = []
+        scheduler._scheduler = FairScheduler(
+            get_redis(), quantum_ms=1000, max_dispatched=10, max_inflight=2,
+            send=lambda job, queue: self.sent.append((job, queue)),
+        )
+        self.rule = CountryRule.objects.create(
+            country='Testland', width_mm=35, height_mm=45,
+            meta_title='Testland', meta_description='Testland', content_body='Testland',
+        )
+
+    def outstanding(self, queue):
+        redis = get_redis()
+        return int(redis.get(f"admission:{queue}:jobs") or 0), int(redis.get(f"admission:{queue}:ms") or 0)
+
+    def test_retry_is_scheduled_and_admitted_like_an_upload(self):
+        store = get_job_store()
+        job = store.create(self.rule, SimpleUploadedFile('photo.png', b'png'))
+        cost = SimpleNamespace(queue=QUEUE_FAST, mode='skip_bg', estimated_ms=800)
+        admission.admitted('first', cost, admission.assess(cost))
+        scheduler.submit(
+            process_photo_task, QUEUE_FAST, 'ip:198.51.100.1',
+            args=(job.id,), kwargs={'skip_bg': True}, cost_ms=800, task_id='first',
+        )
+        self.assertEqual(len(self.sent), 1)
+
+        with self.assertLogs('passport_tool.tasks', 'WARNING'):
+            self.assertEqual(degrade(store, job, {'skip_bg': True}, 'test', 'first'), limits.DEGRADED)
+        retry, queue = self.sent[1]
+        self.assertEqual(queue, QUEUE_BULK)
+        self.assertEqual(retry['kwargs']['quality'], QUALITY_ECONOMY)
+        self.assertEqual(retry['cost_ms'], 800)
+        self.assertEqual(store.get(job.id).task_id, retry['task_id'])
+        # Charged to the same client, while the original still holds its slot
+        self.assertEqual(scheduler._scheduler.client(retry['task_id']), 'ip:198.51.100.1')
+        self.assertEqual(self.outstanding(QUEUE_BULK)[0], 1)
+
+        # The original finishing (task_postrun) leaves only the retry counted
+        scheduler.release_finished_task(task_id='first')
+        admission.note_task_finish(task_id='first', retval=limits.DEGRADED)
+        self.assertEqual(self.outstanding(QUEUE_FAST), (0, 0))
+        self.assertEqual(self.outstanding(QUEUE_BULK)[0], 1)
+        scheduler.release_finished_task(task_id=retry['task_id'])
+        admission.note_task_finish(task_id=retry['task_id'])
+        self.assertEqual(self.outstanding(QUEUE_BULK), (0, 0))
+        self.assertEqual(get_redis().hgetall(f"sched:{QUEUE_BULK}:inflight"), {})
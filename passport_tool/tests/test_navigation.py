@@ -0,0 +1,85 @@
+import time
+
+from django.db import connection
+from django.template.loader import render_to_string
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from passport_tool import navigation
+from passport_tool.context_processors import country_rules
+from passport_tool.models import CountryRule, SiteSettings
+from passport_tool.redis_client import get_redis
+from .base import LocalRedisTestCase
+
+
+def create_rule(country, **fields):
+    return CountryRule.objects.create(
+        country=country, exam_country=country, width_mm=35, height_mm=45,
+        meta_title=country, meta_description=country, content_body=country, **fields,
+    )
+
+
+class NavigationCacheTests(LocalRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.rule = create_rule('Testland Passport')
+        create_rule('Testland Visa', is_exam=True, exam_organization='Visa')
+        # Its first load creates the row, which invalidates the nav once
+        SiteSettings.load()
+        self.addCleanup(setattr, navigation, '_cache', None)
+
+    def countries(self):
+        return [rule['country'] for rule in navigation.navigation()[0]['countries']]
+
+    def expire_check(self):
+        # As if CHECK_INTERVAL had passed since this process last looked
+        navigation._cache = {**navigation._cache, 'checked_at': time.monotonic() - navigation.CHECK_INTERVAL}
+
+    def test_warm_cache_renders_the_menus_without_queries(self):
+        request = RequestFactory().get('/about/')
+        country_rules(request)
+        with self.assertNumQueries(0):
+            html = render_to_string('about.html', {**country_rules(request), 'page_meta': None, 'request': request})
+        self.assertIn('Testland Passport', html)
+
+        # A page still looks up its own meta tags, and nothing for the menus
+        self.client.get('/about/', secure=True)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get('/about/', secure=True).status_code, 200)
+        tables = ' '.join(query['sql'] for query in queries).lower()
+        self.assertNotIn('countryrule', tables)
+        self.assertNotIn('sitesettings', tables)
+
+    def test_other_processes_reload_from_redis_without_queries(self):
+        self.countries()
+        # Another process: nothing cached locally, the nav shared in Redis
+        navigation._cache = None
+        with self.assertNumQueries(1):  # SiteSettings.load()
+            self.assertEqual(self.countries(), ['Testland Passport'])
+
+    def test_saving_a_rule_invalidates_both_caches(self):
+        self.countries()
+        version = int(get_redis().get(navigation.VERSION_KEY) or 0)
+        self.rule.country = 'Renamed Passport'
+        self.rule.save()
+        self.assertIsNone(navigation._cache)
+        self.assertEqual(int(get_redis().get(navigation.VERSION_KEY)), version + 1)
+        self.assertEqual(self.countries(), ['Renamed Passport'])
+
+    def test_deleting_a_rule_invalidates_both_caches(self):
+        self.countries()
+        version = int(get_redis().get(navigation.VERSION_KEY) or 0)
+        self.rule.delete()
+        self.assertIsNone(navigation._cache)
+        self.assertEqual(int(get_redis().get(navigation.VERSION_KEY)), version + 1)
+        self.assertEqual(self.countries(), [])
+
+    def test_other_processes_pick_up_a_change_at_their_next_check(self):
+        self.countries()
+        stale = navigation._cache
+        create_rule('Otherland Passport')
+        # This process was invalidated; another still holds the old menus
+        navigation._cache = stale
+        self.assertEqual(self.countries(), ['Testland Passport'])
+        self.expire_check()
+        self.assertEqual(self.countries(), ['Otherland Passport', 'Testland Passport'])
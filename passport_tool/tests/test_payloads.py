@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import tracemalloc
+
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.test import override_settings
+
+from passport_tool.jobs import get_job_store, ORIGINAL
+from passport_tool.models import CountryRule
+from passport_tool.payloads import DirectoryPayloadTransport, RedisPayloadTransport
+from .base import LocalRedisTestCase
+
+
+class PayloadTransportTests(LocalRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.transports = [
+            RedisPayloadTransport(chunk_bytes=1000),
+            DirectoryPayloadTransport(self.directory),
+        ]
+
+    def test_round_trips_bytes_and_chunk_streams(self):
+        random = os.urandom(4500)
+        text = b'passport photo ' * 600
+        for transport in self.transports:
+            for data in (random, text, b''):
+                with self.subTest(transport=type(transport).__name__, size=len(data)):
+                    transport.put('bytes', data, 60)
+                    self.assertEqual(transport.get('bytes'), data)
+                    transport.put('stream', (data[i:i + 700] for i in range(0, len(data), 700)), 60)
+                    self.assertEqual(transport.get('stream'), data)
+
+    def test_compresses_only_when_it_helps(self):
+        transport = self.transports[0]
+        transport.put('random', iter([os.urandom(3000)]), 60)
+        transport.put('text', iter([b'a' * 3000]), 60)
+        self.assertIn('"codec": "raw"', transport.redis.get('random'))
+        self.assertIn('"codec": "zlib"', transport.redis.get('text'))
+        self.assertIn('"size": 3000', transport.redis.get('text'))
+
+
+class UploadStreamingTests(LocalRedisTestCase):
+    @override_settings(PAYLOAD_TRANSPORT='directory', PAYLOAD_COMPRESS=False)
+    def test_original_is_streamed_from_the_upload_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        rule = CountryRule.objects.create(
+            country='Testland', width_mm=35, height_mm=45,
+            meta_title='Testland', meta_description='Testland', content_body='Testland',
+        )
+        size = 8 * 1024 * 1024
+        upload = TemporaryUploadedFile('photo.jpg', 'image/jpeg', size, None)
+        self.addCleanup(upload.close)
+        upload.write(os.urandom(size))
+        store = get_job_store()
+        with self.settings(PAYLOAD_DIR=directory):
+            tracemalloc.start()
+            try:
+                job = store.create(rule, upload)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(len(store.read_blob(job, ORIGINAL)), size)
+        # One upload chunk at a time, never the whole file
+        self.assertLess(peak, size / 10)
@@ -0,0 +1,99 @@
+import io
+import struct
+import zlib
+
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from PIL import Image
+
+from passport_tool.models import ProcessedPhoto
+from passport_tool.probe import ImageRejected, probe_image
+from .test_uploads import UploadTestCase
+
+
+def png_header(width, height):
+    """A PNG that only claims its size: IHDR and IEND, no pixel data."""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return io.BytesIO(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + chunk(b'IEND', b''))
+
+
+def encoded(image, fmt, **params):
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, **params)
+    buffer.seek(0)
+    return buffer
+
+
+class ProbeTests(SimpleTestCase):
+    def probe(self, upload, max_megapixels=50, max_frames=4):
+        return probe_image(upload, max_megapixels=max_megapixels, max_frames=max_frames)
+
+    def assertRejected(self, upload, status, **limits):
+        with self.assertRaises(ImageRejected) as rejected:
+            self.probe(upload, **limits)
+        self.assertEqual(rejected.exception.status, status)
+        # Left at the start for whoever reads it next
+        self.assertEqual(upload.tell(), 0)
+
+    def test_header_is_read_without_decoding(self):
+        # There are no pixels to decode: loading this image would fail
+        upload = png_header(6000, 4000)
+        info = self.probe(upload)
+        self.assertEqual((info.format, info.width, info.height, info.frames), ('PNG', 6000, 4000, 1))
+        self.assertEqual(info.megapixels, 24)
+        self.assertEqual(upload.tell(), 0)
+
+    def test_exif_orientation_swaps_the_display_size(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        for fmt in ('JPEG', 'PNG', 'WEBP'):
+            with self.subTest(fmt):
+                info = self.probe(encoded(Image.new('RGB', (40, 30)), fmt, exif=exif))
+                self.assertEqual((info.orientation, info.display_size), (6, (30, 40)))
+
+    def test_over_the_megapixel_cap(self):
+        self.assertRejected(png_header(8000, 7500), 'image_too_large')
+        self.assertEqual(self.probe(png_header(8000, 7500), max_megapixels=60).megapixels, 60)
+
+    def test_decompression_bomb(self):
+        # Past twice Image.MAX_IMAGE_PIXELS Pillow refuses to open it at all
+        self.assertRejected(png_header(20000, 20000), 'image_too_large', max_megapixels=1000)
+
+    def test_too_many_frames(self):
+        frames = [Image.new('RGB', (20, 20), (shade, 0, 0)) for shade in range(0, 250, 50)]
+        upload = encoded(frames[0], 'PNG', save_all=True, append_images=frames[1:])
+        self.assertRejected(upload, 'too_many_frames')
+        self.assertEqual(self.probe(upload, max_frames=5).frames, 5)
+
+    def test_unreadable_headers(self):
+        for name, data in (
+            ('truncated', png_header(100, 100).getvalue()[:20]),
+            ('bad magic', b'\x89PNG\r\n\x1a\n' + bytes(64)),
+            ('not an image', b'%PDF-1.7\n' + bytes(64)),
+        ):
+            with self.subTest(name):
+                self.assertRejected(io.BytesIO(data), 'invalid_image')
+
+
+class ProbeUploadTests(UploadTestCase):
+    def post(self, upload):
+        upload.name = 'photo.png'
+        response = self.client.post(
+            reverse('api_upload', args=[self.rule.slug]), {'photo': upload, 'skip_bg': 'true'}, secure=True,
+        )
+        self.assertFalse(ProcessedPhoto.objects.exists())
+        return response
+
+    @override_settings(MAX_UPLOAD_MEGAPIXELS=50)
+    def test_bomb_is_refused_before_a_job_exists(self):
+        response = self.post(png_header(20000, 20000))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['status'], 'image_too_large')
+
+    def test_unreadable_header_is_refused(self):
+        response = self.post(io.BytesIO(b'\x89PNG\r\n\x1a\n' + bytes(64)))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['status'], 'invalid_image')
@@ -0,0 +1,33 @@
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from passport_tool.proxies import client_ip
+from passport_tool.scheduler import client_key
+
+
+@override_settings(TRUSTED_PROXIES=['10.0.0.0/8', '127.0.0.1'])
+class ClientIpTests(SimpleTestCase):
+    def request(self, remote, forwarded=None):
+        headers = {'HTTP_X_FORWARDED_FOR': forwarded} if forwarded is not None else {}
+        return RequestFactory().get('/', REMOTE_ADDR=remote, **headers)
+
+    def test_direct_client(self):
+        self.assertEqual(client_ip(self.request('203.0.113.7')), '203.0.113.7')
+
+    def test_untrusted_peer_cannot_forward(self):
+        self.assertEqual(client_ip(self.request('203.0.113.7', '198.51.100.1')), '203.0.113.7')
+
+    def test_client_behind_the_edge(self):
+        self.assertEqual(client_ip(self.request('10.2.3.4', '198.51.100.1')), '198.51.100.1')
+        self.assertEqual(client_key(self.request('10.2.3.4', '198.51.100.1')), 'ip:198.51.100.1')
+
+    def test_spoofed_entries_left_of_the_edge_are_ignored(self):
+        request = self.request('10.2.3.4', '1.2.3.4, 198.51.100.1, 10.9.9.9')
+        self.assertEqual(client_ip(request), '198.51.100.1')
+
+    def test_garbage_stops_at_the_last_trusted_hop(self):
+        self.assertEqual(client_ip(self.request('10.2.3.4', 'not-an-ip')), '10.2.3.4')
+        self.assertEqual(client_ip(self.request('10.2.3.4')), '10.2.3.4')
+
+    def test_visitors_behind_one_proxy_get_their_own_keys(self):
+        keys = {client_key(self.request('10.2.3.4', f"198.51.100.{n}")) for n in range(5)}
+        self.assertEqual(len(keys), 5)
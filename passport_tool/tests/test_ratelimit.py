@@ -0,0 +1,61 @@
+import unittest
+from unittest import mock
+
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+
+from passport_tool.ratelimit import LocalTokenBucket, RedisTokenBucket, rate_limit
+from .base import LocalRedisTestCase
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401  (fakeredis needs it for EVAL)
+except ImportError:
+    fakeredis = None
+
+
+@rate_limit('upload', methods=('POST',))
+async def async_view(request):
+    return HttpResponse('ok')
+
+
+@rate_limit('upload', methods=('POST',))
+def sync_view(request):
+    return HttpResponse('ok')
+
+
+@override_settings(RATE_LIMITS={'upload': (2, 1800)}, TRUSTED_PROXIES=['10.0.0.0/8'])
+class RateLimitTests(LocalRedisTestCase):
+    def post(self, view, forwarded_for):
+        request = RequestFactory().post('/', REMOTE_ADDR='10.0.0.5', HTTP_X_FORWARDED_FOR=forwarded_for)
+        if iscoroutinefunction(view):
+            return async_to_sync(view)(request)
+        return view(request)
+
+    def test_limits_each_client_behind_the_proxy_separately(self):
+        for view in (async_view, sync_view):
+            with self.subTest(view=view.__name__):
+                host = '198.51.100.1' if view is async_view else '198.51.100.2'
+                self.assertEqual(self.post(view, host).status_code, 200)
+                self.assertEqual(self.post(view, host).status_code, 200)
+                limited = self.post(view, host)
+                self.assertEqual(limited.status_code, 429)
+                self.assertGreater(int(limited['Retry-After']), 0)
+                # Another visitor arriving through the same proxy is unaffected
+                self.assertEqual(self.post(view, '203.0.113.9').status_code, 200)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis with Lua support not installed")
+class RedisTokenBucketTests(LocalRedisTestCase):
+    def test_sync_and_async_share_the_bucket(self):
+        server = fakeredis.FakeServer()
+        bucket = RedisTokenBucket(fakeredis.FakeRedis(server=server, decode_responses=True), LocalTokenBucket())
+        async_client = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+        with mock.patch('passport_tool.redis_client.get_async_redis', return_value=async_client):
+            self.assertTrue(bucket.hit('ratelimit:test', 3, 0.001).allowed)
+            self.assertTrue(async_to_sync(bucket.ahit)('ratelimit:test', 3, 0.001).allowed)
+            self.assertTrue(async_to_sync(bucket.ahit)('ratelimit:test', 3, 0.001).allowed)
+            result = bucket.hit('ratelimit:test', 3, 0.001)
+        self.assertFalse(result.allowed)
+        self.assertGreater(result.retry_after, 0)
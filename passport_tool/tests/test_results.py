@@ -0,0 +1,114 @@
+import io
+import tracemalloc
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from PIL import Image, ImageFile
+
+from passport_tool import liveness
+from passport_tool.engine import OutputSpec, process_image
+from passport_tool.imaging import PillowBackend
+from passport_tool.jobs import get_job_store, RESULT
+from passport_tool.models import CountryRule
+from passport_tool.tasks import process_photo_task
+from .base import LocalRedisTestCase
+
+
+def noise_jpeg(size):
+    """A JPEG of random pixels: small to upload, large once PNG-encoded."""
+    buffer = io.BytesIO()
+    Image.effect_noise(size, 100).convert('RGB').save(buffer, format='JPEG', quality=40)
+    return buffer.getvalue()
+
+
+class ResultEncodingTests(LocalRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.rule = CountryRule.objects.create(
+            country='Testland', width_mm=35, height_mm=45,
+            meta_title='Testland', meta_description='Testland', content_body='Testland',
+        )
+
+    def process(self):
+        store = get_job_store()
+        upload = SimpleUploadedFile('photo.jpg', noise_jpeg((1600, 1600)), content_type='image/jpeg')
+        job = store.create(self.rule, upload)
+        liveness.beat(job.id)
+        tracemalloc.start()
+        try:
+            self.assertIs(process_photo_task.run(job.id, skip_bg=True, use_original_dimensions=True), True)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        job = store.get(job.id)
+        self.assertEqual(job.status, 'completed')
+        return store.read_blob(job, RESULT), peak
+
+    # LocalRedis keeps stored blobs in Python memory, which tracemalloc counts
+    @override_settings(JOB_STORE='database')
+    def test_result_is_encoded_into_storage_without_buffering(self):
+        # The old path held the PNG in a BytesIO and a copy of it from
+        # getvalue(): at least twice its size in Python allocations
+        result, peak = self.process()
+        with Image.open(io.BytesIO(result)) as image:
+            self.assertEqual(image.size, (1600, 1600))
+        self.assertGreater(len(result), 4 * 1024 * 1024)
+        self.assertLess(peak, len(result) / 10)
+
+    @override_settings(JOB_STORE='redis')
+    def test_redis_store_appends_the_result_in_pieces(self):
+        result, _ = self.process()
+        with Image.open(io.BytesIO(result)) as image:
+            self.assertEqual(image.size, (1600, 1600))
+
+
+class FullFrameBufferTests(SimpleTestCase):
+    """
+    Counts the images allocated at the upload's full size while one photo is
+    processed. tracemalloc does not see Pillow's C buffers, so every new
+    image (Image._new) and decoded file (ImageFile.load) is recorded by mode.
+    """
+    size = (1600, 1200)
+
+    def full_frames(self, **options):
+        modes = []
+        new, load = Image.Image._new, ImageFile.ImageFile.load
+
+        def counting_new(image, im):
+            out = new(image, im)
+            if out.size == self.size:
+                modes.append(out.mode)
+            return out
+
+        def counting_load(image):
+            decoding = image._im is None
+            pixels = load(image)
+            if decoding and image.size == self.size:
+                modes.append(image.mode)
+            return pixels
+
+        buffer = io.BytesIO()
+        Image.effect_noise(self.size, 60).convert('RGB').save(buffer, format='JPEG', quality=60)
+        with mock.patch.object(Image.Image, '_new', counting_new), \
+                mock.patch.object(ImageFile.ImageFile, 'load', counting_load):
+            process_image(buffer.getvalue(), OutputSpec(35, 45), '#ffffff', backend=PillowBackend(), **options)
+        return modes
+
+    def test_skip_bg(self):
+        # Decode, RGBA, the premultiplied proxy resize, then one buffer per
+        # brightness and contrast table and the composited canvas
+        self.assertEqual(self.full_frames(skip_bg=True), ['RGB', 'RGBA', 'RGBa', 'RGBA', 'RGBA', 'RGBA'])
+
+    def test_segmentation(self):
+        # rembg stands in with a single full-size matte, so only the engine's
+        # own buffers are counted
+        def remove(image, **kwargs):
+            return Image.new('L', image.size, 255)
+
+        with mock.patch('passport_tool.engine.get_session'), mock.patch('rembg.remove', remove):
+            modes = self.full_frames()
+        # Decode, RGBA, the proxy resize, the matte, the blurred alpha band
+        # (getchannel and filter), then the premultiplied resize into the
+        # output canvas
+        self.assertEqual(modes, ['RGB', 'RGBA', 'RGBa', 'L', 'L', 'L', 'RGBa'])
@@ -0,0 +1,90 @@
+from django.test import SimpleTestCase
+
+from passport_tool.redis_client import LocalRedis
+from passport_tool.scheduler import FairScheduler
+
+QUEUE = 'fast'
+
+
+class FairSchedulerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.redis = LocalRedis()
+        self.sent = []
+
+    def scheduler(self, redis=None, max_dispatched=1, max_inflight=2):
+        return FairScheduler(
+            redis or self.redis, quantum_ms=1000, max_dispatched=max_dispatched,
+            max_inflight=max_inflight, send=lambda job, queue: self.sent.append(job),
+        )
+
+    def submit(self, scheduler, client, name, cost_ms=500):
+        return scheduler.submit(QUEUE, client, 'task', args=[name], cost_ms=cost_ms)
+
+    def run_all(self, scheduler):
+        """Finishes dispatched tasks one at a time; returns job names in dispatch order."""
+        finished = 0
+        while finished < len(self.sent):
+            scheduler.finish(self.sent[finished]['task_id'])
+            finished += 1
+        return [job['args'][0] for job in self.sent]
+
+
+class FairnessTests(FairSchedulerTestCase):
+    def test_steady_client_is_not_stuck_behind_a_burst(self):
+        scheduler = self.scheduler()
+        for index in range(20):
+            self.submit(scheduler, 'ip:burst', f"burst-{index}")
+        self.submit(scheduler, 'ip:steady', 'steady-0')
+        self.submit(scheduler, 'ip:steady', 'steady-1')
+        order = self.run_all(scheduler)
+        self.assertEqual(len(order), 22)
+        # Interleaved: each client gets a quantum's worth (two jobs) per turn
+        self.assertLessEqual(order.index('steady-0'), 3)
+        self.assertLessEqual(order.index('steady-1'), 5)
+        self.assertEqual([name for name in order if name.startswith('burst')], [f"burst-{i}" for i in range(20)])
+
+    def test_per_client_inflight_cap(self):
+        scheduler = self.scheduler(max_dispatched=10, max_inflight=2)
+        for index in range(5):
+            self.submit(scheduler, 'ip:burst', f"burst-{index}")
+        self.assertEqual(len(self.sent), 2)
+        self.run_all(scheduler)
+        self.assertEqual(len(self.sent), 5)
+
+
+class RetiringClientRace(LocalRedis):
+    """
+    LocalRedis that, once the dispatcher finds a client's backlog empty,
+    lets another web process submit a job for that client before the
+    dispatcher goes on to retire it.
+    """
+
+    def __init__(self, on_empty_backlog):
+        super().__init__()
+        self.on_empty_backlog = on_empty_backlog
+
+    def lindex(self, name, index):
+        head = super().lindex(name, index)
+        if head is None and name.endswith(':jobs:ip:a') and self.on_empty_backlog:
+            callback, self.on_empty_backlog = self.on_empty_backlog, None
+            callback()
+        return head
+
+
+class SubmitRaceTests(FairSchedulerTestCase):
+    def test_job_submitted_while_its_client_is_retired_is_dispatched(self):
+        self.redis = RetiringClientRace(lambda: self.submit(other, 'ip:a', 'second'))
+        scheduler = self.scheduler(max_dispatched=4)
+        other = self.scheduler()
+        self.submit(scheduler, 'ip:a', 'first')
+        self.assertEqual([job['args'][0] for job in self.sent], ['first', 'second'])
+        self.assertEqual(self.redis.llen(f"sched:{QUEUE}:jobs:ip:a"), 0)
+
+    def test_client_stays_on_the_ring_while_it_has_work(self):
+        scheduler = self.scheduler(max_dispatched=1)
+        self.submit(scheduler, 'ip:a', 'first')
+        self.submit(scheduler, 'ip:a', 'second')
+        self.assertEqual(self.redis.lrange(f"sched:{QUEUE}:ring", 0, -1), ['ip:a'])
+        self.assertEqual(self.run_all(scheduler), ['first', 'second'])
+        self.assertEqual(self.redis.llen(f"sched:{QUEUE}:ring"), 0)
+        self.assertIsNone(self.redis.hget(f"sched:{QUEUE}:deficit", 'ip:a'))
@@ -0,0 +1,519 @@
+import hashlib
+import io
+import math
+from unittest import mock
+
+from asgiref import sync
+from asgiref.sync import async_to_sync
+from django.core.files.uploadhandler import StopUpload
+from django.test import Client, RequestFactory, SimpleTestCase, override_settings
+from django.urls import reverse
+from PIL import Image
+
+from passport_tool import admission, cost
+from passport_tool.delivery import result_url, sign
+from passport_tool.jobs import JobStore, PREVIEW, RESULT, get_job_store
+from passport_tool.redis_client import get_redis
+from passport_tool.uploads import PhotoUploadHandler, sniff_format
+from passport_tool.models import ApiClient, CountryRule, ProcessedPhoto
+from passport_tool.views import _stream_payload
+from .base import LocalRedisTestCase
+
+
+def png_upload(size=(300, 400), name='photo.png'):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (180, 120, 90)).save(buffer, format='PNG')
+    buffer.seek(0)
+    buffer.name = name
+    return buffer
+
+
+class UploadTestCase(LocalRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.rule = CountryRule.objects.create(
+            country='Testland', slug='testland-passport-photo', width_mm=35, height_mm=45,
+            meta_title='Testland', meta_description='Testland', content_body='Testland',
+        )
+
+    def upload(self, **data):
+        return self.client.post(
+            reverse('api_upload', args=[self.rule.slug]),
+            {'photo': png_upload(), 'skip_bg': 'true', **data},
+            secure=True,
+        )
+
+
+@override_settings(INLINE_MAX_MS=10_000)
+class InlineUploadTests(UploadTestCase):
+    def test_inline_result_is_delivered_by_signed_url(self):
+        response = self.upload()
+        self.assertEqual(response.status_code, 200)
+        payload = response.json()
+        self.assertEqual(payload['status'], 'completed')
+        self.assertFalse(payload['processed_url'].startswith('data:'))
+        self.assertIn('token=', payload['processed_url'])
+
+        result = self.client.get(payload['processed_url'], secure=True)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result['Content-Type'], 'image/png')
+        with Image.open(io.BytesIO(b''.join(result.streaming_content))) as image:
+            # skip_bg keeps the upload's own dimensions
+            self.assertEqual(image.size, (300, 400))
+
+        status = self.client.get(reverse('api_status', args=[payload['photo_id']]), secure=True).json()
+        self.assertEqual(status['status'], 'completed')
+
+    def test_converter_tool_is_transcoded_by_the_conversion_engine(self):
+        self.rule = CountryRule.objects.create(
+            country='PNG to JPG', slug='png-to-jpg', width_mm=35, height_mm=45, is_tool=True,
+            meta_title='PNG to JPG', meta_description='PNG to JPG', content_body='PNG to JPG',
+        )
+        with mock.patch('passport_tool.tasks.process_image') as process_image:
+            payload = self.upload(use_original_dimensions='true').json()
+        process_image.assert_not_called()
+        self.assertEqual(payload['content_type'], 'image/jpeg')
+        result = self.client.get(payload['processed_url'], secure=True)
+        with Image.open(io.BytesIO(b''.join(result.streaming_content))) as image:
+            self.assertEqual((image.format, image.size), ('JPEG', (300, 400)))
+
+    @override_settings(INLINE_CONCURRENCY=2)
+    def test_inline_concurrency_is_configurable(self):
+        cost._inline_slot = None
+        self.addCleanup(setattr, cost, '_inline_slot', None)
+        self.assertTrue(cost.acquire_inline_slot())
+        self.assertTrue(cost.acquire_inline_slot())
+        self.assertFalse(cost.acquire_inline_slot())
+        cost.release_inline_slot()
+        self.assertTrue(cost.acquire_inline_slot())
+        cost.release_inline_slot()
+        cost.release_inline_slot()
+
+
+@override_settings(INLINE_MAX_MS=10_000)
+class JobOwnershipTests(UploadTestCase):
+    def status(self, client, photo_id, **headers):
+        return client.get(reverse('api_status', args=[photo_id]), secure=True, headers=headers)
+
+    def stream(self, client, photo_id, **headers):
+        return client.get(reverse('api_stream', args=[photo_id]), secure=True, headers=headers)
+
+    def assert_only_owner_answered(self, photo_id, owner_headers=None):
+        owner_headers = owner_headers or {}
+        self.assertEqual(self.status(self.client, photo_id, **owner_headers).status_code, 200)
+        self.assertEqual(self.stream(self.client, photo_id, **owner_headers).status_code, 200)
+        stranger = Client()
+        self.assertEqual(self.status(stranger, photo_id).status_code, 404)
+        self.assertEqual(self.stream(stranger, photo_id).status_code, 404)
+
+    def test_other_sessions_cannot_see_a_job(self):
+        photo_id = self.upload().json()['photo_id']
+        self.assert_only_owner_answered(photo_id)
+
+    @override_settings(JOB_STORE='redis')
+    def test_other_sessions_cannot_see_a_redis_job(self):
+        photo_id = self.upload().json()['photo_id']
+        self.assert_only_owner_answered(photo_id)
+
+    def test_jobs_of_an_api_client_need_its_key(self):
+        api_client = ApiClient.objects.create(name='Integrator')
+        other = ApiClient.objects.create(name='Other')
+        photo_id = self.client.post(
+            reverse('api_upload', args=[self.rule.slug]),
+            {'photo': png_upload(), 'skip_bg': 'true'},
+            secure=True, headers={'X-API-Key': api_client.key},
+        ).json()['photo_id']
+        self.assert_only_owner_answered(photo_id, {'X-API-Key': api_client.key})
+        self.assertEqual(self.status(Client(), photo_id, **{'X-API-Key': other.key}).status_code, 404)
+        # Nor does the browser session that happened to send the request
+        self.assertEqual(self.status(self.client, photo_id).status_code, 404)
+
+
+@override_settings(INLINE_MAX_MS=10_000)
+class DownloadTests(UploadTestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = self.upload().json()['processed_url']
+        store = get_job_store()
+        self.data = store.read_blob(store.get(self.url.split('/')[-2]), RESULT)
+        # The response reads the store as it is sent, never the whole blob
+        patcher = mock.patch.object(JobStore, 'read_blob', side_effect=AssertionError('blob loaded whole'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def download(self, **headers):
+        return self.client.get(self.url, secure=True, headers=headers)
+
+    def test_whole_result(self):
+        response = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(int(response['Content-Length']), len(self.data))
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+
+    def test_byte_range(self):
+        response = self.download(Range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.data)}')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(b''.join(response.streaming_content), self.data[10:20])
+
+    def test_suffix_and_open_ended_ranges(self):
+        self.assertEqual(b''.join(self.download(Range='bytes=-7').streaming_content), self.data[-7:])
+        self.assertEqual(b''.join(self.download(Range='bytes=100-').streaming_content), self.data[100:])
+
+    def test_unsatisfiable_range(self):
+        response = self.download(Range=f'bytes={len(self.data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.data)}')
+
+    def test_missing_result(self):
+        store = get_job_store()
+        store.delete_blob(store.get(self.url.split('/')[-2]), RESULT)
+        self.assertEqual(self.download().status_code, 410)
+
+
+@override_settings(JOB_STORE='redis')
+class RedisDownloadTests(DownloadTests):
+    pass
+
+
+@override_settings(INLINE_MAX_MS=10_000)
+class PreviewDeliveryTests(UploadTestCase):
+    def setUp(self):
+        super().setUp()
+        self.photo_id = self.upload().json()['photo_id']
+        store = get_job_store()
+        job = store.get(self.photo_id)
+        self.preview = png_upload((30, 40)).getvalue()
+        store.put_blob(job, PREVIEW, self.preview)
+        store.update(job, status='preview')
+
+    def test_status_sends_a_signed_preview_url(self):
+        payload = self.client.get(reverse('api_status', args=[self.photo_id]), secure=True).json()
+        self.assertEqual(payload['phase'], 'preview')
+        url = payload['preview_url']
+        self.assertFalse(url.startswith('data:'))
+        self.assertIn('kind=preview', url)
+
+        response = self.client.get(url, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(b''.join(response.streaming_content), self.preview)
+
+        seen = self.client.get(reverse('api_status', args=[self.photo_id]), {'preview': 'seen'}, secure=True).json()
+        self.assertNotIn('preview_url', seen)
+
+    def test_progress_events_carry_the_preview_url(self):
+        event = async_to_sync(_stream_payload)(get_job_store(), self.photo_id, {'stage': 'preview'})
+        self.assertEqual(event['preview_url'], result_url(self.photo_id, PREVIEW))
+
+    def test_preview_and_result_tokens_are_not_interchangeable(self):
+        preview_token = sign(self.photo_id, PREVIEW)
+        url = reverse('api_result', args=[self.photo_id])
+        self.assertEqual(self.client.get(url, {'token': preview_token}, secure=True).status_code, 403)
+        self.assertEqual(self.client.get(url, {'token': sign(self.photo_id), 'kind': 'preview'}, secure=True).status_code, 403)
+        self.assertEqual(self.client.get(url, {'token': preview_token, 'kind': 'original'}, secure=True).status_code, 404)
+
+    def test_preview_is_gone_once_the_result_replaces_it(self):
+        store = get_job_store()
+        store.delete_blob(store.get(self.photo_id), PREVIEW)
+        self.assertEqual(self.client.get(result_url(self.photo_id, PREVIEW), secure=True).status_code, 410)
+
+
+@override_settings(INLINE_MAX_MS=0)
+class QueuedUploadTests(UploadTestCase):
+    def test_failed_submit_takes_the_job_back_off_the_queue(self):
+        redis = get_redis()
+        with mock.patch('passport_tool.scheduler.asubmit', side_effect=ConnectionError('broker down')):
+            with self.assertRaises(ConnectionError):
+                self.upload()
+        for queue in ('fast', 'bulk', 'segmentation'):
+            self.assertEqual(int(redis.get(f"admission:{queue}:jobs") or 0), 0)
+            self.assertEqual(int(redis.get(f"admission:{queue}:ms") or 0), 0)
+        self.assertFalse(ProcessedPhoto.objects.exists())
+
+    def queue_upload(self):
+        """Uploads with Celery stubbed out; returns the response and the tasks sent."""
+        with mock.patch('passport_tool.scheduler.FairScheduler._send_to_celery') as send:
+            response = self.upload()
+        self.assertEqual(response.status_code, 200)
+        return response.json(), [job for (job, queue), _ in send.call_args_list]
+
+    def test_upload_is_queued_from_the_event_loop(self):
+        offloaded = []
+        real_sync_to_async = sync.sync_to_async
+
+        def recording_sync_to_async(func, *args, **kwargs):
+            offloaded.append(getattr(func, '__name__', repr(func)))
+            return real_sync_to_async(func, *args, **kwargs)
+
+        with mock.patch.object(sync, 'sync_to_async', recording_sync_to_async):
+            payload, sent = self.queue_upload()
+        # Parsing and probing the received file, writing the original to the
+        # payload store and the Celery publish; admission, dedup and the job
+        # itself go through redis.asyncio and the async ORM
+        self.assertEqual(sorted(offloaded), ['<lambda>', '_store_original', 'dispatch', 'probe_image'])
+
+        self.assertEqual([job['task_id'] for job in sent], [payload['task_id']])
+        job = get_job_store().get(payload['photo_id'])
+        self.assertEqual((job.status, job.task_id), ('pending', payload['task_id']))
+        self.assertEqual(job.owner, self.client.session.session_key)
+
+    @override_settings(JOB_STORE='redis')
+    def test_upload_is_queued_into_the_redis_store(self):
+        payload, sent = self.queue_upload()
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(get_job_store().get(payload['photo_id']).task_id, payload['task_id'])
+
+
+class JobCostTests(SimpleTestCase):
+    def rule(self, is_tool=False):
+        return CountryRule(slug='rule', is_tool=is_tool)
+
+    def test_modes(self):
+        self.assertEqual(cost.job_mode(self.rule(), is_signature=True, skip_bg=True), 'signature')
+        self.assertEqual(cost.job_mode(self.rule(is_tool=True), skip_bg=True), 'conversion')
+        self.assertEqual(cost.job_mode(self.rule(), skip_bg=True, convert=True), 'conversion')
+        self.assertEqual(cost.job_mode(self.rule(), skip_bg=True, use_original_dimensions=True), 'original')
+        self.assertEqual(cost.job_mode(self.rule(), skip_bg=True), 'skip_bg')
+        self.assertEqual(cost.job_mode(self.rule()), 'human')
+
+    @override_settings(FAST_QUEUE_MAX_MS=2000)
+    def test_queue_follows_the_estimate(self):
+        self.assertEqual(cost.JobCost('conversion', 12, 0).queue, 'fast')
+        self.assertEqual(cost.JobCost('skip_bg', 6, 0).queue, 'fast')
+        # 40ms + 270ms per MP passes 2000ms at about 7.3 MP
+        self.assertEqual(cost.JobCost('skip_bg', 8, 0).queue, 'bulk')
+        self.assertEqual(cost.JobCost('human', 0.1, 0).queue, 'segmentation')
+
+    def test_unreadable_headers_are_priced_as_twelve_megapixels(self):
+        self.assertEqual(cost.JobCost('skip_bg', None, 0).estimated_ms, cost.JobCost('skip_bg', 12, 0).estimated_ms)
+        self.assertFalse(cost.JobCost('skip_bg', None, 0).inline)
+
+
+@override_settings(INLINE_MAX_MS=0)
+class CostRoutingTests(UploadTestCase):
+    def routed(self, **data):
+        """Uploads with Celery stubbed out; returns (task name, queue) sent."""
+        with mock.patch('passport_tool.scheduler.FairScheduler._send_to_celery') as send:
+            self.assertEqual(self.upload(**data).status_code, 200)
+        (job, queue), _ = send.call_args
+        return job['task'].rsplit('.', 1)[-1], queue
+
+    def test_cheap_jobs_go_to_the_fast_queue(self):
+        self.assertEqual(self.routed(), ('process_photo_task', 'fast'))
+
+    def test_conversions_go_to_the_fast_queue(self):
+        self.assertEqual(self.routed(mode='convert'), ('convert_photo_task', 'fast'))
+
+    @override_settings(FAST_QUEUE_MAX_MS=50)
+    def test_expensive_jobs_go_to_the_bulk_queue(self):
+        self.assertEqual(self.routed(), ('process_photo_task', 'bulk'))
+
+    def test_background_removal_goes_to_the_segmentation_queue(self):
+        self.assertEqual(self.routed(skip_bg='false'), ('process_photo_task', 'segmentation'))
+        self.assertEqual(int(get_redis().get('admission:segmentation:jobs')), 1)
+        self.assertIsNone(get_redis().get('admission:fast:jobs'))
+
+
+# ProcessedPhoto rows are the database store's jobs
+@override_settings(INLINE_MAX_MS=0, JOB_STORE='database')
+class DeduplicationTests(UploadTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('passport_tool.scheduler.FairScheduler._send_to_celery')
+        self.send = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, client, **headers):
+        response = client.post(
+            reverse('api_upload', args=[self.rule.slug]),
+            {'photo': png_upload(), 'skip_bg': 'true'},
+            secure=True, headers=headers,
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_double_submit_attaches_to_the_running_job(self):
+        first = self.post(self.client)
+        second = self.post(self.client)
+        self.assertTrue(second['deduplicated'])
+        self.assertEqual((second['photo_id'], second['task_id']), (first['photo_id'], first['task_id']))
+        self.assertEqual(ProcessedPhoto.objects.count(), 1)
+        self.assertEqual(self.send.call_count, 1)
+        self.assertEqual(get_redis().get(f"flight:subscribers:{first['photo_id']}"), '1')
+
+    def test_identical_uploads_from_two_sessions_are_separate_jobs(self):
+        first = self.post(self.client)
+        second = self.post(Client())
+        self.assertNotIn('deduplicated', second)
+        self.assertNotEqual(first['photo_id'], second['photo_id'])
+        self.assertEqual(ProcessedPhoto.objects.count(), 2)
+        self.assertEqual(self.send.call_count, 2)
+
+    def test_identical_uploads_from_two_api_clients_are_separate_jobs(self):
+        keys = [ApiClient.objects.create(name=name).key for name in ('One', 'Two')]
+        first = self.post(Client(), **{'X-API-Key': keys[0]})
+        second = self.post(Client(), **{'X-API-Key': keys[1]})
+        self.assertNotIn('deduplicated', second)
+        self.assertNotEqual(first['photo_id'], second['photo_id'])
+        self.assertEqual(self.send.call_count, 2)
+        # The same client resubmitting still attaches
+        self.assertTrue(self.post(Client(), **{'X-API-Key': keys[0]})['deduplicated'])
+        self.assertEqual(ProcessedPhoto.objects.count(), 2)
+
+    def test_different_parameters_are_separate_jobs(self):
+        self.post(self.client)
+        response = self.client.post(
+            reverse('api_upload', args=[self.rule.slug]),
+            {'photo': png_upload(), 'skip_bg': 'true', 'use_original_dimensions': 'true'},
+            secure=True,
+        ).json()
+        self.assertNotIn('deduplicated', response)
+        self.assertEqual(self.send.call_count, 2)
+
+
+@override_settings(INLINE_MAX_MS=0, QUEUE_CONCURRENCY={'fast': 2, 'bulk': 1, 'segmentation': 1}, ADMISSION_SLO_SECONDS=10)
+class AdmissionTests(UploadTestCase):
+    # png_upload(): 300x400, a skip_bg job for the fast queue
+    estimated_ms = cost.COST_MODEL['skip_bg'][0] + cost.COST_MODEL['skip_bg'][1] * 0.12
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('passport_tool.scheduler.FairScheduler._send_to_celery')
+        self.send = patcher.start()
+        self.addCleanup(patcher.stop)
+        # skip_bg jobs have been taking twice their estimate
+        admission.record_service('skip_bg', 1000, 2000)
+
+    def backlog(self, jobs, ms):
+        redis = get_redis()
+        redis.set('admission:fast:jobs', jobs)
+        redis.set('admission:fast:ms', ms)
+
+    def test_accepted_upload_gets_its_eta_and_queue_position(self):
+        self.backlog(3, 6000)
+        response = self.upload()
+        self.assertEqual(response.status_code, 200)
+        payload = response.json()
+        # Three jobs ahead over two workers, then its own corrected time
+        self.assertEqual(payload['queue_position'], 4)
+        self.assertEqual(payload['eta_seconds'], round((6000 / 2 + 2 * self.estimated_ms) / 1000, 1))
+        redis = get_redis()
+        self.assertEqual(int(redis.get('admission:fast:jobs')), 4)
+        self.assertEqual(int(redis.get('admission:fast:ms')), 6000 + int(2 * self.estimated_ms))
+        self.assertEqual(self.send.call_count, 1)
+
+    def test_upload_past_the_slo_is_refused_with_retry_after(self):
+        self.backlog(20, 40000)
+        response = self.upload()
+        self.assertEqual(response.status_code, 503)
+        eta = round((40000 / 2 + 2 * self.estimated_ms) / 1000, 1)
+        retry_after = math.ceil(eta - 10)
+        self.assertEqual(response['Retry-After'], str(retry_after))
+        payload = response.json()
+        self.assertEqual(payload['status'], 'busy')
+        self.assertEqual((payload['retry_after'], payload['eta_seconds']), (retry_after, eta))
+        # Nothing was created, queued or counted
+        self.assertEqual(self.send.call_count, 0)
+        self.assertFalse(ProcessedPhoto.objects.exists())
+        self.assertEqual(int(get_redis().get('admission:fast:jobs')), 20)
+
+    def test_retry_after_is_at_least_five_seconds(self):
+        self.backlog(5, 2 * (10_000 - 2 * self.estimated_ms) + 200)
+        response = self.upload()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '5')
+
+
+class SniffFormatTests(SimpleTestCase):
+    def test_allowed_formats(self):
+        for head, mime in (
+            (b'\xff\xd8\xff\xe0\x00\x10JFIF\x00', 'image/jpeg'),
+            (b'\x89PNG\r\n\x1a\n\x00\x00\x00\x0d', 'image/png'),
+            (b'RIFF\x24\x00\x00\x00WEBP', 'image/webp'),
+            (b'\x00\x00\x00\x18ftypheic', 'image/heic'),
+            (b'BM\x36\x00\x0c\x00\x00\x00\x00\x00\x36\x00', 'image/bmp'),
+        ):
+            with self.subTest(mime=mime):
+                self.assertEqual(sniff_format(head), mime)
+
+    def test_other_formats(self):
+        for head in (b'GIF89a\x01\x00\x01\x00\x80\x00', b'%PDF-1.7\n%\xe2\xe3', b'\x00\x00\x00\x18ftypmp42', b''):
+            with self.subTest(head=head):
+                self.assertIsNone(sniff_format(head))
+
+
+@override_settings(UPLOAD_SPOOL_MEMORY_BYTES=1024)
+class PhotoUploadHandlerTests(SimpleTestCase):
+    def receive(self, data, name='photo.png', chunk=100):
+        handler = PhotoUploadHandler(RequestFactory().post('/'))
+        handler.new_file('photo', name, 'application/octet-stream', None)
+        for start in range(0, len(data), chunk):
+            handler.receive_data_chunk(data[start:start + chunk], start)
+        return handler, handler.file_complete(len(data))
+
+    def test_chunks_are_hashed_and_sniffed_as_they_arrive(self):
+        data = png_upload().getvalue()
+        _, upload = self.receive(data)
+        self.assertEqual(upload.sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual((upload.content_type, upload.sniffed_type), ('image/png', 'image/png'))
+        self.assertEqual((upload.name, upload.size), ('photo.png', len(data)))
+        self.assertEqual(upload.read(), data)
+
+    def test_spooled_in_memory_up_to_the_limit(self):
+        small = b'\x89PNG\r\n\x1a\n' + bytes(500)
+        self.assertFalse(self.receive(small)[1].file._rolled)
+        self.assertTrue(self.receive(small * 4)[1].file._rolled)
+
+    def test_short_files_are_sniffed_when_complete(self):
+        handler, _ = self.receive(b'BM\x00\x00', name='photo.bmp')
+        self.assertEqual(handler.sniffed_type, 'image/bmp')
+        with self.assertRaises(StopUpload):
+            self.receive(b'GIF8', name='photo.bmp')
+
+    @override_settings(PHOTO_UPLOAD_MAX_BYTES=1000)
+    def test_reading_stops_at_the_size_limit(self):
+        data = b'\x89PNG\r\n\x1a\n' + bytes(2000)
+        handler = PhotoUploadHandler(RequestFactory().post('/'))
+        handler.new_file('photo', 'photo.png', 'image/png', None)
+        handler.receive_data_chunk(data[:1000], 0)
+        with self.assertRaises(StopUpload) as stop:
+            handler.receive_data_chunk(data[1000:1100], 1000)
+        self.assertTrue(stop.exception.connection_reset)
+        self.assertTrue(handler.file.closed)
+        self.assertEqual(handler.request.upload_rejection[0], 'file_too_large')
+
+
+class UploadRejectionTests(UploadTestCase):
+    def post_file(self, data, name):
+        upload = io.BytesIO(data)
+        upload.name = name
+        with mock.patch('passport_tool.scheduler.FairScheduler._send_to_celery') as send:
+            response = self.client.post(
+                reverse('api_upload', args=[self.rule.slug]), {'photo': upload, 'skip_bg': 'true'}, secure=True,
+            )
+        send.assert_not_called()
+        self.assertFalse(ProcessedPhoto.objects.exists())
+        return response.status_code, response.json()['status']
+
+    def test_extension_must_be_allowed(self):
+        self.assertEqual(self.post_file(png_upload().getvalue(), 'photo.gif'), (400, 'invalid_file_type'))
+
+    def test_contents_must_be_an_allowed_format(self):
+        gif = io.BytesIO()
+        Image.new('RGB', (30, 40)).save(gif, format='GIF')
+        self.assertEqual(self.post_file(gif.getvalue(), 'photo.png'), (400, 'invalid_mime_type'))
+
+    @override_settings(PHOTO_UPLOAD_MAX_BYTES=2000)
+    def test_file_past_the_limit_is_refused(self):
+        # Within the multipart allowance: stopped while the chunks arrive
+        data = b'\x89PNG\r\n\x1a\n' + bytes(5000)
+        self.assertEqual(self.post_file(data, 'photo.png'), (400, 'file_too_large'))
+
+    @override_settings(PHOTO_UPLOAD_MAX_BYTES=2000)
+    def test_body_past_the_limit_is_not_parsed(self):
+        data = b'\x89PNG\r\n\x1a\n' + bytes(100_000)
+        with mock.patch.object(PhotoUploadHandler, 'new_file') as new_file:
+            self.assertEqual(self.post_file(data, 'photo.png'), (400, 'file_too_large'))
+        new_file.assert_not_called()
@@ -0,0 +1,135 @@
+import io
+import json
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from unittest import mock
+
+from celery.backends.base import DisabledBackend
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from passport_tool import webhooks
+from passport_tool.models import ApiClient, WebhookDelivery
+from passport_tool.tasks import deliver_webhook
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class SignatureTests(SimpleTestCase):
+    body = b'{"id": "1", "type": "job.completed"}'
+
+    def test_signed_body_verifies(self):
+        header = webhooks.sign('secret', int(time.time()), self.body)
+        self.assertTrue(webhooks.verify('secret', header, self.body))
+
+    def test_tampered_body_or_wrong_secret_fails(self):
+        header = webhooks.sign('secret', int(time.time()), self.body)
+        self.assertFalse(webhooks.verify('secret', header, self.body + b' '))
+        self.assertFalse(webhooks.verify('other', header, self.body))
+
+    def test_old_timestamp_fails(self):
+        header = webhooks.sign('secret', int(time.time()) - 301, self.body)
+        self.assertFalse(webhooks.verify('secret', header, self.body))
+        self.assertTrue(webhooks.verify('secret', header, self.body, tolerance=600))
+
+    def test_malformed_header_fails(self):
+        for header in ('', 'v1=abc', 't=soon,v1=abc', 'garbage'):
+            with self.subTest(header=header):
+                self.assertFalse(webhooks.verify('secret', header, self.body))
+
+    @override_settings(WEBHOOK_BACKOFF_SECONDS=10)
+    def test_backoff_triples(self):
+        self.assertEqual([webhooks.backoff(attempt) for attempt in (1, 2, 3, 4)], [10, 30, 90, 270])
+
+
+@override_settings(WEBHOOK_BACKOFF_SECONDS=10)
+class DeliveryTests(TestCase):
+    """deliver_webhook, run eagerly, against `manage.py webhook_receiver`."""
+
+    def setUp(self):
+        self.client_row = ApiClient.objects.create(name='Integrator', callback_hosts='127.0.0.1')
+        self.addCleanup(setattr, webhooks, '_pool', None)
+        self.retry = mock.Mock(wraps=deliver_webhook.retry)
+        for patcher in (
+            mock.patch.object(deliver_webhook, 'retry', self.retry),
+            # Eager results are not stored anywhere
+            mock.patch.object(deliver_webhook, '_backend', DisabledBackend(deliver_webhook.app)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def start_receiver(self, secret=None, **options):
+        """Runs the receiver on a free port; returns (url, its output)."""
+        servers = []
+
+        class Server(ThreadingHTTPServer):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                servers.append(self)
+
+        port = free_port()
+        output = io.StringIO()
+        # The receiver's thread has no view of this test's transaction
+        lookup = mock.Mock(return_value=mock.Mock(secret=secret or self.client_row.secret))
+        with mock.patch('passport_tool.management.commands.webhook_receiver.ThreadingHTTPServer', Server), \
+                mock.patch.object(webhooks, 'api_client', lookup):
+            thread = threading.Thread(target=call_command, args=('webhook_receiver',), kwargs={
+                'port': port, 'api_key': self.client_row.key, 'stdout': output, **options,
+            }, daemon=True)
+            thread.start()
+            deadline = time.monotonic() + 5
+            while not servers and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertTrue(servers, 'receiver did not start')
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(servers[0].shutdown)
+        return f'http://127.0.0.1:{port}/hook', output
+
+    def deliver(self, url, status='failed'):
+        event = {'id': 'evt-1', 'type': f'job.{status}', 'job_id': 42, 'status': status, 'created': time.time()}
+        if status == 'failed':
+            event['error'] = 'No face found.'
+        return deliver_webhook.apply(args=(self.client_row.pk, url, 'http://testserver/', event)).get()
+
+    def countdowns(self):
+        return [c.kwargs['countdown'] for c in self.retry.call_args_list]
+
+    def test_delivery_is_signed_with_the_client_secret(self):
+        url, output = self.start_receiver()
+        self.assertIs(self.deliver(url, status='completed'), True)
+        banner, request_line, body = output.getvalue().split('\n', 2)
+        self.assertEqual(request_line, '#1 /hook signature valid')
+        event = json.loads(body)
+        self.assertTrue(event['result_url'].startswith('http://testserver/api/result/42/?token='))
+        self.assertEqual(self.countdowns(), [])
+
+    def test_receiver_rejects_a_bad_signature(self):
+        url, output = self.start_receiver(secret='not-the-client-secret')
+        with override_settings(WEBHOOK_MAX_ATTEMPTS=1), self.assertLogs('passport_tool.tasks', 'WARNING'):
+            self.assertEqual(self.deliver(url), 'HTTP 401')
+        self.assertIn('signature INVALID', output.getvalue())
+
+    def test_failed_attempts_are_retried_with_backoff(self):
+        # 500 is not retried within an attempt, so each attempt is one request
+        url, output = self.start_receiver(fail_first=2, status=500)
+        with override_settings(WEBHOOK_MAX_ATTEMPTS=5):
+            self.assertIs(self.deliver(url), True)
+        self.assertEqual(self.countdowns(), [10, 30])
+        self.assertIn('#3 /hook signature valid', output.getvalue())
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+    def test_gives_up_after_max_attempts_as_a_dead_letter(self):
+        url, output = self.start_receiver(fail_first=10, status=500)
+        with override_settings(WEBHOOK_MAX_ATTEMPTS=3), self.assertLogs('passport_tool.tasks', 'WARNING'):
+            self.assertEqual(self.deliver(url), 'HTTP 500')
+        self.assertEqual(self.countdowns(), [10, 30])
+        self.assertEqual(output.getvalue().count('answered 500'), 3)
+        dead, = WebhookDelivery.objects.all()
+        self.assertEqual((dead.client, dead.job_id, dead.attempts, dead.last_error), (self.client_row, 42, 3, 'HTTP 500'))
+        self.assertEqual(dead.event['id'], 'evt-1')
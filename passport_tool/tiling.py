@@ -0,0 +1,187 @@
+"""
+Tile-parallel helpers for the Pillow imaging backend.
+
+CPU-heavy per-pixel stages are split into strips, run on a shared thread
+pool (Pillow releases the GIL inside its resampling and filter kernels) and
+stitched back together. Each helper is bit-identical to the serial Pillow
+call it replaces:
+
+- LANCZOS resize runs the way Pillow runs it internally: a horizontal pass,
+  then a vertical pass, on premultiplied data. The first pass is split by
+  rows and the second by columns, so every output pixel sees the same inputs
+  and coefficients.
+- Neighbourhood filters get a halo of context rows that is cropped off
+  afterwards.
+- Global statistics (the contrast mean) are reduced across tiles first.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageEnhance, ImageFilter, ImageStat
+
+# Below this many pixels fanning out costs more than it saves
+TILE_MIN_PIXELS = 1_000_000
+
+_pool = None
+_pool_workers = 0
+
+
+def cpu_quota():
+    """
+    Number of CPUs this process may actually use: the cgroup CPU quota when
+    the container sets one, otherwise the scheduler affinity mask.
+    """
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            return max(1, int(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0:
+            return max(1, quota // period)
+    except (OSError, ValueError):
+        pass
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_pool(workers):
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='engine-tile')
+        _pool_workers = workers
+    return _pool
+
+
+def should_tile(workers, *sizes):
+    return workers > 1 and max(w * h for w, h in sizes) >= TILE_MIN_PIXELS
+
+
+def _spans(length, parts, halo=0):
+    """(start, end, halo_start, halo_end) for `parts` near-equal spans of 0..length."""
+    cuts = [round(length * i / parts) for i in range(parts + 1)]
+    return [(a, b, max(0, a - halo), min(length, b + halo)) for a, b in zip(cuts, cuts[1:]) if b > a]
+
+
+def map_rows(image, fn, workers, halo=0):
+    """
+    Applies `fn` to horizontal strips of `image` (each padded with `halo`
+    rows of context) and stitches the results. `fn` must keep strip height.
+    """
+    spans = _spans(image.height, workers, halo)
+
+    def run(span):
+        start, end, halo_start, halo_end = span
+        out = fn(image.crop((0, halo_start, image.width, halo_end)))
+        if (halo_start, halo_end) != (start, end):
+            top = start - halo_start
+            out = out.crop((0, top, out.width, top + end - start))
+        return out
+
+    parts = list(get_pool(workers).map(run, spans))
+    stitched = Image.new(parts[0].mode, (parts[0].width, image.height))
+    for (start, _, _, _), part in zip(spans, parts):
+        stitched.paste(part, (0, start))
+    return stitched
+
+
+def map_columns(image, fn, workers):
+    """Applies `fn` to vertical strips of `image`; `fn` must keep strip width."""
+    spans = _spans(image.width, workers)
+
+    def run(span):
+        start, end, _, _ = span
+        return fn(image.crop((start, 0, end, image.height)))
+
+    parts = list(get_pool(workers).map(run, spans))
+    stitched = Image.new(parts[0].mode, (image.width, parts[0].height))
+    for (start, _, _, _), part in zip(spans, parts):
+        stitched.paste(part, (start, 0))
+    return stitched
+
+
+def resize(image, size, workers):
+    """Tiled equivalent of image.resize(size, Image.Resampling.LANCZOS)."""
+    if image.size == tuple(size):
+        return image.copy()
+    premultiplied = {"LA": "La", "RGBA": "RGBa"}.get(image.mode)
+    work = image.convert(premultiplied) if premultiplied else image
+    width, height = size
+    if width != work.width:
+        work = map_rows(work, lambda strip: strip.resize((width, strip.height), Image.Resampling.LANCZOS), workers)
+    if height != work.height:
+        work = map_columns(work, lambda strip: strip.resize((strip.width, height), Image.Resampling.LANCZOS), workers)
+    return work.convert(image.mode) if premultiplied else work
+
+
+def gaussian_blur(image, radius, workers):
+    """Tiled equivalent of image.filter(ImageFilter.GaussianBlur(radius))."""
+    # Pillow approximates the gaussian with three box passes; this halo
+    # comfortably covers their combined reach
+    halo = int(radius * 6) + 8
+    return map_rows(image, lambda strip: strip.filter(ImageFilter.GaussianBlur(radius=radius)), workers, halo=halo)
+
+
+# Row strips the contrast mean is measured over
+MEAN_ROWS = 128
+
+# Modes whose bands are all 8-bit, so a point() table maps them exactly
+TABLE_MODES = ("L", "LA", "RGB", "RGBA")
+
+
+def blend_table(degenerate, factor):
+    """
+    Image.blend(constant `degenerate`, v, factor) for every 8-bit v. Worked
+    out by Pillow's own blend, so the rounding and clipping are Pillow's.
+    """
+    ramp = Image.frombytes("L", (256, 1), bytes(range(256)))
+    return list(Image.blend(Image.new("L", (256, 1), degenerate), ramp, factor).tobytes())
+
+
+def point_colour(image, table):
+    """Maps the colour bands of a TABLE_MODES image through `table`; alpha is kept."""
+    identity = list(range(256))
+    return image.point([value for band in image.getbands() for value in (identity if band == "A" else table)])
+
+
+def contrast_mean(image, workers=1):
+    """
+    The grey level ImageEnhance.Contrast blends towards, summed from the L
+    histograms of row strips instead of measured on a full-size L copy.
+    """
+    def histogram(top):
+        return image.crop((0, top, image.width, min(image.height, top + MEAN_ROWS))).convert("L").histogram()
+
+    tops = range(0, image.height, MEAN_ROWS)
+    histograms = get_pool(workers).map(histogram, tops) if workers > 1 else map(histogram, tops)
+    return int(ImageStat.Stat([sum(counts) for counts in zip(*histograms)]).mean[0] + 0.5)
+
+
+def enhance(image, brightness, contrast, sharpness, workers):
+    """
+    Tiled equivalent of ImageEnhance Brightness -> Contrast -> Sharpness, for
+    TABLE_MODES images. Brightness and contrast blend every pixel with a
+    constant, so they are point() tables (see blend_table).
+    """
+    if brightness != 1.0:
+        table = blend_table(0, brightness)
+        image = map_rows(image, lambda strip: point_colour(strip, table), workers)
+    if contrast != 1.0:
+        table = blend_table(contrast_mean(image, workers), contrast)
+        image = map_rows(image, lambda strip: point_colour(strip, table), workers)
+    if sharpness != 1.0:
+        # SMOOTH is 3x3: one context row either side
+        image = map_rows(image, lambda strip: ImageEnhance.Sharpness(strip).enhance(sharpness), workers, halo=1)
+    return image
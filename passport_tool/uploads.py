@@ -0,0 +1,131 @@
+"""
+Streaming upload handling for the photo API.
+
+Django's default handlers hold each upload in memory up to
+FILE_UPLOAD_MAX_MEMORY_SIZE (30MB here, for the admin and CKEditor) before
+the view can look at it. PhotoUploadHandler instead streams the file into
+a SpooledTemporaryFile that stays in memory only up to
+UPLOAD_SPOOL_MEMORY_BYTES, and while the chunks arrive it
+
+- sniffs the format from the first bytes and stops on anything that is not
+  an allowed image type;
+- stops as soon as the file grows past PHOTO_UPLOAD_MAX_BYTES (or right
+  away when the request's Content-Length already says it will);
+- computes the SHA-256, exposed as `upload.sha256` and reused as the
+  job's content identity (dedup.py).
+
+A rejected upload leaves (status, message) in `request.upload_rejection`
+for the view to answer with. Parsing stops at the photo, which the pages
+send before the CSRF token, so the view must answer rejections before its
+CSRF check (harmless: a rejection changes nothing).
+"""
+import hashlib
+import os
+import tempfile
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
+
+# Bytes needed to tell the allowed formats apart
+SNIFF_BYTES = 12
+
+HEIF_BRANDS = {b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'mif1', b'msf1'}
+
+
+def sniff_format(head):
+    """MIME type of an allowed image format from its first bytes, or None."""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[4:8] == b'ftyp' and head[8:12] in HEIF_BRANDS:
+        return 'image/heic'
+    if head.startswith(b'BM'):
+        return 'image/bmp'
+    return None
+
+
+class HashedUploadedFile(UploadedFile):
+    """Spooled upload carrying its SHA-256 and sniffed MIME type."""
+
+    def __init__(self, file, name, content_type, size, charset, sha256, sniffed_type):
+        super().__init__(file, name, content_type, size, charset)
+        self.sha256 = sha256
+        self.sniffed_type = sniffed_type
+
+
+class PhotoUploadHandler(FileUploadHandler):
+    def __init__(self, request=None):
+        super().__init__(request)
+        from django.conf import settings
+        self.max_bytes = settings.PHOTO_UPLOAD_MAX_BYTES
+        self.spool_bytes = settings.UPLOAD_SPOOL_MEMORY_BYTES
+        self.allowed_extensions = settings.ALLOWED_UPLOAD_EXTENSIONS
+        self.allowed_types = settings.ALLOWED_MIME_TYPES
+
+    def _reject(self, status, message, connection_reset):
+        if self.request is not None:
+            self.request.upload_rejection = (status, message)
+        raise StopUpload(connection_reset=connection_reset)
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # Multipart overhead is small: a body this large cannot hold an
+        # acceptable photo. Skip parsing it altogether (StopUpload is not
+        # caught at this stage).
+        if content_length and content_length > self.max_bytes + 64 * 1024:
+            if self.request is not None:
+                self.request.upload_rejection = ('file_too_large', 'File too large.')
+            return QueryDict(encoding=encoding), MultiValueDict()
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        if os.path.splitext(file_name or '')[1].lower() not in self.allowed_extensions:
+            # Drain the body so the client reads the error instead of a reset
+            self._reject(
+                'invalid_file_type',
+                f'Invalid file type. Allowed types: {", ".join(self.allowed_extensions)}',
+                connection_reset=False,
+            )
+        self.file = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        self.sha = hashlib.sha256()
+        self.head = b''
+        self.sniffed_type = None
+        self.received = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.max_bytes:
+            # Stop reading an oversized body right here
+            self.file.close()
+            self._reject('file_too_large', 'File too large.', connection_reset=True)
+        if self.sniffed_type is None:
+            self.head = (self.head + raw_data)[:SNIFF_BYTES]
+            if len(self.head) >= SNIFF_BYTES:
+                self._check_format()
+        self.sha.update(raw_data)
+        self.file.write(raw_data)
+
+    def _check_format(self):
+        self.sniffed_type = sniff_format(self.head)
+        if self.sniffed_type not in self.allowed_types:
+            self.file.close()
+            self._reject('invalid_mime_type', 'Invalid file format detected.', connection_reset=False)
+
+    def file_complete(self, file_size):
+        if self.sniffed_type is None:
+            # Shorter than SNIFF_BYTES
+            self._check_format()
+        self.file.seek(0)
+        return HashedUploadedFile(
+            file=self.file,
+            name=self.file_name,
+            content_type=self.sniffed_type,
+            size=file_size,
+            charset=self.charset,
+            sha256=self.sha.hexdigest(),
+            sniffed_type=self.sniffed_type,
+        )
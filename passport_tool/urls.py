@@ -19,4 +19,7 @@ urlpatterns = [
     path('<slug:slug>/', views.tool_view, name='tool_detail'),
     path('api/upload/<slug:slug>/', views.upload_photo, name='api_upload'),
     path('api/status/<int:photo_id>/', views.check_status, name='api_status'),
+    path('api/stream/<int:photo_id>/', views.stream_status, name='api_stream'),
+    path('api/cancel/<int:photo_id>/', views.cancel_job, name='api_cancel'),
+    path('api/result/<int:photo_id>/', views.download_result, name='api_result'),
 ]
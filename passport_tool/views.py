@@ -1,8 +1,11 @@
+import io
+
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import JsonResponse
+from django.http import JsonResponse, Http404
 from django.contrib import messages
-from .models import CountryRule, ProcessedPhoto, ContactMessage
-import time
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from .models import CountryRule, ContactMessage
+from .ratelimit import rate_limit
 
 def tool_view(request, slug):
     from .tasks import process_photo_task
@@ -87,123 +90,463 @@ def image_converter(request):
     
     return render(request, 'passport_tool/image_converter.html', context)
 
-def upload_photo(request, slug):
+@csrf_exempt
+@rate_limit('upload', methods=('POST',))
+async def upload_photo(request, slug):
+    # Rate limited (ratelimit.py) before the body is read; the photo then
+    # streams through the hashing/sniffing handler (uploads.py). Handlers
+    # must be set before anything reads the body, hence the CSRF check
+    # moves into _upload_photo, after rejections are answered.
+    api_client = None
+    if request.headers.get('X-API-Key'):
+        # Server-to-server integrators (webhooks.py)
+        from .webhooks import aapi_client
+        api_client = await aapi_client(request.headers['X-API-Key'])
+        if api_client is None:
+            return JsonResponse({'error': 'Invalid API key.', 'status': 'invalid_api_key'}, status=401)
+    from .uploads import PhotoUploadHandler
+    request.upload_handlers = [PhotoUploadHandler(request)]
+    if request.method == 'POST':
+        from asgiref.sync import sync_to_async
+        # Under ASGI the body has already been received (into a spooled
+        # file); parsing reads it back, so it runs in a thread
+        await sync_to_async(lambda: request.POST, thread_sensitive=False)()
+        rejection = getattr(request, 'upload_rejection', None)
+        if rejection:
+            status, error = rejection
+            return JsonResponse({'error': error, 'status': status}, status=400)
+    if api_client is not None:
+        # Authenticated by key: there is no browser session to forge
+        return await _create_job(request, slug, api_client)
+    return await _upload_photo(request, slug)
+
+@csrf_protect
+async def _upload_photo(request, slug):
+    return await _create_job(request, slug)
+
+async def _job_owner(request, api_client=None):
+    """Who an upload belongs to: its API client, else the browser session."""
+    if api_client is not None:
+        return f"api:{api_client.pk}"
+    if not request.session.session_key:
+        # Sends the new session's cookie with this response
+        await request.session.asave()
+        request.session.modified = True
+    return request.session.session_key
+
+async def _owns(request, photo):
+    """Whether the caller is the uploader of `photo` (same key or session)."""
+    if request.headers.get('X-API-Key'):
+        from .webhooks import aapi_client
+        client = await aapi_client(request.headers['X-API-Key'])
+        return client is not None and photo.owner == f"api:{client.pk}"
+    return bool(photo.owner) and photo.owner == request.session.session_key
+
+async def _create_job(request, slug, api_client=None):
+    """
+    Admits, deduplicates, stores and queues one upload. Redis and the
+    database are reached through redis.asyncio and the async ORM; only
+    reading the upload's file, writing the original to the payload store,
+    inline processing and the Celery publish run in threads.
+    """
     if request.method == 'POST' and request.FILES.get('photo'):
-        # Rate limiting - max 20 uploads per 30 minutes per IP
-        ip_address = request.META.get('REMOTE_ADDR', '')
-        session_key = f'photo_uploads_{ip_address}'
-        
-        # Get upload timestamps from session
-        uploads = request.session.get(session_key, [])
-        current_time = time.time()
-        
-        # Remove uploads older than 30 minutes (1800 seconds)
-        uploads = [ts for ts in uploads if current_time - ts < 1800]
-        
-        if len(uploads) >= 20:
-            return JsonResponse({
-                'error': 'Too many uploads. Please try again later.',
-                'status': 'rate_limited'
-            }, status=429)
-        
+        from asgiref.sync import sync_to_async
+        # Extension, format sniffing and size were checked while streaming
         photo = request.FILES['photo']
         
-        # File validation - check extension
-        import os
+        # Header-only admission: dimensions, frames, decompression bombs
         from django.conf import settings
-        
-        file_ext = os.path.splitext(photo.name)[1].lower()
-        if file_ext not in settings.ALLOWED_UPLOAD_EXTENSIONS:
-            return JsonResponse({
-                'error': f'Invalid file type. Allowed types: {", ".join(settings.ALLOWED_UPLOAD_EXTENSIONS)}',
-                'status': 'invalid_file_type'
-            }, status=400)
-        
-        # MIME check (optional)
+        from .probe import probe_image, ImageRejected
         try:
-            import magic
-            mime = magic.Magic(mime=True)
-            file_mime = mime.from_buffer(photo.read(2048))
-            photo.seek(0)
-            if file_mime not in settings.ALLOWED_MIME_TYPES:
-                return JsonResponse({
-                    'error': 'Invalid file format detected.',
-                    'status': 'invalid_mime_type'
-                }, status=400)
-        except:
-            pass
-        
-        if photo.size > settings.FILE_UPLOAD_MAX_MEMORY_SIZE:
-            return JsonResponse({
-                'error': 'File too large.',
-                'status': 'file_too_large'
-            }, status=400)
+            image_info = await sync_to_async(probe_image, thread_sensitive=False)(
+                photo,
+                max_megapixels=settings.MAX_UPLOAD_MEGAPIXELS,
+                max_frames=settings.MAX_UPLOAD_FRAMES
+            )
+        except ImageRejected as e:
+            return JsonResponse({'error': e.message, 'status': e.status}, status=400)
+
+        # Optional completion webhook instead of polling
+        callback_url = request.POST.get('callback_url')
+        if callback_url:
+            from .webhooks import check_callback, CallbackRejected
+            try:
+                check_callback(api_client, callback_url)
+            except CallbackRejected as e:
+                return JsonResponse({'error': e.message, 'status': e.status}, status=400)
         
         try:
-            country_rule = CountryRule.objects.get(slug=slug)
+            country_rule = await CountryRule.objects.aget(slug=slug)
         except CountryRule.DoesNotExist:
             return JsonResponse({'error': 'Invalid tool'}, status=400)
         
-        processed = ProcessedPhoto.objects.create(
-            original_image=photo,
-            rule=country_rule
-        )
-        
-        uploads.append(current_time)
-        request.session[session_key] = uploads
-        
         skip_bg = request.POST.get('skip_bg') == 'true'
         use_original_dimensions = request.POST.get('use_original_dimensions') == 'true'
         is_signature = (country_rule.country == "Signature Resizer")
 
-        task = process_photo_task.delay(
-            processed.id, 
-            skip_bg=skip_bg, 
+        # Converter/compressor tools (and "keep original" on the image
+        # converter) only need transcoding: conversion mode skips the engine
+        from .cost import job_mode, estimate_job, acquire_inline_slot, release_inline_slot
+        mode = job_mode(
+            country_rule,
+            skip_bg=skip_bg,
             use_original_dimensions=use_original_dimensions,
-            is_signature=is_signature
+            is_signature=is_signature,
+            convert=request.POST.get('mode') == 'convert'
         )
-        processed.task_id = task.id
-        processed.save()
+        conversion_kwargs = {}
+        if mode == 'conversion':
+            from .conversion import target_format
+            target_kb = request.POST.get('target_kb')
+            conversion_kwargs = {
+                'fmt': target_format(country_rule, request.POST.get('format')),
+                'target_kb': int(target_kb) if target_kb and target_kb.isdigit() else None,
+            }
+
+        # Only the uploader can poll the job and get its result URL
+        owner = await _job_owner(request, api_client)
+
+        # Cheap jobs: process inline and answer in this response, no polling
+        job = estimate_job(photo, mode, info=image_info)
+        if job.inline and acquire_inline_slot():
+            from .tasks import process_upload_inline
+            try:
+                processed = await sync_to_async(process_upload_inline)(
+                    photo, country_rule, mode, owner,
+                    use_original_dimensions=use_original_dimensions,
+                    **conversion_kwargs
+                )
+            except Exception:
+                # Let the worker retry it (and report the error) the usual way
+                photo.seek(0)
+                processed = None
+            finally:
+                release_inline_slot()
+            if processed is not None:
+                # Delivered like a queued result: signed URL, same retention
+                from .delivery import result_url
+                return JsonResponse({
+                    'photo_id': processed.id,
+                    'status': 'completed',
+                    'phase': 'final',
+                    'processed_url': result_url(processed.id),
+                    'content_type': processed.result_mime,
+                    'expires_in': settings.RESULT_URL_MAX_AGE
+                })
+
+        # Single flight: a repeat of an in-flight upload from this session
+        # or API client (double click, retry after a network error) joins
+        # the existing job. Each callback gets a job of its own.
+        from . import dedup
+        flight = dedup.flight_key(owner, dedup.content_digest(photo), {
+            'rule': country_rule.slug,
+            'mode': mode,
+            'skip_bg': skip_bg,
+            'use_original_dimensions': use_original_dimensions,
+            'is_signature': is_signature,
+            **conversion_kwargs,
+        })
+        existing = None if callback_url else await dedup.afind(flight)
+        if existing:
+            from .liveness import abeat
+            await dedup.aattach(existing.id)
+            await abeat(existing.id)
+            return JsonResponse({
+                'photo_id': existing.id,
+                'status': 'processing',
+                'task_id': existing.task_id,
+                'deduplicated': True
+            })
+
+        # Admission control: refuse work the client would abandon anyway
+        from .admission import aassess, aadmitted, withdrawn
+        admission = await aassess(job)
+        if not admission.accepted:
+            response = JsonResponse({
+                'error': f'We are very busy right now. Please try again in about {admission.retry_after} seconds.',
+                'status': 'busy',
+                'retry_after': admission.retry_after,
+                'eta_seconds': admission.eta_seconds
+            }, status=503)
+            response['Retry-After'] = str(admission.retry_after)
+            return response
+
+        from .jobs import get_job_store
+        store = get_job_store()
+        processed = await store.acreate(country_rule, photo, owner=owner)
+
+        # Route by cost so cheap jobs never queue behind segmentation, and
+        # interleave clients fairly within each queue
+        from .tasks import process_photo_task, convert_photo_task
+        from .scheduler import asubmit, aclient_key
+        if mode == 'conversion':
+            task, task_kwargs = convert_photo_task, {
+                'use_original_dimensions': use_original_dimensions,
+                **conversion_kwargs,
+            }
+        else:
+            task, task_kwargs = process_photo_task, {
+                'skip_bg': skip_bg,
+                'use_original_dimensions': use_original_dimensions,
+                'is_signature': is_signature,
+            }
+        import uuid
+        task_id = str(uuid.uuid4())
+        # Count the job before it can possibly finish, and uncount it if
+        # it never reaches the queue
+        await aadmitted(task_id, job, admission)
+        try:
+            await asubmit(
+                task, job.queue, await aclient_key(request),
+                args=(processed.id,), kwargs=task_kwargs, cost_ms=job.estimated_ms, task_id=task_id
+            )
+        except Exception:
+            # Rare: the broker is down. Cleaned up the simple way
+            await sync_to_async(withdrawn)(task_id)
+            await sync_to_async(store.delete)(processed)
+            raise
+        await store.aupdate(processed, task_id=task_id)
+        await dedup.aregister(flight, processed.id)
+        # Start the liveness clock; status polls and streams keep it running
+        from .liveness import abeat
+        await abeat(processed.id)
+        from . import events
+        await events.apublish(processed.id, 'queued', position=admission.position, eta_seconds=admission.eta_seconds)
+        if callback_url:
+            from . import webhooks
+            await webhooks.aregister(processed.id, api_client, callback_url, request.build_absolute_uri('/'))
         
         return JsonResponse({
             'photo_id': processed.id,
             'status': 'processing',
-            'task_id': task.id
+            'task_id': task_id,
+            'eta_seconds': admission.eta_seconds,
+            'queue_position': admission.position
         })
     
     return JsonResponse({'error': 'Invalid request'}, status=400)
 
-import base64
+def _discard_failed(store, photo):
+    """Drops a failed or cancelled job once its client has been told."""
+    from . import liveness, dedup
+    if photo.status == 'cancelled':
+        liveness.forget(photo.id)
+        store.delete(photo)
+    elif not dedup.release(photo.id):
+        # A job shared by deduplicated uploads stays for the others
+        store.delete(photo)
+
+CANCELLED_MESSAGE = 'Processing stopped because the page was inactive. Please upload your photo again.'
 
-def check_status(request, photo_id):
-    photo = get_object_or_404(ProcessedPhoto, id=photo_id)
+@rate_limit('status')
+async def check_status(request, photo_id):
+    from asgiref.sync import sync_to_async
+    from . import liveness
+    from .jobs import get_job_store, ACTIVE_STATUSES, PREVIEW
+    store = get_job_store()
+    photo = await store.aget(photo_id)
+    if photo is None or not await _owns(request, photo):
+        raise Http404
+    if photo.status in ACTIVE_STATUSES:
+        # The client is still waiting for this job
+        await liveness.abeat(photo.id)
     
-    if photo.status == 'completed' and photo.processed_image:
-        try:
-            with photo.processed_image.open('rb') as f:
-                encoded_string = base64.b64encode(f.read()).decode('utf-8')
-                processed_url = f"data:image/png;base64,{encoded_string}"
-            
-            photo.processed_image.delete(save=False)
-            photo.delete()
-            
-            return JsonResponse({
-                'status': 'completed',
-                'processed_url': processed_url
-            })
-        except Exception as e:
-            return JsonResponse({'status': 'failed', 'error': str(e)})
+    if photo.status == 'completed':
+        # The image itself comes from download_result; the URL stays valid
+        # for a few minutes and the result for RESULT_RETENTION_SECONDS
+        from django.conf import settings
+        from .delivery import result_url
+        url = result_url(photo.id)
+        return JsonResponse({
+            'status': 'completed',
+            'phase': 'final',
+            'processed_url': url,
+            'content_type': photo.result_mime,
+            'expires_in': settings.RESULT_URL_MAX_AGE
+        })
             
+    elif photo.status == 'preview':
+        # Two-phase results: the low-res preview is ready, final still rendering.
+        # Clients that already have the preview pass ?preview=seen to skip the payload.
+        payload = {
+            'status': 'processing',
+            'phase': 'preview',
+            'processed_url': None
+        }
+        if request.GET.get('preview') != 'seen':
+            # Fetched from download_result, like the final image
+            from .delivery import result_url
+            payload['preview_url'] = result_url(photo.id, PREVIEW)
+        return JsonResponse(payload)
+        
     elif photo.status == 'failed':
-        err = photo.error_message
-        photo.delete()
-        return JsonResponse({'status': 'failed', 'error': err})
+        await sync_to_async(_discard_failed)(store, photo)
+        return JsonResponse({'status': 'failed', 'error': photo.error_message})
+
+    elif photo.status == 'cancelled':
+        # Dropped while the page looked abandoned (e.g. a long-hidden tab)
+        await sync_to_async(_discard_failed)(store, photo)
+        return JsonResponse({'status': 'failed', 'error': CANCELLED_MESSAGE})
         
     return JsonResponse({
         'status': photo.status,
         'processed_url': None
     })
 
+async def _stream_payload(store, photo_id, event):
+    """
+    Completes a progress event the way check_status answers the same state:
+    result URL, preview URL, and the cleanup after failures.
+    """
+    from asgiref.sync import sync_to_async
+    from django.conf import settings
+    from .delivery import result_url
+    from .jobs import PREVIEW, result_mime
+    stage = event['stage']
+    # Done and preview are built from the event alone: every listener of a
+    # job gets them at once, without a lookup each
+    if stage == 'done':
+        event.update(
+            processed_url=result_url(photo_id),
+            content_type=result_mime(event.get('result_format')),
+            expires_in=settings.RESULT_URL_MAX_AGE,
+        )
+        return event
+    if stage == 'preview':
+        event['preview_url'] = result_url(photo_id, PREVIEW)
+        return event
+    if stage not in ('failed', 'cancelled'):
+        return event
+    photo = await store.aget(photo_id)
+    if photo is None:
+        return {'stage': 'failed', 'error': 'This job has expired. Please upload your photo again.'}
+    await sync_to_async(_discard_failed)(store, photo)
+    if stage == 'cancelled':
+        event['error'] = CANCELLED_MESSAGE
+    return event
+
+@rate_limit('status')
+async def stream_status(request, photo_id):
+    """
+    Server-sent events for one job (events.py): every stage as it starts,
+    the preview, then the signed result URL. Replaces polling check_status;
+    the connection keeps the job alive like a poll does. An open stream is
+    a coroutine waiting on a queue, so a worker holds thousands of them.
+    """
+    import json
+    import time
+    from django.conf import settings
+    from django.http import StreamingHttpResponse
+    from . import events, liveness
+    from .jobs import get_job_store, ACTIVE_STATUSES
+    store = get_job_store()
+    photo = await store.aget(photo_id)
+    if photo is None or not await _owns(request, photo):
+        raise Http404
+
+    async def finished():
+        # Finished before the stream opened (or events were lost)
+        event = {'stage': {'completed': 'done'}.get(photo.status, photo.status), 'result_format': photo.result_format}
+        if photo.error_message:
+            event['error'] = photo.error_message
+        yield event
+
+    async def stream():
+        # Reconnect quickly once the stream is closed below
+        yield 'retry: 2000\n\n'
+        heartbeat_at = 0
+        if photo.status not in ACTIVE_STATUSES:
+            source = finished()
+        else:
+            source = events.listen(photo_id, settings.SSE_MAX_SECONDS, keepalive=settings.SSE_KEEPALIVE_SECONDS)
+        async for event in source:
+            if time.monotonic() - heartbeat_at >= settings.SSE_KEEPALIVE_SECONDS:
+                await liveness.abeat(photo_id)
+                heartbeat_at = time.monotonic()
+            if event is None:
+                yield ': keepalive\n\n'
+                continue
+            yield f"data: {json.dumps(await _stream_payload(store, photo_id, event))}\n\n"
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Tell nginx-style proxies not to buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def download_result(request, photo_id):
+    """
+    Serves a finished job's image, or with ?kind=preview the preview of one
+    still rendering, to holders of a signed URL, which only the job's owner
+    is given (delivery.py).
+    """
+    from django.conf import settings
+    from django.http import HttpResponse, FileResponse
+    from .delivery import verify, byte_range, RangeFile, RangeNotSatisfiable
+    from .jobs import get_job_store, PREVIEW, RESULT
+    kind = request.GET.get('kind', RESULT)
+    if kind not in (PREVIEW, RESULT):
+        raise Http404
+    if not verify(photo_id, request.GET.get('token'), settings.RESULT_URL_MAX_AGE, kind):
+        return JsonResponse({'error': 'This download link has expired.'}, status=403)
+    store = get_job_store()
+    photo = store.get(photo_id)
+    blob = None
+    # The preview is dropped once the result is ready
+    if photo is not None and (photo.status == 'completed' or kind == PREVIEW):
+        try:
+            # Read from the store as the response is sent, never loaded whole
+            blob = store.open_blob(photo, kind)
+        except OSError:
+            pass
+    if blob is None:
+        return JsonResponse({'error': 'This result is no longer available. Please upload your photo again.'}, status=410)
+
+    size = blob.seek(0, io.SEEK_END)
+    blob.seek(0)
+    try:
+        span = byte_range(request.headers.get('Range'), size)
+    except RangeNotSatisfiable:
+        blob.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if kind == PREVIEW:
+        content_type, filename = 'image/png', f'snapfixer-{photo.id}-preview.png'
+    else:
+        content_type, filename = photo.result_mime, f'snapfixer-{photo.id}.{photo.result_format or "png"}'
+    if span is None:
+        response = FileResponse(blob, content_type=content_type)
+    else:
+        start, end = span
+        response = FileResponse(RangeFile(blob, start, end), content_type=content_type, status=206)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = f'inline; filename="{filename}"'
+    response['Cache-Control'] = f'private, max-age={settings.RESULT_URL_MAX_AGE}'
+    return response
+
+def cancel_job(request, photo_id):
+    """
+    Explicit cancel sent (via sendBeacon) when the page is closed or left.
+    The task id from the upload response proves the caller owns the job.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    from . import dedup
+    from .jobs import get_job_store, ACTIVE_STATUSES
+    photo = get_job_store().get(photo_id)
+    if photo is None:
+        raise Http404
+    if not photo.task_id or request.POST.get('task_id') != photo.task_id:
+        return JsonResponse({'error': 'Invalid request'}, status=403)
+    # A job shared by deduplicated uploads is only cancelled by the last one
+    if photo.status in ACTIVE_STATUSES and not dedup.release(photo.id):
+        from .liveness import cancel
+        cancel(photo.id)
+    return JsonResponse({'status': 'cancelling'})
+
 def home(request):
     countries = CountryRule.objects.filter(is_exam=False, is_tool=False).exclude(exam_country="Global").order_by('country')
     custom_rule = CountryRule.objects.filter(slug='custom-size-passport-photo').first()
@@ -217,6 +560,14 @@ def about(request):
 
 def contact(request):
     if request.method == 'POST':
+        from .ratelimit import check
+        limit = check(request, 'contact')
+        if not limit.allowed:
+            messages.error(request, 'You have sent several messages already. Please try again later.')
+            response = render(request, 'contact.html', status=429)
+            response['Retry-After'] = str(limit.retry_after)
+            return response
+
         honeypot = request.POST.get('website', '')
         if honeypot: return redirect('contact')
         
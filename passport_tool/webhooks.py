@@ -0,0 +1,204 @@
+"""
+Completion webhooks for API clients.
+
+An upload sent with a valid X-API-Key (ApiClient) may name a callback_url
+on one of the client's allow-listed hosts. When the job finishes the worker
+queues tasks.deliver_webhook, which POSTs a JSON event:
+
+    {"id": "<delivery uuid>", "type": "job.completed", "job_id": 42,
+     "status": "completed", "created": 1700000000.0,
+     "result_url": "https://.../api/result/42/?token=...",
+     "content_type": "image/png", "expires_in": 300}
+
+("job.failed" and "job.cancelled" carry "error" instead of the result),
+signed with the client's secret:
+
+    X-SnapFixer-Signature: t=<unix time>,v1=<hex HMAC-SHA256 of "<t>.<body>">
+
+Receivers should verify the signature, reject old timestamps and ignore
+repeated event ids (an attempt that timed out may have arrived).
+
+Deliveries share one pooled urllib3 client per worker process. Connection
+errors and 502/503/504 are retried within an attempt; failed attempts are
+retried up to WEBHOOK_MAX_ATTEMPTS times with exponential backoff, each with
+a freshly signed result URL. Events that still fail are kept as
+WebhookDelivery rows (dead letters), which the admin can redeliver.
+
+Registering a callback also holds the job alive (liveness.hold) for its
+lifetime: integrators wait for the callback instead of polling.
+
+`manage.py webhook_receiver` is a local stand-in receiver for testing.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import time
+import uuid
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+EVENT_TYPES = {'completed': 'job.completed', 'failed': 'job.failed', 'cancelled': 'job.cancelled'}
+
+
+class CallbackRejected(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def api_client(key):
+    """The active ApiClient owning `key`, or None."""
+    from .models import ApiClient
+    return ApiClient.objects.filter(key=key, is_active=True).first()
+
+
+async def aapi_client(key):
+    """api_client for async views."""
+    from .models import ApiClient
+    return await ApiClient.objects.filter(key=key, is_active=True).afirst()
+
+
+def check_callback(client, url):
+    """Raises CallbackRejected unless `client` may receive webhooks at `url`."""
+    from django.conf import settings
+    if client is None:
+        raise CallbackRejected('callback_requires_api_key', 'callback_url is only available with an API key.')
+    parts = urlsplit(url)
+    schemes = ('https', 'http') if settings.WEBHOOK_ALLOW_HTTP else ('https',)
+    if parts.scheme not in schemes or not parts.hostname:
+        raise CallbackRejected('invalid_callback_url', f'callback_url must be an absolute {" or ".join(schemes)} URL.')
+    if parts.hostname.lower() not in client.allowed_hosts:
+        raise CallbackRejected('callback_not_allowed', f'{parts.hostname} is not an allowed callback host for this API key.')
+
+
+def _key(job_id):
+    return f"webhook:{job_id}"
+
+
+def register(job_id, client, url, base_url):
+    """Remembers where to report `job_id`; `base_url` makes result links absolute."""
+    from django.conf import settings
+    from .redis_client import get_redis
+    from . import liveness
+    redis = get_redis()
+    redis.hset(_key(job_id), mapping={'client_id': client.pk, 'url': url, 'base_url': base_url})
+    redis.expire(_key(job_id), settings.JOB_TTL_SECONDS)
+    liveness.hold(job_id, settings.JOB_TTL_SECONDS)
+
+
+async def aregister(job_id, client, url, base_url):
+    """register for async views."""
+    from django.conf import settings
+    from .redis_client import get_async_redis
+    from . import liveness
+    redis = get_async_redis()
+    await redis.hset(_key(job_id), mapping={'client_id': client.pk, 'url': url, 'base_url': base_url})
+    await redis.expire(_key(job_id), settings.JOB_TTL_SECONDS)
+    await liveness.ahold(job_id, settings.JOB_TTL_SECONDS)
+
+
+def job_finished(job):
+    """Queues the completion event for `job` if it has a callback (once)."""
+    try:
+        from .redis_client import get_redis
+        redis = get_redis()
+        target = redis.hgetall(_key(job.id))
+        if not target:
+            return
+        redis.delete(_key(job.id))
+        from .jobs import result_mime
+        from .tasks import deliver_webhook
+        event = {
+            'id': str(uuid.uuid4()),
+            'type': EVENT_TYPES.get(job.status, f'job.{job.status}'),
+            'job_id': job.id,
+            'status': job.status,
+            'created': time.time(),
+        }
+        if job.status == 'completed':
+            event['content_type'] = result_mime(job.result_format)
+        else:
+            event['error'] = job.error_message or 'Processing stopped before the photo was finished.'
+        deliver_webhook.delay(int(target['client_id']), target['url'], target['base_url'], event)
+    except Exception as e:
+        logger.warning("Could not queue webhook for job %s: %s", job.id, e)
+
+
+def sign(secret, timestamp, body):
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def verify(secret, header, body, tolerance=300):
+    """Checks an X-SnapFixer-Signature header (what receivers should do)."""
+    try:
+        fields = dict(part.split('=', 1) for part in header.split(','))
+        timestamp = int(fields['t'])
+    except (ValueError, KeyError):
+        return False
+    if abs(time.time() - timestamp) > tolerance:
+        return False
+    return hmac.compare_digest(sign(secret, timestamp, body), header)
+
+
+def render(event, base_url):
+    """Request body for one attempt: result links are signed per attempt."""
+    from django.conf import settings
+    from .delivery import result_url
+    payload = dict(event)
+    if event['status'] == 'completed':
+        payload['result_url'] = base_url.rstrip('/') + result_url(event['job_id'])
+        payload['expires_in'] = settings.RESULT_URL_MAX_AGE
+    return json.dumps(payload).encode()
+
+
+_pool = None
+
+def http():
+    """Process-wide pooled client (keep-alive connections per callback host)."""
+    global _pool
+    if _pool is None:
+        import urllib3
+        from django.conf import settings
+        _pool = urllib3.PoolManager(
+            num_pools=50,
+            maxsize=4,
+            timeout=urllib3.Timeout(connect=3, read=settings.WEBHOOK_TIMEOUT_SECONDS),
+            retries=urllib3.Retry(
+                total=2,
+                backoff_factor=0.5,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=None,  # POST included: events are idempotent by id
+                redirect=False,
+                raise_on_status=False,
+            ),
+        )
+    return _pool
+
+
+def post(client, url, base_url, event):
+    """One delivery attempt; returns None on a 2xx, else the error."""
+    body = render(event, base_url)
+    headers = {
+        'Content-Type': 'application/json',
+        'User-Agent': 'SnapFixer-Webhooks/1.0',
+        'X-SnapFixer-Event': event['type'],
+        'X-SnapFixer-Delivery': event['id'],
+        'X-SnapFixer-Signature': sign(client.secret, int(time.time()), body),
+    }
+    try:
+        response = http().request('POST', url, body=body, headers=headers)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    if 200 <= response.status < 300:
+        return None
+    return f"HTTP {response.status}"
+
+
+def backoff(attempt):
+    """Seconds before retrying after failed attempt number `attempt` (1-based)."""
+    from django.conf import settings
+    return settings.WEBHOOK_BACKOFF_SECONDS * 3 ** (attempt - 1)
@@ -25,8 +25,12 @@ fi
 # 4. Start Gunicorn
 echo "Starting Gunicorn..."
 # Use the WEB_CONCURRENCY env var if set, otherwise default to 1 for memory safety on Nano
-exec gunicorn validphoto.wsgi:application \
+# ASGI (uvicorn) workers: waiting uploads, status polls and progress streams
+# are coroutines, so one worker holds thousands of clients (see
+# `manage.py loadtest_streams`); blocking upload work runs in its thread pool
+exec gunicorn validphoto.asgi:application \
     --bind 0.0.0.0:8000 \
     --workers ${WEB_CONCURRENCY:-1} \
+    --worker-class uvicorn_worker.UvicornWorker \
     --timeout 300 \
     --log-level debug
@@ -2,3 +2,7 @@ import os
 from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'validphoto.settings')
 application = get_asgi_application()
+
+# Photo uploads are refused by size while arriving, before Django buffers them
+from passport_tool.bodylimit import UploadSizeLimit  # noqa: E402
+application = UploadSizeLimit(application)
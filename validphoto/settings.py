@@ -141,6 +141,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'validphoto.wsgi.application'
+ASGI_APPLICATION = 'validphoto.asgi.application'
 
 # Database
 DATABASES = {
@@ -195,9 +196,16 @@ MEDIA_ROOT = BASE_DIR / 'media'
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Redis for Celery and shared job state; "local://" gives job-state helpers
+# an in-process stand-in (see passport_tool/redis_client.py)
+REDIS_URL = env('REDIS_URL', default='redis://redis:6379/0')
+# Connections each web worker's async views may hold (progress streams share
+# one subscription, see passport_tool/events.py)
+REDIS_ASYNC_MAX_CONNECTIONS = env.int('REDIS_ASYNC_MAX_CONNECTIONS', default=50)
+
 # Celery Configuration
-CELERY_BROKER_URL = env('REDIS_URL', default='redis://redis:6379/0')
-CELERY_RESULT_BACKEND = env('REDIS_URL', default='redis://redis:6379/0')
+CELERY_BROKER_URL = REDIS_URL
+CELERY_RESULT_BACKEND = REDIS_URL
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
@@ -208,13 +216,141 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'passport_tool.tasks.cleanup_old_photos',
         'schedule': 1800.0, # 30 minutes
     },
+    'dispatch-fair-queues': {
+        'task': 'passport_tool.tasks.dispatch_fair_queues',
+        'schedule': 30.0,
+    },
+    'cancel-abandoned-jobs': {
+        'task': 'passport_tool.tasks.cancel_abandoned_jobs',
+        'schedule': 30.0,
+    },
+}
+
+# Processing jobs are routed by estimated cost (passport_tool/cost.py) to the
+# "fast", "bulk" and "segmentation" queues, each served by its own worker
+# pool; beat tasks stay on the default queue. Prefetch 1 so a worker never
+# holds jobs another idle worker could start.
+CELERY_TASK_DEFAULT_QUEUE = 'celery'
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+FAST_QUEUE_MAX_MS = env.int('FAST_QUEUE_MAX_MS', default=2000)
+
+# Per-client fair scheduling in front of the queues (passport_tool/scheduler.py):
+# deficit round robin by IP, each client credited SCHEDULER_QUANTUM_MS of
+# estimated work per turn. At most SCHEDULER_MAX_DISPATCHED jobs per queue
+# are handed to Celery at once (about the worker concurrency) and at most
+# SCHEDULER_MAX_INFLIGHT_PER_CLIENT per client.
+FAIR_SCHEDULING = env.bool('FAIR_SCHEDULING', default=True)
+SCHEDULER_QUANTUM_MS = env.int('SCHEDULER_QUANTUM_MS', default=3000)
+SCHEDULER_MAX_DISPATCHED = env.int('SCHEDULER_MAX_DISPATCHED', default=4)
+SCHEDULER_MAX_INFLIGHT_PER_CLIENT = env.int('SCHEDULER_MAX_INFLIGHT_PER_CLIENT', default=2)
+
+# Admission control (passport_tool/admission.py): uploads whose predicted
+# wait + service time exceeds the SLO get 503 + Retry-After. QUEUE_CONCURRENCY
+# mirrors the worker pools serving each queue (docker-compose / koyeb.yaml).
+ADMISSION_SLO_SECONDS = env.int('ADMISSION_SLO_SECONDS', default=90)
+QUEUE_CONCURRENCY = {
+    'fast': env.int('FAST_QUEUE_CONCURRENCY', default=4),
+    'bulk': env.int('BULK_QUEUE_CONCURRENCY', default=2),
+    'segmentation': env.int('SEGMENTATION_QUEUE_CONCURRENCY', default=1),
 }
 
+# Budgets for processing jobs (passport_tool/limits.py). Past the soft time
+# limit or TASK_MAX_RSS_MB of process memory a job is retried once at economy
+# quality; the hard limit kills it (prefork pools only: thread and solo pools
+# can only stop a job between engine stages). Prefork children are replaced
+# after WORKER_MAX_TASKS_PER_CHILD jobs or above WORKER_MAX_RSS_MB. The
+# defaults fit one child plus the pool's parent (~90 MB) on a nano (512 MB)
+# instance, with the job ceiling below the recycle line (system check W001);
+# workers running more children set both lower. 0 turns a memory check off.
+TASK_SOFT_TIME_LIMIT = env.int('TASK_SOFT_TIME_LIMIT', default=60)
+TASK_TIME_LIMIT = env.int('TASK_TIME_LIMIT', default=90)
+TASK_MAX_RSS_MB = env.int('TASK_MAX_RSS_MB', default=360)
+CELERY_WORKER_MAX_TASKS_PER_CHILD = env.int('WORKER_MAX_TASKS_PER_CHILD', default=200)
+CELERY_WORKER_MAX_MEMORY_PER_CHILD = env.int('WORKER_MAX_RSS_MB', default=400) * 1024 or None  # KiB
+
+# A job whose client has not polled for this long (or that sent a cancel on
+# page close) is abandoned: revoked while queued, stopped between engine
+# stages while running. Generous because browsers throttle timers in
+# background tabs to about once a minute.
+ABANDON_AFTER_SECONDS = env.int('ABANDON_AFTER_SECONDS', default=90)
+
+# Where job status and images live (passport_tool/jobs.py): "database"
+# (ProcessedPhoto rows + MEDIA_ROOT files, needs a disk shared by web and
+# workers) or "redis" (keys expiring after JOB_TTL_SECONDS, no Postgres
+# writes or media files per job).
+JOB_STORE = env('JOB_STORE', default='database')
+JOB_TTL_SECONDS = env.int('JOB_TTL_SECONDS', default=3600)
+
+# Expired database-store jobs are deleted CLEANUP_BATCH_SIZE rows at a time,
+# at most CLEANUP_MAX_BATCHES per cleanup_old_photos run (every 30 minutes);
+# a larger backlog is left for the next runs (passport_tool/cleanup.py).
+CLEANUP_BATCH_SIZE = env.int('CLEANUP_BATCH_SIZE', default=500)
+CLEANUP_MAX_BATCHES = env.int('CLEANUP_MAX_BATCHES', default=20)
+
+# Finished results are fetched from short-lived signed URLs
+# (passport_tool/delivery.py) and kept for RESULT_RETENTION_SECONDS after
+# completion (Redis store; the database store keeps them until cleanup).
+RESULT_URL_MAX_AGE = env.int('RESULT_URL_MAX_AGE', default=300)
+RESULT_RETENTION_SECONDS = env.int('RESULT_RETENTION_SECONDS', default=900)
+
+# Progress streams (passport_tool/events.py, /api/stream/<id>/): a stream is
+# closed after SSE_MAX_SECONDS (the browser reconnects and resumes from the
+# current stage) and sends a keepalive comment after SSE_KEEPALIVE_SECONDS
+# of silence so proxies keep the connection open.
+SSE_MAX_SECONDS = env.int('SSE_MAX_SECONDS', default=120)
+SSE_KEEPALIVE_SECONDS = env.int('SSE_KEEPALIVE_SECONDS', default=15)
+
+# Completion webhooks for API clients (passport_tool/webhooks.py): attempts
+# are retried after WEBHOOK_BACKOFF_SECONDS, then 3x longer each time (10,
+# 30, 90, 270s by default, inside RESULT_RETENTION_SECONDS) before the event
+# becomes a dead letter. Plain-http callbacks only with WEBHOOK_ALLOW_HTTP
+# (defaults to DEBUG, for the local webhook_receiver).
+WEBHOOK_MAX_ATTEMPTS = env.int('WEBHOOK_MAX_ATTEMPTS', default=5)
+WEBHOOK_BACKOFF_SECONDS = env.int('WEBHOOK_BACKOFF_SECONDS', default=10)
+WEBHOOK_TIMEOUT_SECONDS = env.int('WEBHOOK_TIMEOUT_SECONDS', default=10)
+WEBHOOK_ALLOW_HTTP = env.bool('WEBHOOK_ALLOW_HTTP', default=DEBUG)
+
+# How uploads reach the worker (passport_tool/payloads.py), never via
+# MEDIA_ROOT: "redis" (chunked, zlib when it helps) or "directory" (files in
+# PAYLOAD_DIR, e.g. a tmpfs or mounted bucket standing in for a blob store).
+PAYLOAD_TRANSPORT = env('PAYLOAD_TRANSPORT', default='redis')
+PAYLOAD_DIR = env('PAYLOAD_DIR', default='/dev/shm/snapfixer-payloads')
+PAYLOAD_CHUNK_BYTES = env.int('PAYLOAD_CHUNK_BYTES', default=1024 * 1024)
+PAYLOAD_COMPRESS = env.bool('PAYLOAD_COMPRESS', default=True)
+
 # Upload limits (30MB)
 DATA_UPLOAD_MAX_MEMORY_SIZE = 31457280
 FILE_UPLOAD_MAX_MEMORY_SIZE = 31457280
 DATA_UPLOAD_MAX_NUMBER_FIELDS = 1000
 
+# The photo API streams uploads through passport_tool/uploads.py instead:
+# rejected by type or size while arriving, and held in memory only up to
+# UPLOAD_SPOOL_MEMORY_BYTES (the rest spills to a temporary file). Under
+# ASGI the size limit is also enforced before Django buffers the body
+# (passport_tool/bodylimit.py, wrapped around validphoto.asgi).
+PHOTO_UPLOAD_MAX_BYTES = env.int('PHOTO_UPLOAD_MAX_BYTES', default=31457280)
+UPLOAD_SPOOL_MEMORY_BYTES = env.int('UPLOAD_SPOOL_MEMORY_BYTES', default=2 * 1024 * 1024)
+
+# Header-only admission (passport_tool/probe.py): larger or multi-frame
+# images are refused before they can reach a worker. 50 MP covers any
+# phone or DSLR photo.
+MAX_UPLOAD_MEGAPIXELS = env.int('MAX_UPLOAD_MEGAPIXELS', default=50)
+MAX_UPLOAD_FRAMES = env.int('MAX_UPLOAD_FRAMES', default=4)
+
+# Token-bucket rate limits per client IP (passport_tool/ratelimit.py):
+# (burst capacity, seconds to refill it). Status polls are generous because
+# whole classrooms share one address.
+RATE_LIMITS = {
+    'upload': (env.int('UPLOAD_RATE_LIMIT', default=20), 1800),
+    'status': (env.int('STATUS_RATE_LIMIT', default=600), 60),
+    'contact': (env.int('CONTACT_RATE_LIMIT', default=5), 3600),
+}
+
+# Reverse proxies (addresses or CIDR ranges) whose X-Forwarded-For is
+# believed when identifying clients for rate limits and fair scheduling
+# (proxies.py). Set it to the network the platform's edge connects from.
+TRUSTED_PROXIES = env.list('TRUSTED_PROXIES', default=['127.0.0.1', '::1'])
+
 # Security Settings
 # Only enforce HTTPS in production (when DEBUG=False)
 if not DEBUG:
@@ -246,3 +382,27 @@ SESSION_EXPIRE_AT_BROWSER_CLOSE = False
 # Allowed file upload extensions
 ALLOWED_UPLOAD_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp', '.heic', '.heif', '.bmp']
 ALLOWED_MIME_TYPES = ['image/jpeg', 'image/png', 'image/webp', 'image/heic', 'image/heif', 'image/bmp']
+
+# Imaging backend for the photo engine: "pillow" or "vips". "vips" needs
+# pyvips (in requirements.txt; the binary wheel bundles libvips); without it
+# the engine raises ImproperlyConfigured and `manage.py check` reports it
+IMAGING_BACKEND = env('IMAGING_BACKEND', default='pillow')
+
+# Threads used to tile-parallelise resizes, alpha blur and enhancement inside
+# a single job (Pillow backend). 0 = size to the container's CPU quota.
+ENGINE_THREADS = env.int('ENGINE_THREADS', default=0)
+
+# Segmentation inference: "local" (one rembg session per process), "thread"
+# (micro-batch concurrent jobs inside the worker) or "socket" (node-wide
+# server started with `manage.py run_inference_server`)
+INFERENCE_MODE = env('INFERENCE_MODE', default='local')
+INFERENCE_SOCKET = env('INFERENCE_SOCKET', default='/tmp/snapfixer-inference.sock')
+INFERENCE_BATCH_WINDOW_MS = env.int('INFERENCE_BATCH_WINDOW_MS', default=5)
+INFERENCE_MAX_BATCH = env.int('INFERENCE_MAX_BATCH', default=8)
+
+# Inline fast path: uploads whose estimated cost fits this budget are
+# processed in the web process and returned in the upload response, at
+# most INLINE_CONCURRENCY at a time per web process (the rest are queued)
+INLINE_MAX_MS = env.int('INLINE_MAX_MS', default=400)
+INLINE_MAX_BYTES = env.int('INLINE_MAX_BYTES', default=3 * 1024 * 1024)
+INLINE_CONCURRENCY = env.int('INLINE_CONCURRENCY', default=2)